@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+アセンブラの処理時間を生成したソースで計測する
+
+./bench_assemble.py [--modules n] [--jobs n] [words ...]
+wordsはアセンブル後のおおよそのword数 (default: 4096 16384 65000)
+--modulesを指定した場合、wordsをn個のモジュールに分けて--jobsのプロセス数でアセンブルとリンクをする
+"""
+
+import argparse
+import array
+import io
+import pathlib
+import tempfile
+import time
+
+import casl2sim
+
+def generate(words, name="MAIN"):
+    """
+    約words wordとなるソースを生成する (前方参照のラベル、定数、マクロ、DCを含む)
+    """
+    lines = [f"{name:8}START"]
+    size = 0
+    i = 0
+    while size < words - 32:
+        lines.extend([
+            f"L{i}      LD      GR1,D{i}",
+            f"        ADDA    GR1,=1",
+            f"        CPA     GR1,GR2",
+            f"        JPL     L{i + 1}",
+            f"        LAD     GR2,{i % 100},GR1",
+            f"        ST      GR1,D{i}    ; comment",
+            f"        SLL     GR1,0,GR3",
+            f"        CALL    L{i + 1}",
+            f"D{i}      DC      {i % 1000},#FF,'ab'"])
+        size += 19
+        if i % 16 == 0:
+            lines.append(f"        OUT     D{i},D{i}")
+            size += 12
+        i += 1
+    lines.append(f"L{i}      RET")
+    lines.append("        END")
+    return [line + "\n" for line in lines]
+
+def parse(src):
+    p = casl2sim.Parser()
+    p.parse(io.StringIO("".join(src)))
+    return len(p.get_mem())
+
+def parse_stream(src):
+    mem = array.array("H", bytes(2 * (casl2sim.Comet2.ADR_MAX + 1)))
+    size = 0
+    p = casl2sim.StreamParser()
+    for adr, vals, _ in p.parse_iter(io.StringIO("".join(src))):
+        mem[adr:adr+len(vals)] = vals
+        size = max(size, adr + len(vals))
+    return size
+
+def link_modules(words, modules, jobs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for i in range(modules):
+            path = pathlib.Path(tmpdir) / f"m{i}.casl2"
+            path.write_text("".join(generate(words // modules, f"M{i}")))
+            paths.append(str(path))
+        start = time.perf_counter()
+        p = casl2sim.Linker()
+        p.link(casl2sim.assemble_objects(paths, None, jobs))
+        elapsed = time.perf_counter() - start
+    print(f"# modules={modules} jobs={jobs} words={len(p.get_mem()):6} time={elapsed*1000:8.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("words", type=int, nargs="*", default=[4096, 16384, 65000])
+    parser.add_argument("--modules", type=int)
+    parser.add_argument("--jobs", type=int, default=1)
+    args = parser.parse_args()
+    for words in args.words:
+        if args.modules is not None:
+            link_modules(words, args.modules, args.jobs)
+            continue
+        src = generate(words)
+        for name, func in (("Parser", parse), ("StreamParser", parse_stream)):
+            start = time.perf_counter()
+            size = func(src)
+            elapsed = time.perf_counter() - start
+            print(f"# {name:12} words={size:6} lines={len(src):6} " +
+                    f"time={elapsed*1000:8.1f}ms ({elapsed/len(src)*1e6:.2f}us/line)")
+
+if __name__ == "__main__":
+    main()
@@ -6,15 +6,37 @@ CASL2シミュレータ
 STARTの位置から開始し、ENDの位置に来た時終了する
 """
 import argparse
+import array
+import asyncio
+import bisect
+import codecs
 import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import multiprocessing
+from multiprocessing import shared_memory
+import mmap
 import operator
+import os
+import pathlib
+import random
 import re
+import struct
 import sys
+import time
 
+try:
+    import numpy as np
+except ImportError: # numpyは--lanesでのみ使用する
+    np = None
 
 LABEL = r"[A-Za-z][A-Z0-9a-z]*" # 本来は小文字は不可
 RE_LABEL_LINE = re.compile(fr"({LABEL})(.*)")
-RE_OP_LINE = re.compile(r"\s+[A-Z].*")
+RE_OP_LINE = r"\s+[A-Z].*"
+# ラベル(省略可能)と命令以降に分割する
+RE_LINE = re.compile(fr"({LABEL})?({RE_OP_LINE})")
 RE_COMMENT = re.compile(r";.*")
 RE_DC = re.compile(r"\s+DC\s+")
 RE_DC_ARGS = re.compile(fr"('(''|[^'])+'|[0-9]+|#[0-9A-Fa-f]+|{LABEL})(.*)")
@@ -34,8 +56,85 @@ class Element:
         self.label = label
 # End Element
 
+class SymbolIndex:
+    """
+    番地をその番地以前で最も近いラベルとのオフセット ("LOOP+3") で表す
+    ラベルを番地の昇順に並べ、二分探索する 結果は番地ごとにキャッシュする
+    """
+    def __init__(self, labels):
+        # 同じ番地のラベルは後に定義したものを使う (Parser.set_labelinfoと同じ)
+        symbols = {}
+        for label, adr in labels.items():
+            if adr is not None:
+                symbols[adr] = label
+        self._adrs = sorted(symbols)
+        self._names = [symbols[adr] for adr in self._adrs]
+        self._cache = {}
+
+    @classmethod
+    def from_mem(cls, mem):
+        return cls({elem.label: adr for adr, elem in enumerate(mem) if elem.label is not None})
+
+    def lookup(self, adr):
+        """
+        (ラベル名, オフセット)を返す adr以前にラベルがない場合None
+        """
+        i = bisect.bisect_right(self._adrs, adr) - 1
+        if i < 0:
+            return None
+        return (self._names[i], adr - self._adrs[i])
+
+    def format(self, adr):
+        """
+        "LABEL" または "LABEL+n" を返す adr以前にラベルがない場合None
+        """
+        try:
+            return self._cache[adr]
+        except KeyError:
+            pass
+        sym = self.lookup(adr)
+        if sym is not None:
+            label, offset = sym
+            sym = label if offset == 0 else f"{label}+{offset}"
+        self._cache[adr] = sym
+        return sym
+# End SymbolIndex
+
 class Parser:
     REG_NAME_LIST = ("GR0", "GR1", "GR2", "GR3", "GR4", "GR5", "GR6", "GR7")
+    # 命令の生成方法 {命令: (生成するメソッド名, 引数以外のパラメータ)}
+    OP_SPECS = {
+            "NOP": ("op_noarg", (0x00,)),
+            "LD": ("op_1or2word", (0x14, 0x10)),
+            "ST": ("op_2word", (0x11,)),
+            "LAD": ("op_2word", (0x12,)),
+            "ADDA": ("op_1or2word", (0x24, 0x20)),
+            "SUBA": ("op_1or2word", (0x25, 0x21)),
+            "ADDL": ("op_1or2word", (0x26, 0x22)),
+            "SUBL": ("op_1or2word", (0x27, 0x23)),
+            "AND": ("op_1or2word", (0x34, 0x30)),
+            "OR": ("op_1or2word", (0x35, 0x31)),
+            "XOR": ("op_1or2word", (0x36, 0x32)),
+            "CPA": ("op_1or2word", (0x44, 0x40)),
+            "CPL": ("op_1or2word", (0x45, 0x41)),
+            "SLA": ("op_2word", (0x50,)),
+            "SRA": ("op_2word", (0x51,)),
+            "SLL": ("op_2word", (0x52,)),
+            "SRL": ("op_2word", (0x53,)),
+            "JMI": ("op_adr", (0x61,)),
+            "JNZ": ("op_adr", (0x62,)),
+            "JZE": ("op_adr", (0x63,)),
+            "JUMP": ("op_adr", (0x64,)),
+            "JPL": ("op_adr", (0x65,)),
+            "JOV": ("op_adr", (0x66,)),
+            "PUSH": ("op_adr", (0x70,)),
+            "POP": ("op_reg", (0x71,)),
+            "CALL": ("op_adr", (0x80,)),
+            "RET": ("op_noarg", (0x81,)),
+            "SVC": ("op_svc", (0xf0,)),
+            "START": ("op_START", ()),
+            "END": ("op_END", ()),
+            "DS": ("op_DS", ())}
 
     def __init__(self, start_offset=0):
         self._start_offset = start_offset
@@ -58,6 +157,11 @@ class Parser:
         self._end = -1
         # 解析中の行番号
         self._line_num = 0
+        # 命令を含む行番号 (debug用 DC, DSのみの行は含まない)
+        self._code_lines = set()
+        # 命令ごとの生成処理 {命令: (メソッド, 引数以外のパラメータ)}
+        self._encoders = {op: (getattr(self, name), params)
+                for op, (name, params) in self.OP_SPECS.items()}
 
     def parse(self, fin):
         for line in fin:
@@ -73,16 +177,23 @@ class Parser:
             self.err_exit("syntax error [not found 'START']")
         self.set_labelinfo()
 
-    def load_data(self, f, offset):
-        adr = offset
-        while True:
-            while len(self._mem) <= adr:
-                self._mem.append(Element(0, 0))
-            b = f.read(1)
-            if b == b'':
-                break
-            self._mem[adr].value = int.from_bytes(b, byteorder=sys.byteorder)
-            adr += 1
+    def load_data(self, f, offset, fmt="byte"):
+        """
+        fの内容をoffsetからのメモリに書き込む
+        fmtはIMAGE_FORMATSのいずれか
+        """
+        try:
+            segments = read_image(f.read(), fmt)
+        except ValueError as e:
+            self.err_exit(f"bad data format ({e})")
+        for adr, vals in segments:
+            adr += offset
+            if len(self._mem) < adr:
+                self._mem.extend([Element(0, 0) for _ in range(adr - len(self._mem))])
+            overlap = vals[:len(self._mem)-adr]
+            for elem, val in zip(self._mem[adr:adr+len(overlap)], overlap):
+                elem.value = val
+            self._mem.extend([Element(val, 0) for val in vals[len(overlap):]])
 
     def err_exit(self, msg):
         print(f"Assemble Error: {msg}", file=sys.stderr)
@@ -100,6 +211,15 @@ class Parser:
     def get_labels(self):
         return self._defined_labels
 
+    def get_code_lines(self):
+        return self._code_lines
+
+    def get_adr(self):
+        """
+        次に生成する命令の番地
+        """
+        return len(self._mem)
+
     def add_unresolved_label(self, label, elem):
         if label not in self._unresolved_labels:
             self._unresolved_labels[label] = []
@@ -160,30 +280,44 @@ class Parser:
         lineを解析する
         解析の結果追加されるメモリのリストを返す
         """
-        line_ = re.sub(RE_COMMENT, "", line)[:-1]
+        if ";" in line:
+            line = RE_COMMENT.sub("", line)
+        line_ = line[:-1]
         if len(line_.strip()) == 0:
             return []
-        m = re.match(RE_LABEL_LINE, line_)
-        if m is not None:
-            self.define_label(m.group(1), len(self._mem))
-            line_ = m.group(2)
-        if re.match(RE_OP_LINE, line_) is None:
+        m = RE_LINE.match(line_)
+        if m is None:
+            m = RE_LABEL_LINE.match(line_)
+            if m is not None:
+                self.define_label(m.group(1), self.get_adr())
             self.err_exit(f"syntax error [bad format] (L{self._line_num})")
-        tokens = line_.strip().split()
+        label, line_ = m.groups()
+        if label is not None:
+            self.define_label(label, self.get_adr())
+        tokens = line_.split()
         op = tokens[0]
         if op == "DC":
             return self.parse_DC(line_)
-        args = []
-        for token in tokens[1:]:
-            args.extend(token.split(","))
+        # 各トークンを','で分割して連結する
+        args = ",".join(tokens[1:]).split(",") if len(tokens) > 1 else []
         macro = self.parse_macro(op, args)
         if macro is not None:
+            self.add_code_line()
             return macro
-        return self.parse_op(op, args)
+        mem_part = self.parse_op(op, args)
+        if op not in ("START", "END", "DS"):
+            self.add_code_line()
+        return mem_part
+
+    def add_code_line(self):
+        """
+        解析中の行を命令を含む行として記録する
+        """
+        self._code_lines.add(self._line_num)
 
     def parse_DC(self, line):
-        args = re.sub(RE_DC, "", line)
-        m = re.match(RE_DC_ARGS, args)
+        args = RE_DC.sub("", line)
+        m = RE_DC_ARGS.match(args)
         if m is None:
             self.err_exit(f"syntax error [DC bad format] (L{self._line_num})")
         arg, _, args = m.groups()
@@ -193,7 +327,7 @@ class Parser:
             if args[0] != ",":
                 self.err_exit(f"syntax error [DC ','] (L{self._line_num})")
             args = args[1:].strip()
-            m = re.match(RE_DC_ARGS, args)
+            m = RE_DC_ARGS.match(args)
             arg, _, args = m.groups()
             mem_part.extend(self.parse_DC_arg(arg))
         return mem_part
@@ -246,78 +380,41 @@ class Parser:
         return mem_part
 
     def parse_op(self, op, args):
-        if op == "NOP":
-            return self.encode_1word(0x00, 0, 0)
-        elif op == "LD":
-            return self.op_1or2word(0x14, 0x10, args)
-        elif op == "ST":
-            return self.op_2word(0x11, args)
-        elif op == "LAD":
-            return self.op_2word(0x12, args)
-        elif op == "ADDA":
-            return self.op_1or2word(0x24, 0x20, args)
-        elif op == "SUBA":
-            return self.op_1or2word(0x25, 0x21, args)
-        elif op == "ADDL":
-            return self.op_1or2word(0x26, 0x22, args)
-        elif op == "SUBL":
-            return self.op_1or2word(0x27, 0x23, args)
-        elif op == "AND":
-            return self.op_1or2word(0x34, 0x30, args)
-        elif op == "OR":
-            return self.op_1or2word(0x35, 0x31, args)
-        elif op == "XOR":
-            return self.op_1or2word(0x36, 0x32, args)
-        elif op == "CPA":
-            return self.op_1or2word(0x44, 0x40, args)
-        elif op == "CPL":
-            return self.op_1or2word(0x45, 0x41, args)
-        elif op == "SLA":
-            return self.op_2word(0x50, args)
-        elif op == "SRA":
-            return self.op_2word(0x51, args)
-        elif op == "SLL":
-            return self.op_2word(0x52, args)
-        elif op == "SRL":
-            return self.op_2word(0x53, args)
-        elif op == "JMI":
-            return self.op_2word(0x61, args, True)
-        elif op == "JNZ":
-            return self.op_2word(0x62, args, True)
-        elif op == "JZE":
-            return self.op_2word(0x63, args, True)
-        elif op == "JUMP":
-            return self.op_2word(0x64, args, True)
-        elif op == "JPL":
-            return self.op_2word(0x65, args, True)
-        elif op == "JOV":
-            return self.op_2word(0x66, args, True)
-        elif op == "PUSH":
-            return self.op_2word(0x70, args, True)
-        elif op == "POP":
-            return self.encode_1word(0x71, self.reg(args[0]), 0)
-        elif op == "CALL":
-            return self.op_2word(0x80, args, True)
-        elif op == "RET":
-            return self.encode_1word(0x81, 0, 0)
-        elif op == "SVC":
-            return self.encode_2word(0xf0, 0, args[0], 0)
-        elif op == "START":
-            if len(self._mem) != self._start_offset:
-                self.err_exit("syntax error ['START' must be first]")
-            if len(args) == 0:
-                self._start = len(self._mem)
-            else:
-                self._start_label = args[0]
-            return []
-        elif op == "END":
-            self._end = len(self._mem)
-            return []
-        elif op == "DS":
-            return [Element(0, self._line_num) for _ in range(int(args[0]))]
-        elif op == "DC": # not reached
-            self.err_exit(f"internal error DC (L{self._line_num})")
-        self.err_exit(f"unknown operation (L{self._line_num}: {op})")
+        encoder = self._encoders.get(op)
+        if encoder is None:
+            if op == "DC": # not reached
+                self.err_exit(f"internal error DC (L{self._line_num})")
+            self.err_exit(f"unknown operation (L{self._line_num}: {op})")
+        func, params = encoder
+        return func(*params, args)
+
+    def op_noarg(self, op, args):
+        return self.encode_1word(op, 0, 0)
+
+    def op_reg(self, op, args):
+        return self.encode_1word(op, self.reg(args[0]), 0)
+
+    def op_adr(self, op, args):
+        return self.op_2word(op, args, True)
+
+    def op_svc(self, op, args):
+        return self.encode_2word(op, 0, args[0], 0)
+
+    def op_START(self, args):
+        if self.get_adr() != self._start_offset:
+            self.err_exit("syntax error ['START' must be first]")
+        if len(args) == 0:
+            self._start = self.get_adr()
+        else:
+            self._start_label = args[0]
+        return []
+
+    def op_END(self, args):
+        self._end = self.get_adr()
+        return []
+
+    def op_DS(self, args):
+        return [Element(0, self._line_num) for _ in range(int(args[0]))]
 
     def op_1or2word(self, op1word, op2word, args):
         """
@@ -387,12 +484,785 @@ class Parser:
         return [elem1, elem2]
 # End Parser
 
+class StreamParser(Parser):
+    """
+    行のiterableを順に解析し、生成したwordを逐次出力するアセンブラ
+    解析済みの行は保持せず、未解決のラベルと定数は参照元の番地と行番号のみをarrayで保持する
+    命令を含む行も記録しない (get_code_lines()はNoneを返す)
+    """
+    def __init__(self, start_offset=0):
+        super().__init__(start_offset)
+        self._mem = []
+        self._adr = start_offset
+        # 未解決のラベルの参照元 {ラベル名: (番地のarray, 行番号のarray)}
+        self._fixups = {}
+        # 未割当の定数の参照元 {定数: 番地のarray}
+        self._const_fixups = {}
+        # 解析中の行で参照したラベル、定数 [(ラベル名または定数, 格納先の要素), ...]
+        self._line_refs = []
+        # 解析中の行で定義したラベルにより確定した書き込み [(番地, 値), ...]
+        self._line_patches = []
+
+    def get_adr(self):
+        return self._adr
+
+    def get_code_lines(self):
+        return None
+
+    def add_code_line(self):
+        pass
+
+    def add_unresolved_label(self, label, elem):
+        elem.vlabel = label
+        self._line_refs.append((label, elem))
+
+    def add_unallocated_const(self, const, elem):
+        elem.vlabel = f"={const}"
+        self._line_refs.append((const, elem))
+
+    def define_label(self, label, adr):
+        super().define_label(label, adr)
+        if label in self._fixups:
+            adrs, _ = self._fixups.pop(label)
+            self._line_patches.extend((ref_adr, adr & 0xffff) for ref_adr in adrs)
+
+    def parse_iter(self, lines):
+        """
+        linesを解析し、メモリへの書き込み(番地, wordのarray, 行番号)を順に返す
+        後のラベル定義や定数の割当で確定した値は行番号をNoneとして書き込む
+        """
+        for line in lines:
+            self._line_num += 1
+            mem_part = self.parse_line(line)
+            for adr, val in self._line_patches:
+                yield (adr, array.array("H", [val]), None)
+            self._line_patches.clear()
+            if len(mem_part) == 0:
+                continue
+            if self._end >= 0:
+                self.err_exit("syntax error ['END' must be last]")
+            adr = self._adr
+            if adr + len(mem_part) > Comet2.ADR_MAX + 1:
+                self.err_exit(f"program too large (L{self._line_num})")
+            if len(self._line_refs) != 0:
+                self.add_fixups(mem_part, adr)
+            yield (adr, array.array("H", [elem.value for elem in mem_part]), self._line_num)
+            self._adr += len(mem_part)
+        if self._end < 0:
+            self.err_exit("syntax error [not found 'END']")
+        self.resolve_labels()
+        yield from self.allocate_consts()
+        if self._start < 0:
+            self.err_exit("syntax error [not found 'START']")
+
+    def add_fixups(self, mem_part, adr):
+        positions = {id(elem): adr + i for i, elem in enumerate(mem_part)}
+        for ref, elem in self._line_refs:
+            ref_adr = positions[id(elem)]
+            if isinstance(ref, int):
+                self._const_fixups.setdefault(ref, array.array("H")).append(ref_adr)
+            elif self._defined_labels.get(ref) is not None:
+                elem.value = self._defined_labels[ref] & 0xffff
+            else:
+                adrs, lines = self._fixups.setdefault(ref, (array.array("H"), array.array("I")))
+                adrs.append(ref_adr)
+                lines.append(self._line_num)
+        self._line_refs.clear()
+
+    def resolve_labels(self):
+        if self._start_label is not None:
+            if self._start_label not in self._defined_labels:
+                self.err_exit(f"undefined start label ({self._start_label})")
+            self._start = self._defined_labels[self._start_label]
+        # 定義済みのラベルの参照元は定義時に書き込んでいるため、残っているものはエラー
+        for label, (_, lines) in self._fixups.items():
+            linemsgs = ", ".join([f"L{line}" for line in lines])
+            if label not in self._defined_labels:
+                self.err_exit(f"undefined label ({linemsgs}: {label})")
+            self.err_exit(f"reserved label ({linemsgs}: {label})")
+
+    def allocate_consts(self):
+        for const, adrs in self._const_fixups.items():
+            adr = self._adr
+            yield (adr, array.array("H", [const & 0xffff]), 0)
+            for ref_adr in adrs:
+                yield (ref_adr, array.array("H", [adr]), None)
+            self._adr += 1
+
+    def parse(self, fin):
+        """
+        parse_iter()の結果からメモリを作成する
+        (値がラベル由来であることはデバッグ出力に表示しない)
+        """
+        mem = [Element(0, 0) for _ in range(self._start_offset)]
+        for adr, vals, line in self.parse_iter(fin):
+            if line is None:
+                for i, val in enumerate(vals):
+                    mem[adr + i].value = val
+            else:
+                mem.extend([Element(val, line) for val in vals])
+        self._mem = mem
+        self.set_labelinfo()
+# End StreamParser
+
+class LineParser(Parser):
+    """
+    1行を番地に依存しない形で解析する (IncrementalParserで使用する)
+    """
+    def encode(self, line, line_num):
+        """
+        lineを解析し、(wordの値のtuple, 参照 ((位置, ラベル名または定数), ...), 定義するラベル,
+        STARTの場合その引数(無い場合"") それ以外None, ENDの場合True, 命令を含む行の場合True)を返す
+        """
+        self._line_num = line_num
+        self._label = None
+        self._refs = []
+        self._start_arg = None
+        self._is_end = False
+        self._code_lines.clear()
+        mem_part = self.parse_line(line)
+        positions = {id(elem): i for i, elem in enumerate(mem_part)}
+        refs = tuple((positions[id(elem)], ref) for ref, elem in self._refs)
+        return (tuple(elem.value for elem in mem_part), refs, self._label,
+                self._start_arg, self._is_end, len(self._code_lines) != 0)
+
+    def get_adr(self):
+        return self._start_offset
+
+    def define_label(self, label, adr):
+        self._label = label
+
+    def add_unresolved_label(self, label, elem):
+        self._refs.append((label, elem))
+
+    def add_unallocated_const(self, const, elem):
+        self._refs.append((const, elem))
+
+    def op_START(self, args):
+        self._start_arg = args[0] if len(args) != 0 else ""
+        return []
+
+    def op_END(self, args):
+        self._is_end = True
+        return []
+# End LineParser
+
+class IncrementalParser(Parser):
+    """
+    行ごとの解析結果を保持し、前回のparse()から変更された行のみ解析し直すアセンブラ
+    再利用するのは各行の字句解析と命令の符号化の結果のみで、
+    番地の割当、ラベルの解決、定数の配置はparse()のたびに全体をやり直す (全体の再配置)
+    """
+    def __init__(self, start_offset=0):
+        super().__init__(start_offset)
+        self._line_parser = LineParser(start_offset)
+        # 行ごとの解析結果 {行の文字列: LineParser.encode()の結果}
+        self._line_cache = {}
+        # 直前のparse()で解析し直した行数
+        self._encoded_lines = 0
+
+    def get_encoded_lines(self):
+        return self._encoded_lines
+
+    def parse(self, fin):
+        cache = self._line_cache
+        # 行の解析結果以外の状態を初期化する
+        super().__init__(self._start_offset)
+        encoded = 0
+        line_cache = {}
+        mem = self._mem
+        for line in fin:
+            self._line_num += 1
+            result = cache.get(line)
+            if result is None:
+                result = self._line_parser.encode(line, self._line_num)
+                encoded += 1
+            line_cache[line] = result
+            vals, refs, label, start_arg, is_end, is_code = result
+            if label is not None:
+                self.define_label(label, len(mem))
+            if start_arg is not None:
+                self.op_START([] if start_arg == "" else [start_arg])
+            if is_end:
+                self.op_END([])
+            elems = [Element(val, self._line_num) for val in vals]
+            for pos, ref in refs:
+                if isinstance(ref, int):
+                    self.add_unallocated_const(ref, elems[pos])
+                else:
+                    self.add_unresolved_label(ref, elems[pos])
+            mem.extend(elems)
+            if is_code:
+                self._code_lines.add(self._line_num)
+        self._line_cache = line_cache
+        self._encoded_lines = encoded
+        if self._end < 0:
+            self.err_exit("syntax error [not found 'END']")
+        if len(self._mem) > self._end:
+            self.err_exit("syntax error ['END' must be last]")
+        self.resolve_labels()
+        self.allocate_consts()
+        if self._start < 0:
+            self.err_exit("syntax error [not found 'START']")
+        self.set_labelinfo()
+# End IncrementalParser
+
+class ObjectParser(Parser):
+    """
+    1つのモジュールを再配置可能なオブジェクトにアセンブルする
+    STARTのラベルを公開し(値は実行開始番地)、モジュール内で定義されていないラベルは外部参照とする
+    """
+    OBJECT_FORMAT = "casl2sim-object-2"
+
+    def __init__(self):
+        super().__init__(0)
+        # STARTのラベル (モジュール名)
+        self._name = None
+        # 直前に定義したラベルとその行番号
+        self._last_label = (None, 0)
+
+    def define_label(self, label, adr):
+        super().define_label(label, adr)
+        self._last_label = (label, self._line_num)
+
+    def op_START(self, args):
+        mem_part = super().op_START(args)
+        label, line_num = self._last_label
+        if line_num == self._line_num:
+            self._name = label
+        return mem_part
+
+    def parse(self, fin):
+        for line in fin:
+            self._line_num += 1
+            self._mem.extend(self.parse_line(line))
+        if self._end < 0:
+            self.err_exit("syntax error [not found 'END']")
+        if len(self._mem) > self._end:
+            self.err_exit("syntax error ['END' must be last]")
+        if self._start_label is not None:
+            if self._defined_labels.get(self._start_label) is None:
+                self.err_exit(f"undefined start label ({self._start_label})")
+            self._start = self._defined_labels[self._start_label]
+        if self._start < 0:
+            self.err_exit("syntax error [not found 'START']")
+
+    def get_object(self):
+        """
+        オブジェクト(JSONに変換できる辞書)を返す 番地はモジュールの先頭からの位置
+        relocs: モジュール内のラベルを参照する位置  externs: 外部参照の位置  literals: 定数を参照する位置
+        """
+        index = {id(elem): i for i, elem in enumerate(self._mem)}
+        words = [elem.value for elem in self._mem]
+        relocs = []
+        externs = []
+        for label, elemlist in self._unresolved_labels.items():
+            offsets = [index[id(elem)] for elem in elemlist]
+            if label not in self._defined_labels:
+                externs.append([label, offsets])
+                continue
+            adr = self._defined_labels[label]
+            if adr is None:
+                self.err_exit(f"reserved label ({self.get_linemsgs(elemlist)}: {label})")
+            for offset in offsets:
+                words[offset] = adr & 0xffff
+            relocs.append([label, offsets])
+        literals = [[const, [index[id(elem)] for elem in elemlist]]
+                for const, elemlist in self._unallocated_consts.items()]
+        return {
+                "format": ObjectParser.OBJECT_FORMAT,
+                "name": self._name,
+                "entry": self._start,
+                "end": self._end,
+                "words": words,
+                "lines": [elem.line for elem in self._mem],
+                "code_lines": sorted(self._code_lines),
+                "labels": {label: adr for label, adr in self._defined_labels.items() if adr is not None},
+                "relocs": relocs,
+                "externs": externs,
+                "literals": literals}
+# End ObjectParser
+
+class Linker(Parser):
+    """
+    オブジェクトをstart_offsetから順に配置し、外部参照と定数を解決する
+    先頭のオブジェクトの実行開始番地から実行し、先頭のオブジェクトのENDで終了する
+    定数は全てのオブジェクトの後にまとめて配置する
+    先頭以外のオブジェクトのラベルは"モジュール名.ラベル"とし、行番号は0とする
+    """
+    def link(self, objects):
+        bases = []
+        adr = self._start_offset
+        exports = {}
+        for obj in objects:
+            if obj.get("format") != ObjectParser.OBJECT_FORMAT:
+                self.err_exit("bad object format")
+            bases.append(adr)
+            name = obj["name"]
+            if name is not None:
+                if name in exports:
+                    self.err_exit(f"defined module ({name})")
+                exports[name] = adr + obj["entry"]
+            adr += len(obj["words"])
+        for i, (obj, base) in enumerate(zip(objects, bases)):
+            is_main = i == 0
+            lines = obj["lines"] if is_main else [0] * len(obj["words"])
+            elems = [Element(val, line) for val, line in zip(obj["words"], lines)]
+            for label, offsets in obj["relocs"]:
+                for offset in offsets:
+                    elems[offset].value = (elems[offset].value + base) & 0xffff
+                    elems[offset].vlabel = label
+            for label, offsets in obj["externs"]:
+                if label not in exports:
+                    linemsgs = ", ".join([f"L{obj['lines'][offset]}" for offset in offsets])
+                    self.err_exit(f"undefined label ({obj['name'] or '-'} {linemsgs}: {label})")
+                for offset in offsets:
+                    elems[offset].value = exports[label] & 0xffff
+                    elems[offset].vlabel = label
+            for const, offsets in obj["literals"]:
+                for offset in offsets:
+                    self.add_unallocated_const(const, elems[offset])
+            for label, label_adr in obj["labels"].items():
+                if not is_main and label == obj["name"]:
+                    continue
+                name = label if is_main else f"{obj['name']}.{label}"
+                self._defined_labels.setdefault(name, base + label_adr)
+            if is_main:
+                self._start = base + obj["entry"]
+                self._end = base + obj["end"]
+                self._code_lines = set(obj["code_lines"])
+            self._mem.extend(elems)
+        main = objects[0]
+        for name in exports:
+            # 先頭のモジュール名のラベルは実行開始番地とする
+            if name != main["name"] and name in self._defined_labels:
+                line = main["lines"][main["labels"][name]] if name in main["labels"] else 0
+                self.err_exit(f"defined label (L{line}: {name})")
+        self._defined_labels.update(exports)
+        # 同じ値の定数はモジュールをまたいで1つにまとめる
+        self.allocate_consts()
+        self.set_labelinfo()
+# End Linker
+
+class ControlFlowIndex:
+    """
+    アセンブル後のメモリを逆アセンブルし、命令の開始番地、基本ブロック、CALLの飛び先、データ領域を求める
+    START、命令の行に付いたラベル、分岐とCALLの飛び先からたどれる範囲を命令とする
+    番地ごとの情報は配列に保持する
+    """
+    # 分岐命令とCALLのオペコード
+    OPS_BRANCH = frozenset((0x61, 0x62, 0x63, 0x64, 0x65, 0x66, 0x80))
+    # オペランドの番地のメモリを読み書きする命令のオペコード
+    OPS_MEM_ACCESS = frozenset((0x10, 0x11, 0x20, 0x21, 0x22, 0x23, 0x30, 0x31, 0x32,
+        0x40, 0x41))
+    # 1word命令のオペコード
+    OPS_1WORD = frozenset((0x00, 0x14, 0x24, 0x25, 0x26, 0x27, 0x34, 0x35, 0x36, 0x44, 0x45,
+        0x71, 0x81))
+    OP_JUMP = 0x64
+    OP_CALL = 0x80
+    OP_RET = 0x81
+
+    def __init__(self, mem, start, labels=None, code_lines=None):
+        self._mem = mem
+        self._start = start
+        size = len(mem)
+        # 番地ごとの命令のword数 (命令の開始番地以外は0)
+        self._inst_size = array.array("B", bytes(size))
+        # 番地ごとの基本ブロックの番号 (命令以外は-1)
+        self._block_of = array.array("i", [-1]) * size
+        # 基本ブロックの開始番地、終了番地(次の番地)
+        self._block_starts = array.array("I")
+        self._block_ends = array.array("I")
+        # 基本ブロックごとの後続ブロックの開始番地
+        self._block_succs = []
+        # 基本ブロックごとの最後の命令の番地
+        self._last_insts = []
+        self._call_targets = set()
+        # 分岐, CALLの飛び先と戻り先
+        self._entries = set()
+        # インデックスレジスタを使用した分岐, CALLの番地
+        self._indexed_branches = []
+        # インデックスレジスタを使用しない分岐, CALL, メモリアクセスのオペランドの番地
+        self._static_refs = set()
+        # インデックスレジスタを使用しないメモリアクセスの対象の番地
+        self._accessed = set()
+        # インデックスレジスタを使用したメモリアクセスの基点の番地
+        self._indexed_bases = []
+        seeds = [start]
+        if labels is not None and code_lines is not None:
+            for adr in labels.values():
+                if adr is not None and adr < size and mem[adr].line in code_lines:
+                    seeds.append(adr)
+        self.decode(seeds)
+        self.build_blocks()
+
+    def decode(self, seeds):
+        mem = self._mem
+        size_max = len(mem)
+        work = list(seeds)
+        self._entries.update(seeds)
+        while len(work) > 0:
+            adr = work.pop()
+            if adr >= size_max or self._inst_size[adr] != 0:
+                continue
+            word = mem[adr].value
+            op = word >> 8
+            x = word & 0xf
+            if op in Comet2.OPS_2WORD:
+                size = 2
+            elif op in self.OPS_1WORD:
+                size = 1
+            else:
+                # 不正な命令 (実行時エラー)
+                continue
+            self._inst_size[adr] = size
+            operand = mem[adr+1].value if size == 2 and adr + 1 < size_max else 0
+            if op in self.OPS_BRANCH:
+                if op == self.OP_CALL:
+                    self._entries.add(adr + 2)
+                if x != 0:
+                    self._indexed_branches.append(adr)
+                else:
+                    self._static_refs.add(adr + 1)
+                    self._entries.add(operand)
+                    work.append(operand)
+                    if op == self.OP_CALL:
+                        self._call_targets.add(operand)
+                if op == self.OP_JUMP:
+                    continue
+            elif op == self.OP_RET:
+                continue
+            elif op in self.OPS_MEM_ACCESS:
+                if x == 0:
+                    self._static_refs.add(adr + 1)
+                    self._accessed.add(operand)
+                else:
+                    self._indexed_bases.append(operand)
+            work.append(adr + size)
+
+    def build_blocks(self):
+        mem = self._mem
+        last_insts = []
+        prev_end = None
+        ends_block = True
+        for adr, size in enumerate(self._inst_size):
+            if size == 0:
+                continue
+            if ends_block or adr != prev_end or adr in self._entries:
+                self._block_starts.append(adr)
+                self._block_ends.append(adr)
+                last_insts.append(adr)
+            block = len(self._block_starts) - 1
+            self._block_of[adr:adr+size] = array.array("i", [block]) * size
+            prev_end = adr + size
+            self._block_ends[block] = prev_end
+            last_insts[block] = adr
+            op = mem[adr].value >> 8
+            ends_block = op in self.OPS_BRANCH or op == self.OP_RET
+        for adr in last_insts:
+            word = mem[adr].value
+            op = word >> 8
+            nxt = adr + self._inst_size[adr]
+            succs = []
+            if op in self.OPS_BRANCH and op != self.OP_CALL and word & 0xf == 0:
+                succs.append(mem[adr+1].value)
+            if op not in (self.OP_JUMP, self.OP_RET):
+                succs.append(nxt)
+            self._block_succs.append([succ for succ in succs if self.is_inst(succ)])
+        self._last_insts = last_insts
+
+    def is_inst(self, adr):
+        """
+        adrが命令の開始番地の場合Trueを返す
+        """
+        return 0 <= adr < len(self._inst_size) and self._inst_size[adr] != 0
+
+    def get_inst_size(self, adr):
+        """
+        adrの命令のword数を返す (命令の開始番地でない場合0)
+        """
+        return self._inst_size[adr] if 0 <= adr < len(self._inst_size) else 0
+
+    def get_insts(self):
+        return [adr for adr, size in enumerate(self._inst_size) if size != 0]
+
+    def is_code(self, adr):
+        """
+        adrが命令(オペランドを含む)の場合Trueを返す
+        """
+        return 0 <= adr < len(self._block_of) and self._block_of[adr] >= 0
+
+    def get_block(self, adr):
+        """
+        adrを含む基本ブロックの(開始番地, 終了番地)を返す (命令でない場合None)
+        """
+        if not self.is_code(adr):
+            return None
+        block = self._block_of[adr]
+        return (self._block_starts[block], self._block_ends[block])
+
+    def is_block_start(self, adr):
+        return self.is_code(adr) and self._block_starts[self._block_of[adr]] == adr
+
+    def is_entry(self, adr):
+        """
+        adrが分岐, CALLの飛び先、戻り先の場合Trueを返す
+        """
+        return adr in self._entries
+
+    def get_call_targets(self):
+        return self._call_targets
+
+    def get_indexed_branches(self):
+        return self._indexed_branches
+
+    def get_indexed_bases(self):
+        return self._indexed_bases
+
+    def get_accessed(self):
+        return self._accessed
+
+    def is_static_ref(self, adr):
+        """
+        adrがインデックスレジスタを使用しない分岐, CALL, メモリアクセスのオペランドの場合Trueを返す
+        """
+        return adr in self._static_refs
+
+    def get_data_regions(self):
+        """
+        命令でない領域の(開始番地, 終了番地)のリストを返す
+        """
+        regions = []
+        region_start = None
+        for adr, block in enumerate(self._block_of):
+            if block < 0 and region_start is None:
+                region_start = adr
+            elif block >= 0 and region_start is not None:
+                regions.append((region_start, adr))
+                region_start = None
+        if region_start is not None:
+            regions.append((region_start, len(self._block_of)))
+        return regions
+
+    def get_block_label(self, adr):
+        label = self._mem[adr].label
+        return label if label is not None else f"{adr:04x}"
+
+    def to_json(self):
+        blocks = []
+        for start, end, succs in zip(self._block_starts, self._block_ends, self._block_succs):
+            blocks.append({"start": start, "end": end, "label": self._mem[start].label,
+                "succs": succs})
+        return {"start": self._start,
+                "insts": self.get_insts(),
+                "blocks": blocks,
+                "call_targets": sorted(self._call_targets),
+                "data": self.get_data_regions()}
+
+    def to_dot(self):
+        lines = ["digraph cfg {", "    node [shape=box];"]
+        blocks = zip(self._block_starts, self._block_ends, self._block_succs, self._last_insts)
+        for start, end, succs, last in blocks:
+            label = self.get_block_label(start)
+            lines.append(f'    b{start:04x} [label="{label}\\n{start:04x}-{end-1:04x}"];')
+            for succ in succs:
+                lines.append(f"    b{start:04x} -> b{succ:04x};")
+            if self._mem[last].value == self.OP_CALL << 8 and self.is_inst(self._mem[last+1].value):
+                lines.append(f"    b{start:04x} -> b{self._mem[last+1].value:04x} [style=dashed];")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, f, fmt="json"):
+        if fmt == "dot":
+            f.write(self.to_dot())
+        else:
+            json.dump(self.to_json(), f, indent=1)
+            f.write("\n")
+# End ControlFlowIndex
+
+class Optimizer:
+    """
+    アセンブル後のメモリに対する覗き穴最適化 (-O)
+    STARTから到達できる命令を解析し、各命令の番地を変えずに書き換える
+    以下の場合は計算した番地で命令に到達する可能性があるため何もしない
+    - インデックスレジスタを使用したJUMP, 条件分岐, CALLがある
+    - 分岐先以外で命令の番地をラベルで参照している (LAD, PUSH, DC等)
+    - インデックスレジスタを使用したメモリアクセスの基点が命令
+    命令の番地をラベルで参照してメモリを読み書きする場合、その命令は書き換えない
+    数値で直接指定した番地による参照は考慮しない
+    """
+    # フラグを設定する命令のオペコード (全てのフラグを上書きする)
+    OPS_SET_FLAGS = frozenset((0x10, 0x14, 0x20, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27,
+        0x30, 0x31, 0x32, 0x34, 0x35, 0x36, 0x40, 0x41, 0x44, 0x45, 0x50, 0x51, 0x52, 0x53))
+    # フラグを変更も参照もしない命令のオペコード (NOP, ST, LAD, PUSH, POP)
+    OPS_KEEP_FLAGS = frozenset((0x00, 0x11, 0x12, 0x70, 0x71))
+    # 連続したIN, OUTマクロの間の "POP GR2; POP GR1; PUSH 0,GR1; PUSH 0,GR2"
+    MACRO_POP_PUSH = (0x7120, 0x7110, 0x7001, 0x0000, 0x7002, 0x0000)
+    OP_JUMP = 0x6400
+    OP_LAD_GR1 = 0x1210
+    OP_LAD_GR2 = 0x1220
+    # フラグが使われないことを確認する際にたどる命令数の上限
+    FLAG_SCAN_MAX = 16
+
+    def __init__(self, mem, start):
+        self._mem = mem
+        self._index = ControlFlowIndex(mem, start)
+        self._stats = {"io_macro": 0, "load_after_store": 0, "jump_thread": 0}
+
+    def is_optimizable(self):
+        """
+        計算した番地で命令に到達する可能性がない場合Trueを返す
+        """
+        index = self._index
+        if len(index.get_indexed_branches()) != 0:
+            return False
+        if any(index.is_code(base) for base in index.get_indexed_bases()):
+            return False
+        for adr, elem in enumerate(self._mem):
+            if elem.vlabel is None or elem.vlabel.startswith("="):
+                continue
+            if not index.is_static_ref(adr) and index.is_code(elem.value):
+                return False
+        return True
+
+    def optimize(self):
+        """
+        最適化を行い、書き換えた箇所の数を返す
+        最適化できない場合Noneを返す
+        """
+        if not self.is_optimizable():
+            return None
+        insts = self._index.get_insts()
+        for adr in insts:
+            self.remove_macro_pop_push(adr)
+            self.remove_load_after_store(adr)
+        for adr in insts:
+            self.thread_jump(adr)
+        return self._stats
+
+    def is_fixed(self, adr, size):
+        """
+        adrからsize wordを書き換えてはいけない場合Trueを返す
+        """
+        accessed = self._index.get_accessed()
+        return any(a in accessed for a in range(adr, adr + size))
+
+    def set_jump(self, adr, dst):
+        self._mem[adr].value = self.OP_JUMP
+        self._mem[adr].vlabel = None
+        self._mem[adr+1].value = dst & 0xffff
+        self._mem[adr+1].vlabel = self._mem[dst].label if dst < len(self._mem) else None
+
+    def remove_macro_pop_push(self, adr):
+        """
+        連続したIN, OUTマクロの間のPOP, PUSHを後続のLADへのJUMPにする
+        (後続のLADでGR1, GR2は上書きされ、スタックの内容は変わらないため)
+        """
+        mem = self._mem
+        n = len(self.MACRO_POP_PUSH)
+        if adr + n + 4 > len(mem) or self.is_fixed(adr, n + 4):
+            return
+        if any(mem[adr+i].value != v for i, v in enumerate(self.MACRO_POP_PUSH)):
+            return
+        if mem[adr+n].value != self.OP_LAD_GR1 or mem[adr+n+2].value != self.OP_LAD_GR2:
+            return
+        if any(self._index.is_entry(a) for a in (adr + 1, adr + 2, adr + 4)):
+            return
+        self.set_jump(adr, adr + n)
+        self._stats["io_macro"] += 1
+
+    def remove_load_after_store(self, adr):
+        """
+        "ST GRa,X,x" の直後の "LD GRa,X,x" を次の命令へのJUMPにする
+        LDが設定するフラグがその後使われない場合のみ
+        """
+        mem = self._mem
+        ld = adr + 2
+        index = self._index
+        if index.get_inst_size(adr) != 2 or index.get_inst_size(ld) != 2 or index.is_entry(ld):
+            return
+        st_word = mem[adr].value
+        if st_word >> 8 != 0x11 or mem[ld].value != (0x1000 | (st_word & 0xff)):
+            return
+        if mem[adr+1].value != mem[ld+1].value or self.is_fixed(adr, 4):
+            return
+        if not self.is_flags_dead(ld + 2):
+            return
+        self.set_jump(ld, ld + 2)
+        self._stats["load_after_store"] += 1
+
+    def is_flags_dead(self, adr):
+        """
+        adrから実行したとき、フラグを参照する前に必ず上書きする場合Trueを返す
+        """
+        mem = self._mem
+        for _ in range(self.FLAG_SCAN_MAX):
+            if not self._index.is_inst(adr):
+                return False
+            op = mem[adr].value >> 8
+            if op in self.OPS_SET_FLAGS:
+                return True
+            if op == 0x64:
+                adr = mem[adr+1].value
+            elif op in self.OPS_KEEP_FLAGS:
+                adr += self._index.get_inst_size(adr)
+            else:
+                return False
+        return False
+
+    def thread_jump(self, adr):
+        """
+        JUMPへの分岐, CALLの飛び先を最終的な飛び先にする
+        """
+        mem = self._mem
+        if self._index.get_inst_size(adr) != 2 or mem[adr].value >> 8 not in ControlFlowIndex.OPS_BRANCH:
+            return
+        if self.is_fixed(adr, 2):
+            return
+        dst = mem[adr+1].value
+        visited = {adr}
+        while (self._index.get_inst_size(dst) == 2 and mem[dst].value == self.OP_JUMP and
+                not self.is_fixed(dst, 2) and dst not in visited):
+            visited.add(dst)
+            dst = mem[dst+1].value
+        if dst == mem[adr+1].value or dst in visited:
+            return
+        mem[adr+1].value = dst
+        mem[adr+1].vlabel = mem[dst].label if dst < len(mem) else None
+        self._stats["jump_thread"] += 1
+# End Optimizer
+
 class Comet2:
     ADR_MAX = 0xffff
     REG_NUM = 8
     REG_BITS = 16
     SVC_OP_IN = 1
     SVC_OP_OUT = 2
+    # 拡張SVC (--svc-ext)
+    SVC_OP_COPY = 0x10
+    SVC_OP_FILL = 0x11
+    SVC_OP_CMP = 0x12
+    SVC_OP_OUTW = 0x13
+    # 2word命令のオペコード
+    OPS_2WORD = frozenset((0x10, 0x11, 0x12, 0x20, 0x21, 0x22, 0x23, 0x30, 0x31, 0x32,
+        0x40, 0x41, 0x50, 0x51, 0x52, 0x53, 0x61, 0x62, 0x63, 0x64, 0x65, 0x66,
+        0x70, 0x80, 0xf0))
+    # 条件分岐命令のオペコード (JMI, JNZ, JZE, JPL, JOV)
+    OPS_COND_JUMP = frozenset((0x61, 0x62, 0x63, 0x65, 0x66))
+    # 条件分岐命令の分岐条件
+    JUMP_CONDS = {
+            0x61: lambda c: c._sf != 0,
+            0x62: lambda c: c._zf == 0,
+            0x63: lambda c: c._zf != 0,
+            0x65: lambda c: c._sf == 0 and c._zf == 0,
+            0x66: lambda c: c._of != 0}
+    # まとめて実行する命令列の最大word数 (IN, OUTマクロ)
+    FUSION_MAX_WORDS = 12
+    CHECKPOINT_FORMAT = "casl2sim-checkpoint-2"
+    # チェックポイントに保存する属性 (GR, 命令ごとのカウンタ以外)
+    CHECKPOINT_ATTRS = ("_pr", "_sp", "_zf", "_sf", "_of", "_end", "_steps", "_cnt_mem_reads",
+            "_cnt_mem_writes", "_cnt_pushes", "_cnt_pops", "_cnt_taken", "_cnt_not_taken",
+            "_call_depth", "_cnt_call_depth_max", "_cnt_in_bytes", "_cnt_out_bytes")
 
     def __init__(self, mem, print_regs=False, simple_output=False):
         self._print_regs = print_regs
@@ -403,10 +1273,58 @@ class Comet2:
         self._zf = 0
         self._sf = 0
         self._of = 0
+        # 終了アドレス (setup()で設定する)
+        self._end = 0
         self._fin = None
         self._fout = None
         self._fdbg = None
         self._input_all = None
+        # 実行したステップ数
+        self._steps = 0
+        # 実行するステップ数の上限 無効の場合None
+        self._max_steps = None
+        # 性能カウンタ
+        self._cnt_ops = [0] * 256
+        self._cnt_mem_reads = 0
+        self._cnt_mem_writes = 0
+        self._cnt_pushes = 0
+        self._cnt_pops = 0
+        self._cnt_taken = 0
+        self._cnt_not_taken = 0
+        self._call_depth = 0
+        self._cnt_call_depth_max = 0
+        self._cnt_in_bytes = 0
+        self._cnt_out_bytes = 0
+        # 番地の表示に使うラベル 最初に使うときにメモリのラベルから作る
+        self._symbols = None
+        # SVC INの入力の記録先、再生元 無効の場合None
+        self._input_log = None
+        self._input_replay = None
+        # チェックポイント (保存間隔のステップ数, 保存先) 無効の場合None
+        self._checkpoint = None
+        # チェックポイントに記録する実行開始前のメモリの値のハッシュ
+        self._program_hash = None
+        # postmortem用のリングバッファ 無効の場合None
+        self._pm_buf = None
+        self._pm_size = 0
+        # カバレッジ 無効の場合None
+        self._coverage = None
+        # サイクル数の見積もり 無効の場合None
+        self._cost = None
+        # まとめて実行する命令列 {開始番地: (処理, word数)} 無効の場合None
+        self._fusion = None
+        self._fusion_enabled = False
+        # 番地ごとのその番地を含む命令列の数
+        self._fusion_cover = None
+        # 書き込んだ番地の集合 無効の場合None
+        self._written = None
+        # CALL先をPythonで実行する処理 {番地: (名前, 処理)}
+        self._hooks = {}
+        self._hook_verify = False
+        # 検証中の呼び出し [(CALL前のSP, 戻り先, 名前, 期待する状態, スタックの使用量), ...]
+        self._hook_pending = []
+        # 検証中に書き込んだ番地と書き込み前の(値, 行番号, ラベル) [{番地: (値, 行番号, ラベル)}, ...]
+        self._journals = []
         self.init_mem(mem)
         self.OP_TABLE = {
                 0x00:self.op_NOP,
@@ -428,6 +1346,8 @@ class Comet2:
                 0x70:self.op_PUSH, 0x71:self.op_POP,
                 0x80:self.op_CALL, 0x81:self.op_RET,
                 0xf0:self.op_SVC}
+        self.SVC_TABLE = {
+                Comet2.SVC_OP_IN:self.op_SVC_IN, Comet2.SVC_OP_OUT:self.op_SVC_OUT}
 
     def init_mem(self, mem):
         self._mem = mem
@@ -453,47 +1373,529 @@ class Comet2:
     def get_allmem(self):
         return self._mem
 
-    def run(self, start, end, fout=None, fdbg=None, fin=None, virtual_call=False, input_all=False):
-        self._fout = fout
-        self._fdbg = fdbg
-        self._fin = fin
-        self._pr = start & 0xffff
-        end = end & 0xffff
-        self._input_all = input_all
-        self.output_regs()
-        if virtual_call:
-            self._sp = (self._sp - 1) & 0xffff
-            self._mem[self._sp].value = end
-            if self._fdbg is not None:
-                self._fdbg.write("VCALL: [----] " +
-                        f"MEM[{self._sp:04x}] <- {end:04x} (SP <- {self._sp:04x})\n")
-        while self._pr != end:
-            self.run_once()
-        self.output_regs()
+    def get_steps(self):
+        return self._steps
 
-    def run_once(self):
-        self._inst_adr = self._pr
-        elem = self.fetch()
-        op = (elem.value & 0xff00) >> 8
-        if op not in self.OP_TABLE:
-            lstr = "" if elem.line == 0 else f"L{elem.line} "
-            self.err_exit(f"unknown operation ({lstr}[{self._pr - 1:04x}]: {elem.value:04x})")
-        self.OP_TABLE[op](elem)
+    def get_pr(self):
+        return self._pr
 
-    def err_exit(self, msg):
-        print(f"Runtime Error: {msg}", file=sys.stderr)
-        self.output_regs()
-        sys.exit(1)
+    def get_end(self):
+        return self._end
+
+    def get_counters(self):
+        ops = {}
+        for op, handler in self.OP_TABLE.items():
+            if self._cnt_ops[op] != 0:
+                ops[handler.__name__[3:]] = self._cnt_ops[op]
+        return {
+                "instructions": self._steps,
+                "ops": ops,
+                "mem_reads": self._cnt_mem_reads,
+                "mem_writes": self._cnt_mem_writes,
+                "stack_pushes": self._cnt_pushes,
+                "stack_pops": self._cnt_pops,
+                "branches_taken": self._cnt_taken,
+                "branches_not_taken": self._cnt_not_taken,
+                "call_depth_max": self._cnt_call_depth_max,
+                "svc_in_bytes": self._cnt_in_bytes,
+                "svc_out_bytes": self._cnt_out_bytes}
+
+    def set_symbols(self, symbols):
+        self._symbols = symbols
+
+    def get_symbols(self):
+        if self._symbols is None:
+            self._symbols = SymbolIndex.from_mem(self._mem)
+        return self._symbols
+
+    def get_symbol_msg(self, adr):
+        """
+        デバッグ出力での番地の前置き ("'LOOP+3'=") を返す
+        """
+        sym = self.get_symbols().format(adr)
+        return "" if sym is None else f"'{sym}'="
+
+    def enable_checkpoint(self, every, path):
+        """
+        everyステップごとに実行中の状態をpathに保存する
+        """
+        if every <= 0:
+            self.err_exit("checkpoint interval must be positive")
+        self._checkpoint = (every, path)
+        if self._program_hash is None:
+            self._program_hash = self.hash_mem()
+
+    def hash_mem(self):
+        """
+        メモリの値のハッシュを返す
+        """
+        return hashlib.sha256(array.array("H", [elem.value for elem in self._mem]).tobytes()).hexdigest()
+
+    @staticmethod
+    def stream_tell(f):
+        """
+        ストリームの現在位置を返す シークできない場合None
+        """
+        if f is None:
+            return None
+        try:
+            return f.tell() if f.seekable() else None
+        except (OSError, ValueError):
+            return None
+
+    def save_checkpoint(self, path):
+        """
+        レジスタ、カウンタ、入出力の位置、メモリの値をpathに保存する
+        形式: ヘッダの長さ(4byte) ヘッダ(JSON) メモリの値(2byte(little endian) * 65536)
+        一時ファイルに書き込んでから置き換えるため、保存中に終了しても以前の内容が残る
+        """
+        state = {name: getattr(self, name) for name in self.CHECKPOINT_ATTRS}
+        state["format"] = self.CHECKPOINT_FORMAT
+        state["program"] = self._program_hash
+        state["gr"] = self._gr
+        state["cnt_ops"] = self._cnt_ops
+        replay = None if self._input_replay is None else self._input_replay.get_file()
+        state["io"] = {"in": self.stream_tell(self._fin), "out": self.stream_tell(self._fout),
+                "replay": self.stream_tell(replay)}
+        header = json.dumps(state).encode()
+        vals = array.array("H", [elem.value for elem in self._mem])
+        if sys.byteorder == "big":
+            vals.byteswap()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(len(header).to_bytes(4, "little"))
+            f.write(header)
+            f.write(vals.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load_checkpoint(self, path):
+        """
+        save_checkpoint()で保存した状態に戻し、入出力の位置 {"in": n, "out": n, "replay": n} を返す
+        形式が異なる場合、保存時と実行開始前のメモリの値が異なる場合ValueErrorを送出する
+        """
+        with open(path, "rb") as f:
+            size = int.from_bytes(f.read(4), "little")
+            try:
+                state = json.loads(f.read(size))
+            except ValueError:
+                state = None
+            if not isinstance(state, dict) or state.get("format") != self.CHECKPOINT_FORMAT:
+                raise ValueError("bad checkpoint format")
+            vals = array.array("H")
+            vals.frombytes(f.read())
+        if sys.byteorder == "big":
+            vals.byteswap()
+        if len(vals) != Comet2.ADR_MAX + 1:
+            raise ValueError("bad checkpoint memory size")
+        program_hash = self.hash_mem()
+        if state.get("program") != program_hash:
+            raise ValueError("checkpoint was saved from a different program")
+        self._program_hash = program_hash
+        for name in self.CHECKPOINT_ATTRS:
+            setattr(self, name, state[name])
+        self._gr[:] = state["gr"]
+        self._cnt_ops[:] = state["cnt_ops"]
+        for elem, val in zip(self._mem, vals):
+            if elem.value != val:
+                # 実行時に書き換えられた値として扱う
+                elem.value = val
+                elem.line = 0
+                elem.vlabel = None
+        return state["io"]
+
+    def enable_postmortem(self, size):
+        """
+        直前のsizeステップの実行履歴を保持する
+        履歴は異常終了時のみ整形して出力する
+        """
+        if size <= 0:
+            self.err_exit("postmortem size must be positive")
+        self._pm_buf = [None] * size
+        self._pm_size = size
+
+    def track_writes(self):
+        """
+        実行中に書き込んだ番地を記録する集合を返す
+        """
+        self._written = set()
+        return self._written
+
+    def set_max_steps(self, max_steps):
+        self._max_steps = max_steps
+
+    def enable_coverage(self, coverage=None):
+        """
+        coverageを指定した場合、そのCoverageに記録する
+        """
+        self._coverage = Coverage(self._mem) if coverage is None else coverage
+        return self._coverage
+
+    def get_coverage(self):
+        return self._coverage
+
+    def enable_input_record(self, recorder):
+        """
+        SVC INで読み込んだ文字をInputRecorderに記録する
+        """
+        self._input_log = recorder
+
+    def enable_input_replay(self, replay):
+        """
+        SVC INの入力をfinの代わりにInputReplayから読み込む
+        """
+        self._input_replay = replay
+
+    def enable_fusion(self):
+        """
+        よく現れる命令列を実行時に1つの処理としてまとめて実行する
+        トレース出力等のステップ単位の記録が有効な場合は使用しない
+        """
+        self._fusion_enabled = True
+
+    def register_svc(self, code, handler):
+        """
+        SVC codeの処理handler(elem)を登録する
+        """
+        self.SVC_TABLE[code & 0xffff] = handler
+
+    def enable_svc_ext(self):
+        self.register_svc(Comet2.SVC_OP_COPY, self.op_SVC_COPY)
+        self.register_svc(Comet2.SVC_OP_FILL, self.op_SVC_FILL)
+        self.register_svc(Comet2.SVC_OP_CMP, self.op_SVC_CMP)
+        self.register_svc(Comet2.SVC_OP_OUTW, self.op_SVC_OUTW)
+
+    def register_hook(self, adr, func, name=None):
+        """
+        adrへのCALLをfunc(comet2)の呼び出しに置き換える
+        funcはサブルーチンの仕様通りにレジスタ、メモリ、フラグを変更する
+        メモリはset_mem()、set_mem_block()で変更する (enable_hook_verify()で書き込んだ番地を記録するため)
+        呼び出し後はRETが実行された時と同じ状態になる
+        """
+        self._hooks[adr & Comet2.ADR_MAX] = (f"{adr:04x}" if name is None else name, func)
+
+    def enable_hook_verify(self):
+        """
+        フックと本来のサブルーチンを両方実行し、RET時の状態を比較する
+        """
+        self._hook_verify = True
+
+    def enable_cost(self, model, start=0):
+        self._cost = CostProfile(model.build_table(self.OP_TABLE), self._mem, start, self.get_symbols())
+        return self._cost
+
+    def get_cost(self):
+        return self._cost
+
+    def setup(self, start, end, fout=None, fdbg=None, fin=None, virtual_call=False, input_all=False):
+        """
+        実行前の準備をする run()またはrun_steps()の前に呼び出す
+        """
+        self._fout = fout
+        self._fdbg = fdbg
+        self._fin = fin
+        self._pr = start & 0xffff
+        self._end = end & 0xffff
+        self._input_all = input_all
+        self.output_regs()
+        if virtual_call:
+            self._sp = (self._sp - 1) & 0xffff
+            self._mem[self._sp].value = self._end
+            if self._fdbg is not None:
+                self._fdbg.write("VCALL: [----] " +
+                        f"MEM[{self._sp:04x}] <- {self._end:04x} (SP <- {self._sp:04x})\n")
+        return self.build_fusion(self._end)
+
+    def finish(self):
+        self.output_regs()
+        self.output_counters()
+        return self.get_counters()
+
+    def run(self, start, end, fout=None, fdbg=None, fin=None, virtual_call=False, input_all=False):
+        fusion = self.setup(start, end, fout, fdbg, fin, virtual_call, input_all)
+        end = self._end
+        try:
+            if fusion is None and self._max_steps is None and self._checkpoint is None:
+                while self._pr != end:
+                    self.run_once()
+            else:
+                fusion = {} if fusion is None else fusion
+                max_steps = self._max_steps
+                every, checkpoint_path = self._checkpoint or (None, None)
+                next_checkpoint = None if every is None else self._steps + every
+                while self._pr != end:
+                    if max_steps is not None and self._steps >= max_steps:
+                        self.err_exit(f"max steps exceeded ({max_steps})")
+                    if next_checkpoint is not None and self._steps >= next_checkpoint:
+                        self.save_checkpoint(checkpoint_path)
+                        next_checkpoint = self._steps + every
+                    fused = fusion.get(self._pr)
+                    if fused is None:
+                        self.run_once()
+                    else:
+                        fused[0]()
+        except (Exception, KeyboardInterrupt):
+            self.output_postmortem()
+            raise
+        return self.finish()
+
+    def run_steps(self, n, input_ready=None):
+        """
+        setup()の後、最大nステップ実行する
+        input_ready: SVC INの実行前に呼び出し、Falseの場合はSVC INの直前で停止する
+        戻り値: "end" (終了アドレスに到達) "input" (SVC INの直前で停止) None (nステップ実行した)
+        """
+        end = self._end
+        # 命令列の融合はSVC INを含む場合があるため、input_readyを指定した場合は使用しない
+        fusion = self._fusion if self._fusion is not None and input_ready is None else {}
+        max_steps = self._max_steps
+        mem = self._mem
+        steps_end = self._steps + n
+        try:
+            while self._pr != end:
+                if self._steps >= steps_end:
+                    return None
+                if max_steps is not None and self._steps >= max_steps:
+                    self.err_exit(f"max steps exceeded ({max_steps})")
+                if input_ready is not None and mem[self._pr].value >> 8 == 0xf0 and \
+                        mem[(self._pr + 1) & 0xffff].value == Comet2.SVC_OP_IN and not input_ready():
+                    return "input"
+                fused = fusion.get(self._pr)
+                if fused is None:
+                    self.run_once()
+                else:
+                    fused[0]()
+        except (Exception, KeyboardInterrupt):
+            self.output_postmortem()
+            raise
+        return "end"
+
+    def run_once(self):
+        self._inst_adr = self._pr
+        elem = self.fetch()
+        op = (elem.value & 0xff00) >> 8
+        if self._pm_buf is not None:
+            # 文字列への変換はせず実行前の状態をそのまま保持する
+            self._pm_buf[self._steps % self._pm_size] = (self._steps, self._inst_adr,
+                    elem.value, self._mem[self._pr].value, tuple(self._gr),
+                    self._sp, self._zf, self._sf, self._of)
+        self._steps += 1
+        self._cnt_ops[op] += 1
+        if op not in self.OP_TABLE:
+            lstr = "" if elem.line == 0 else f"L{elem.line} "
+            labelmsg = self.get_symbol_msg(self._pr - 1)
+            self.err_exit(f"unknown operation ({lstr}[{labelmsg}{self._pr - 1:04x}]: {elem.value:04x})")
+        self.OP_TABLE[op](elem)
+        if self._coverage is not None:
+            self._coverage.record(op, self._inst_adr, self._pr)
+        if self._cost is not None:
+            self._cost.record(elem.value, self._inst_adr, self._pr)
+
+    def build_fusion(self, end):
+        if not self._fusion_enabled or self._fdbg is not None or self._pm_buf is not None \
+                or self._coverage is not None or self._cost is not None:
+            self._fusion = None
+            return None
+        self._fusion = {}
+        self._fusion_cover = bytearray(Comet2.ADR_MAX + 1)
+        words = [elem.value for elem in self._mem]
+        for adr in range(Comet2.ADR_MAX + 1):
+            fused = self.fuse(words, adr)
+            if fused is None:
+                continue
+            handler, size = fused
+            # 命令列の途中で終了する場合はまとめない
+            if adr < end < adr + size or adr + size > Comet2.ADR_MAX + 1:
+                continue
+            self._fusion[adr] = fused
+            for a in range(adr, adr + size):
+                self._fusion_cover[a] += 1
+        return self._fusion
+
+    def invalidate_fusion(self, adr):
+        """
+        adrを含む命令列をまとめて実行しないようにする
+        """
+        for start in range(adr - Comet2.FUSION_MAX_WORDS + 1, adr + 1):
+            fused = self._fusion.get(start)
+            if fused is not None and start + fused[1] > adr:
+                del self._fusion[start]
+                # 他の命令列に含まれない番地は以降の書き込みで確認しない
+                for a in range(start, start + fused[1]):
+                    self._fusion_cover[a] -= 1
+
+    def fuse(self, words, adr):
+        """
+        adrから始まる命令列がまとめて実行できる場合、(処理, word数)を返す
+        """
+        if adr + Comet2.FUSION_MAX_WORDS > Comet2.ADR_MAX + 1:
+            return None
+        w = words[adr:adr+Comet2.FUSION_MAX_WORDS]
+        op = w[0] >> 8
+        if op == 0x70 and w[:4] == [0x7001, 0, 0x7002, 0] and w[4] == 0x1210 and w[6] == 0x1220 \
+                and w[8] == 0xf000 and w[9] in (Comet2.SVC_OP_IN, Comet2.SVC_OP_OUT) \
+                and w[10:12] == [0x7120, 0x7110]:
+            return (self.fused_io(adr, w[5], w[7], w[9]), 12)
+        if op == 0x10 and (w[2] >> 8) in (0x20, 0x21, 0x22, 0x23) and (w[4] >> 8) == 0x11 \
+                and len({w[0] & 0xf0, w[2] & 0xf0, w[4] & 0xf0}) == 1:
+            return (self.fused_load_op_store(adr, w), 6)
+        inc = None
+        i = 0
+        if op == 0x12 and (w[0] & 0xf) == ((w[0] >> 4) & 0xf) != 0:
+            # LAD GRx,n,GRx
+            inc = ((w[0] >> 4) & 0xf, w[1])
+            i = 2
+        op = w[i] >> 8
+        if op in (0x40, 0x41):
+            size = 2
+        elif op in (0x44, 0x45):
+            size = 1
+        else:
+            return None
+        jop = w[i+size] >> 8
+        if jop not in Comet2.OPS_COND_JUMP or (w[i+size] & 0xf) != 0:
+            return None
+        return (self.fused_cmp_jump(adr + i + size, inc, w[i:i+size], jop, w[i+size+1]), i + size + 2)
+
+    def fused_cmp_jump(self, jump_adr, inc, cmp_words, jop, target):
+        """
+        [LAD GRx,n,GRx] CPA/CPL Jcc
+        """
+        cop = cmp_words[0] >> 8
+        reg1 = (cmp_words[0] >> 4) & 0xf
+        opr3 = cmp_words[0] & 0xf
+        opr2 = cmp_words[1] if len(cmp_words) == 2 else None
+        arithmetic = cop in (0x40, 0x44)
+        cond = Comet2.JUMP_CONDS[jop]
+        ninst = 2 if inc is None else 3
+        next_adr = (jump_adr + 2) & Comet2.ADR_MAX
+        cnt_ops = self._cnt_ops
+        gr = self._gr
+        def handler():
+            if inc is not None:
+                reg, n = inc
+                gr[reg] = (n + gr[reg]) & 0xffff
+                cnt_ops[0x12] += 1
+            if opr2 is None:
+                v2 = gr[opr3]
+            else:
+                v2 = self.get_mem(opr2 if opr3 == 0 else (opr2 + gr[opr3]) & 0xffff)
+            self.cmp_flag(gr[reg1], v2, arithmetic)
+            cnt_ops[cop] += 1
+            cnt_ops[jop] += 1
+            self._steps += ninst
+            self._inst_adr = jump_adr
+            if cond(self):
+                self._pr = target
+                self._cnt_taken += 1
+            else:
+                self._pr = next_adr
+                self._cnt_not_taken += 1
+        return handler
+
+    def fused_load_op_store(self, adr, w):
+        """
+        LD GRx,a ADDA/SUBA/ADDL/SUBL GRx,b ST GRx,c
+        """
+        reg = (w[0] >> 4) & 0xf
+        aop = w[2] >> 8
+        calc = self.add_flag if aop in (0x20, 0x22) else self.sub_flag
+        arithmetic = aop in (0x20, 0x21)
+        adrs = ((w[1], w[0] & 0xf), (w[3], w[2] & 0xf), (w[5], w[4] & 0xf))
+        cnt_ops = self._cnt_ops
+        gr = self._gr
+        next_adr = (adr + 6) & Comet2.ADR_MAX
+        def handler():
+            (a, ax), (b, bx), (c, cx) = adrs
+            v1 = self.get_mem(a if ax == 0 else (a + gr[ax]) & 0xffff)
+            gr[reg] = v1
+            v2 = self.get_mem(b if bx == 0 else (b + gr[bx]) & 0xffff)
+            r = calc(v1, v2, arithmetic)
+            gr[reg] = r
+            self.set_mem(c if cx == 0 else (c + gr[cx]) & 0xffff, r)
+            cnt_ops[0x10] += 1
+            cnt_ops[aop] += 1
+            cnt_ops[0x11] += 1
+            self._steps += 3
+            self._inst_adr = adr + 4
+            self._pr = next_adr
+        return handler
+
+    def fused_io(self, adr, buf_adr, size_adr, code):
+        """
+        IN, OUTマクロ (PUSH 0,GR1 PUSH 0,GR2 LAD GR1,a LAD GR2,b SVC n POP GR2 POP GR1)
+        """
+        svc = self.SVC_TABLE[code]
+        svc_elem = self._mem[adr + 8]
+        cnt_ops = self._cnt_ops
+        gr = self._gr
+        next_adr = (adr + 12) & Comet2.ADR_MAX
+        def handler():
+            for reg in (1, 2):
+                self._sp = (self._sp - 1) & 0xffff
+                self.set_mem(self._sp, gr[reg])
+            gr[1] = buf_adr
+            gr[2] = size_adr
+            self._inst_adr = adr + 8
+            self._pr = adr + 10
+            # SVCの実行時のステップ数は通常の実行と同じにする (--record-input)
+            self._steps += 5
+            svc(svc_elem)
+            cnt_ops[0x70] += 2
+            cnt_ops[0x12] += 2
+            cnt_ops[0xf0] += 1
+            self._cnt_pushes += 2
+            if adr not in self._fusion:
+                # 入力によって命令列が書き換えられた場合は続きを通常の実行に戻す
+                return
+            for reg in (2, 1):
+                gr[reg] = self.get_mem(self._sp)
+                self._sp = (self._sp + 1) & 0xffff
+            cnt_ops[0x71] += 2
+            self._cnt_pops += 2
+            self._steps += 2
+            self._inst_adr = adr + 11
+            self._pr = next_adr
+        return handler
+
+    def err_exit(self, msg):
+        print(f"Runtime Error: {msg}", file=sys.stderr)
+        self.output_regs()
+        self.output_postmortem()
+        sys.exit(1)
+
+    def output_postmortem(self):
+        if self._pm_buf is None:
+            return
+        size = self._pm_size
+        history = [self._pm_buf[i % size] for i in range(self._steps, self._steps + size)]
+        history = [h for h in history if h is not None]
+        if len(history) == 0:
+            return
+        # 各ステップの実行後の状態は次のステップの実行前の状態 (最後は現在の状態)
+        current = (None, None, None, None, tuple(self._gr), self._sp, self._zf, self._sf, self._of)
+        lines = [f"Postmortem: last {len(history)} steps"]
+        for h, after in zip(history, history[1:] + [current]):
+            step, adr, word, operand, gr, sp, zf, sf, of = h
+            changes = [f"GR{i}: {v1:04x} -> {v2:04x}"
+                    for i, (v1, v2) in enumerate(zip(gr, after[4])) if v1 != v2]
+            if sp != after[5]:
+                changes.append(f"SP: {sp:04x} -> {after[5]:04x}")
+            for name, v1, v2 in (("ZF", zf, after[6]), ("SF", sf, after[7]), ("OF", of, after[8])):
+                if v1 != v2:
+                    changes.append(f"{name}: {v1} -> {v2}")
+            labelmsg = self.get_symbol_msg(adr)
+            line = f"PM: {step:>8} [{labelmsg}{adr:04x}] {word:04x} {operand:04x}  " + ", ".join(changes)
+            lines.append(line.rstrip())
+        sys.stderr.write("\n".join(lines) + "\n")
 
     def output_debug(self, elem, msg, print_flags=True):
         if self._fdbg is None:
             return
         lstr = "--:" if elem.line == 0 else f"L{elem.line}:"
         flags = f" (ZF <- {self._zf}, SF <- {self._sf}, OF <- {self._of})" if print_flags else ""
-        label = self._mem[self._inst_adr].label
-        labelmsg = ""
-        if label is not None:
-            labelmsg = f"'{label}'="
+        labelmsg = self.get_symbol_msg(self._inst_adr)
         self._fdbg.write(f"{lstr:>6} [{labelmsg}{self._inst_adr:04x}] {msg}{flags}\n")
 
     def output(self, msg):
@@ -512,6 +1914,22 @@ class Comet2:
         self._fdbg.write(f"-REGS: PR={self._pr:04x} SP={self._sp:04x} ")
         self._fdbg.write(f"ZF={self._zf} SF={self._sf} OF={self._of}\n\n")
 
+    def output_counters(self):
+        if not self._print_regs or self._fdbg is None:
+            return
+        counters = self.get_counters()
+        ops = " ".join([f"{name}={n}" for name, n in counters.pop("ops").items()])
+        self._fdbg.write("-COUNTERS: " + " ".join([f"{k}={v}" for k, v in counters.items()]) + "\n")
+        self._fdbg.write(f"-COUNTERS: {ops}\n\n")
+
+    def get_state(self):
+        return (self._gr[:], self._sp, self._zf, self._sf, self._of)
+
+    def set_flags(self, zf, sf, of):
+        self._zf = int(zf != 0)
+        self._sf = int(sf != 0)
+        self._of = int(of != 0)
+
     def get_gr(self, n):
         if n < 0 or Comet2.REG_NUM <= n:
             self.err_exit("GR index out of range")
@@ -525,14 +1943,60 @@ class Comet2:
     def get_mem(self, adr):
         if adr < 0 or Comet2.ADR_MAX < adr:
             self.err_exit("MEM address out of range")
+        self._cnt_mem_reads += 1
         return self._mem[adr].value
 
     def set_mem(self, adr, val):
         if adr < 0 or Comet2.ADR_MAX < adr:
             self.err_exit("MEM address out of range")
-        self._mem[adr].value = val & 0xffff
-        self._mem[adr].line = 0
-        self._mem[adr].vlabel = None
+        self._cnt_mem_writes += 1
+        if self._fusion is not None and self._fusion_cover[adr]:
+            self.invalidate_fusion(adr)
+        if self._written is not None:
+            self._written.add(adr)
+        elem = self._mem[adr]
+        if self._journals:
+            for journal in self._journals:
+                journal.setdefault(adr, (elem.value, elem.line, elem.vlabel))
+        elem.value = val & 0xffff
+        elem.line = 0
+        elem.vlabel = None
+
+    def load_mem(self, adr, vals):
+        """
+        実行前にメモリの値を設定する (カウンタ等は更新しない)
+        """
+        if adr < 0 or Comet2.ADR_MAX < adr + len(vals) - 1:
+            self.err_exit("MEM address out of range")
+        for elem, val in zip(self._mem[adr:adr+len(vals)], vals):
+            elem.value = val & 0xffff
+            elem.line = 0
+            elem.vlabel = None
+
+    def get_mem_block(self, adr, size):
+        if adr < 0 or Comet2.ADR_MAX < adr + size - 1:
+            self.err_exit("MEM address out of range")
+        self._cnt_mem_reads += size
+        return [elem.value for elem in self._mem[adr:adr+size]]
+
+    def set_mem_block(self, adr, vals):
+        size = len(vals)
+        if adr < 0 or Comet2.ADR_MAX < adr + size - 1:
+            self.err_exit("MEM address out of range")
+        self._cnt_mem_writes += size
+        if self._fusion is not None and any(self._fusion_cover[adr:adr+size]):
+            for a in range(adr, adr + size):
+                self.invalidate_fusion(a)
+        if self._written is not None:
+            self._written.update(range(adr, adr + size))
+        for journal in self._journals:
+            for a in range(adr, adr + size):
+                elem = self._mem[a]
+                journal.setdefault(a, (elem.value, elem.line, elem.vlabel))
+        for elem, val in zip(self._mem[adr:adr+size], vals):
+            elem.value = val & 0xffff
+            elem.line = 0
+            elem.vlabel = None
 
     def fetch(self):
         m = self._mem[self._pr&0xffff]
@@ -849,6 +2313,9 @@ class Comet2:
         if self._sf != 0:
             self._pr = adr
             msg = f"PR <- {adr_str} "
+            self._cnt_taken += 1
+        else:
+            self._cnt_not_taken += 1
         self.output_debug(elem, msg + "<if SF == 1>", False)
 
     def op_JNZ(self, elem):
@@ -857,6 +2324,9 @@ class Comet2:
         if self._zf == 0:
             self._pr = adr
             msg = f"PR <- {adr_str} "
+            self._cnt_taken += 1
+        else:
+            self._cnt_not_taken += 1
         self.output_debug(elem, msg + "<if ZF == 0>", False)
 
     def op_JZE(self, elem):
@@ -865,6 +2335,9 @@ class Comet2:
         if self._zf != 0:
             self._pr = adr
             msg = f"PR <- {adr_str} "
+            self._cnt_taken += 1
+        else:
+            self._cnt_not_taken += 1
         self.output_debug(elem, msg + "<if ZF == 1>", False)
 
     def op_JUMP(self, elem):
@@ -878,6 +2351,9 @@ class Comet2:
         if self._sf == 0 and self._zf == 0:
             self._pr = adr
             msg = f"PR <- {adr_str} "
+            self._cnt_taken += 1
+        else:
+            self._cnt_not_taken += 1
         self.output_debug(elem, msg + "<if SF == 0 and ZF == 0>", False)
 
     def op_JOV(self, elem):
@@ -886,12 +2362,18 @@ class Comet2:
         if self._of != 0:
             self._pr = adr
             msg = f"PR <- {adr_str} "
+            self._cnt_taken += 1
+        else:
+            self._cnt_not_taken += 1
         self.output_debug(elem, msg + "<if OF == 1>", False)
 
     def op_PUSH(self, elem):
         _, adr, adr_str = self.get_reg_adr(elem)
         self._sp = (self._sp - 1) & 0xffff
         self.set_mem(self._sp, adr)
+        self._cnt_pushes += 1
+        if self._hook_pending:
+            self.update_hook_stack()
         self.output_debug(elem,
                 f"MEM[SP={self._sp:04x}] <- {adr_str} (SP <- {self._sp:04x})", False)
 
@@ -901,45 +2383,128 @@ class Comet2:
         val = self.get_mem(adr)
         self.set_gr(reg, val)
         self._sp = (self._sp + 1) & 0xffff
+        self._cnt_pops += 1
         self.output_debug(elem,
                 f"GR{reg} <- {val:04x} <MEM[SP={adr:04x}]> (SP <- {self._sp:04x})", False)
 
     def op_CALL(self, elem):
         _, adr, adr_str = self.get_reg_adr(elem)
+        hook = self._hooks.get(adr)
+        if hook is not None:
+            if not self._hook_verify:
+                self.call_hook(elem, adr_str, *hook)
+                return
+            self.start_hook_verify(*hook)
         self._sp = (self._sp - 1) & 0xffff
         val = self._pr
         self.set_mem(self._sp, val)
         self._pr = adr
+        self._cnt_pushes += 1
+        self._call_depth += 1
+        if self._call_depth > self._cnt_call_depth_max:
+            self._cnt_call_depth_max = self._call_depth
+        if self._hook_pending:
+            self.update_hook_stack()
         self.output_debug(elem,
                 f"PR <- {adr_str}, MEM[SP={self._sp:04x}] <- PR={val:04x} " +
                 f"(SP <- {self._sp:04x})", False)
 
+    def call_hook(self, elem, adr_str, name, func):
+        # CALLとRETを実行した場合と同様にスタックに戻り先が残る
+        val = self._pr
+        self.set_mem((self._sp - 1) & 0xffff, val)
+        self._cnt_pushes += 1
+        self._cnt_pops += 1
+        if self._cost is not None:
+            self._cost.skip_call()
+        func(self)
+        self.output_debug(elem, f"HLE '{name}' <{adr_str}> (PR <- {self._pr:04x})")
+
+    def start_hook_verify(self, name, func):
+        """
+        フックの実行結果を記録した後、実行前の状態に戻す
+        フックが書き込んだ番地のみ記録し、書き込み前の値、行番号、ラベルに戻す
+        本来のサブルーチンが書き込んだ番地はRETまで記録する
+        """
+        state = self.get_state()
+        fdbg = self._fdbg
+        self._fdbg = None
+        hook_journal = {}
+        self._journals.append(hook_journal)
+        try:
+            self.set_mem((self._sp - 1) & 0xffff, self._pr)
+            func(self)
+        finally:
+            self._journals.pop()
+            self._fdbg = fdbg
+        expected = (self.get_state(), {adr: self._mem[adr].value for adr in hook_journal})
+        for adr, (val, line, vlabel) in hook_journal.items():
+            elem = self._mem[adr]
+            elem.value, elem.line, elem.vlabel = val, line, vlabel
+        self._gr[:] = state[0]
+        self._sp = state[1]
+        self.set_flags(*state[2:])
+        self._hook_pending.append([state[1], self._pr, name, expected, 0])
+        self._journals.append({})
+
+    def update_hook_stack(self):
+        # 本来のサブルーチンが使用したスタックの範囲は比較しない
+        pending = self._hook_pending[-1]
+        pending[4] = max(pending[4], (pending[0] - self._sp) & 0xffff)
+
+    def check_hook_verify(self):
+        sp, ret, name, (state, hook_vals), depth = self._hook_pending.pop()
+        journal = self._journals.pop()
+        stack = {(sp - i) & 0xffff for i in range(1, depth + 1)}
+        # どちらも書き込んでいない番地は同じ値
+        for adr in sorted(hook_vals.keys() | journal.keys()):
+            elem = self._mem[adr]
+            val = hook_vals[adr] if adr in hook_vals else journal[adr][0]
+            if elem.value != val and adr not in stack:
+                self.err_exit(f"HLE verify error ('{name}': MEM[{adr:04x}]={elem.value:04x}, " +
+                        f"HLE={val:04x})")
+        if self.get_state() != state:
+            actual = self.get_state()
+            self.err_exit(f"HLE verify error ('{name}': GR, SP, ZF, SF, OF={actual}, HLE={state})")
+
     def op_RET(self, elem):
         self._pr = self.get_mem(self._sp)
         self._sp = (self._sp + 1) & 0xffff
+        self._cnt_pops += 1
+        self._call_depth -= 1
         self.output_debug(elem, f"PR <- {self._pr:04x} (SP <- {self._sp:04x})", False)
+        if self._hook_pending and self._hook_pending[-1][0] == self._sp \
+                and self._hook_pending[-1][1] == self._pr:
+            self.check_hook_verify()
 
     def op_SVC(self, elem):
         code2 = self.fetch().value
-        if code2 == Comet2.SVC_OP_IN:
-            self.op_SVC_IN(elem)
-        elif code2 == Comet2.SVC_OP_OUT:
-            self.op_SVC_OUT(elem)
-        else:
+        handler = self.SVC_TABLE.get(code2)
+        if handler is None:
             self.err_exit(f"unknown SVC op 'SVC {code2:04x}'")
+        handler(elem)
 
     def op_SVC_IN(self, elem):
         # IN: GR1(保存先アドレス) GR2(サイズ格納先アドレス)
         # self._finがNoneの場合、サイズ0の入力とみなす
         start = self.get_gr(1)
         self.output_debug(elem, "SVC IN", False)
+        fin = self._fin
+        if self._input_replay is not None:
+            try:
+                fin = self._input_replay.next(self._steps)
+            except ValueError as e:
+                self.err_exit(str(e))
+        consumed = [] if self._input_log is not None else None
         size = 0
         for _ in range(256):
             save_adr = (start + size) & Comet2.ADR_MAX
             instr = ""
-            if self._fin is not None:
+            if fin is not None:
                 while True:
-                    instr = self._fin.read(1)
+                    instr = fin.read(1)
+                    if consumed is not None:
+                        consumed.append(instr)
                     if instr == "" or self._input_all or Comet2.is_printable(instr):
                         break
             if instr == "":
@@ -948,9 +2513,12 @@ class Comet2:
             self.set_mem(save_adr, d)
             self.output_debug(elem, f"IN: MEM[{save_adr:04x}] <- {d:04x} <input>", False)
             size += 1
+        self._cnt_in_bytes += size
         size_adr = self.get_gr(2)
         self.set_mem(size_adr, size)
         self.output_debug(elem, f"IN: MEM[{size_adr:04x}] <- {size:04x} <input size>", False)
+        if consumed is not None:
+            self._input_log.record(self._steps, "".join(consumed))
 
     @staticmethod
     def is_printable(s):
@@ -968,20 +2536,1457 @@ class Comet2:
             adr = adr & Comet2.ADR_MAX
             msg.append(self.get_mem(adr)&0xff)
         self.output_debug(elem, f"SVC OUT MEM[{start:04x}]...MEM[{adr:04x}]", False)
+        self._cnt_out_bytes += len(msg)
         self.output(Comet2.to_str(msg))
 
+    def op_SVC_COPY(self, elem):
+        # COPY: GR1(コピー元アドレス) GR2(コピー先アドレス) GR3(word数)
+        src = self.get_gr(1)
+        dst = self.get_gr(2)
+        size = self.get_gr(3)
+        self.set_mem_block(dst, self.get_mem_block(src, size))
+        self.output_debug(elem, f"SVC COPY MEM[{dst:04x}]... <- MEM[{src:04x}]... ({size:04x} words)", False)
+
+    def op_SVC_FILL(self, elem):
+        # FILL: GR1(書き込み先アドレス) GR2(値) GR3(word数)
+        dst = self.get_gr(1)
+        val = self.get_gr(2)
+        size = self.get_gr(3)
+        self.set_mem_block(dst, [val] * size)
+        self.output_debug(elem, f"SVC FILL MEM[{dst:04x}]... <- {val:04x} ({size:04x} words)", False)
+
+    def op_SVC_CMP(self, elem):
+        # CMP: GR1(比較元アドレス) GR2(比較先アドレス) GR3(word数)
+        # 最初に異なるwordの位置をGR0に格納し、そのwordをCPLで比較した時と同じフラグを設定する
+        # 全て一致した場合GR0はword数
+        adr1 = self.get_gr(1)
+        adr2 = self.get_gr(2)
+        size = self.get_gr(3)
+        vals1 = self.get_mem_block(adr1, size)
+        vals2 = self.get_mem_block(adr2, size)
+        index = size
+        v1 = v2 = 0
+        for i, (v1, v2) in enumerate(zip(vals1, vals2)):
+            if v1 != v2:
+                index = i
+                break
+        self.cmp_flag(v1, v2, False)
+        self.set_gr(0, index)
+        self.output_debug(elem, f"SVC CMP MEM[{adr1:04x}]... MEM[{adr2:04x}]... " +
+                f"({size:04x} words) (GR0 <- {index:04x})")
+
+    def op_SVC_OUTW(self, elem):
+        # OUTW: GR1(出力元アドレス) GR2(サイズ格納先アドレス)
+        # 各wordを16進数で出力する
+        start = self.get_gr(1)
+        size = self.get_mem(self.get_gr(2))
+        vals = self.get_mem_block(start, size)
+        self.output_debug(elem, f"SVC OUTW MEM[{start:04x}]... ({size:04x} words)", False)
+        self._cnt_out_bytes += size * 2
+        self.output(" ".join([f"{v:04x}" for v in vals]))
+
     @staticmethod
     def to_str(ilist):
         # TODO ASCIIのみ (本来対応する文字コードはJIS X 0201)
         return "".join([chr(i) for i in ilist])
 # End Comet2
 
-def print_mem(mem):
-        width = 8
-        for i in range(0, len(mem), width):
-            line = " ".join([f"{m.value:04x}" for m in mem[i:i+width]])
-            print(f"# [{i:04x}]: {line}")
-        print("")
+class Comet2Lanes:
+    """
+    同じプログラムを入力の異なる複数のマシン(レーン)で同時に実行する
+    レジスタ、フラグ、メモリをNumPy配列で保持し、PRと命令が同じレーンをまとめて実行する
+    SVCはIN, OUTのみ対応する
+    """
+    def __init__(self, mem, inputs, grlist=(0, 0, 0, 0, 0, 0, 0, 0), sp=0, input_all=False):
+        if np is None:
+            self.err_exit("numpy is required for lanes")
+        n = len(inputs)
+        vals = np.array([elem.value for elem in mem], dtype=np.uint16)
+        if len(vals) > Comet2.ADR_MAX + 1:
+            self.err_exit("memory over")
+        vals.resize(Comet2.ADR_MAX + 1)
+        self._mem = np.tile(vals, (n, 1))
+        self._gr = np.tile(np.array(grlist, dtype=np.int64) & 0xffff, (n, 1))
+        self._pr = np.zeros(n, dtype=np.int64)
+        self._sp = np.full(n, sp & 0xffff, dtype=np.int64)
+        self._zf = np.zeros(n, dtype=np.int64)
+        self._sf = np.zeros(n, dtype=np.int64)
+        self._of = np.zeros(n, dtype=np.int64)
+        self._steps = np.zeros(n, dtype=np.int64)
+        self._active = np.zeros(n, dtype=bool)
+        self._inputs = inputs
+        self._in_pos = [0] * n
+        self._input_all = input_all
+        self._outputs = [[] for _ in range(n)]
+        self._errors = [None] * n
+        alu_ops = {0x20: (self.add_flag, True), 0x21: (self.sub_flag, True),
+                0x22: (self.add_flag, False), 0x23: (self.sub_flag, False),
+                0x30: (self.bit_flag, np.bitwise_and), 0x31: (self.bit_flag, np.bitwise_or),
+                0x32: (self.bit_flag, np.bitwise_xor)}
+        self.OP_TABLE = {
+                0x00: self.op_NOP, 0x10: self.op_LD, 0x11: self.op_ST, 0x12: self.op_LAD,
+                0x14: self.op_LD,
+                0x40: self.mk_op_cmp(True), 0x41: self.mk_op_cmp(False),
+                0x44: self.mk_op_cmp(True), 0x45: self.mk_op_cmp(False),
+                0x50: self.mk_op_shift(Comet2.REG_BITS, 0x4000, True, True),
+                0x51: self.mk_op_shift(Comet2.REG_BITS, 0x0001, False, True),
+                0x52: self.mk_op_shift(Comet2.REG_BITS + 1, 0x8000, True, False),
+                0x53: self.mk_op_shift(Comet2.REG_BITS + 1, 0x0001, False, False),
+                0x61: self.mk_op_jump(lambda l: self._sf[l] != 0),
+                0x62: self.mk_op_jump(lambda l: self._zf[l] == 0),
+                0x63: self.mk_op_jump(lambda l: self._zf[l] != 0),
+                0x64: self.mk_op_jump(lambda l: np.ones(len(l), dtype=bool)),
+                0x65: self.mk_op_jump(lambda l: (self._sf[l] == 0) & (self._zf[l] == 0)),
+                0x66: self.mk_op_jump(lambda l: self._of[l] != 0),
+                0x70: self.op_PUSH, 0x71: self.op_POP, 0x80: self.op_CALL, 0x81: self.op_RET,
+                0xf0: self.op_SVC}
+        for op, (calc, arg) in alu_ops.items():
+            self.OP_TABLE[op] = self.mk_op_alu(calc, arg)
+            self.OP_TABLE[op + 4] = self.mk_op_alu(calc, arg)
+
+    def err_exit(self, msg):
+        print(f"Runtime Error: {msg}", file=sys.stderr)
+        sys.exit(1)
+
+    def run(self, start, end, virtual_call=False, max_steps=None):
+        """
+        全てのレーンがendに到達するか、エラーになるまで実行する
+        max_stepsを超えたレーンはエラーとする
+        """
+        end = end & 0xffff
+        self._pr[:] = start & 0xffff
+        if virtual_call:
+            self._sp = (self._sp - 1) & 0xffff
+            self._mem[np.arange(len(self._sp)), self._sp] = end
+        self._active[:] = [e is None for e in self._errors]
+        self._active &= self._pr != end
+        while self._active.any():
+            self.step()
+            self._active &= self._pr != end
+            if max_steps is not None and (self._steps[self._active] >= max_steps).any():
+                for lane in np.flatnonzero(self._active & (self._steps >= max_steps)):
+                    self.fail(lane, f"max steps exceeded ({max_steps})")
+        return self.get_results()
+
+    def step(self):
+        lanes = np.flatnonzero(self._active)
+        pr = self._pr[lanes]
+        w1 = self._mem[lanes, pr].astype(np.int64)
+        w2 = self._mem[lanes, (pr + 1) & 0xffff].astype(np.int64)
+        keys = (pr << 32) | (w1 << 16) | w2
+        if (keys == keys[0]).all():
+            self.execute(lanes, int(pr[0]), int(w1[0]), int(w2[0]))
+            return
+        # PRまたは命令が異なるレーンはグループごとに実行する
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        for k, i in enumerate(first):
+            self.execute(lanes[inverse.reshape(-1) == k], int(pr[i]), int(w1[i]), int(w2[i]))
+
+    def execute(self, lanes, pc, w1, w2):
+        op = w1 >> 8
+        r1 = (w1 >> 4) & 0xf
+        r2 = w1 & 0xf
+        self._steps[lanes] += 1
+        handler = self.OP_TABLE.get(op)
+        if handler is None:
+            for lane in lanes:
+                self.fail(lane, f"unknown operation ([{pc:04x}]: {w1:04x})")
+            return
+        if op in Comet2.OPS_2WORD:
+            self._pr[lanes] = (pc + 2) & 0xffff
+            if op == 0xf0 or r2 == 0:
+                adr = np.full(len(lanes), w2, dtype=np.int64)
+            else:
+                adr = (w2 + self._gr[lanes, r2]) & 0xffff
+        else:
+            self._pr[lanes] = (pc + 1) & 0xffff
+            adr = None
+        handler(lanes, r1, r2, adr)
+
+    def fail(self, lane, msg):
+        self._errors[lane] = msg
+        self._active[lane] = False
+
+    def get_results(self):
+        """
+        レーンごとの実行結果のリストを返す
+        """
+        results = []
+        for i in range(len(self._inputs)):
+            results.append({
+                "gr": self._gr[i].tolist(), "pr": int(self._pr[i]), "sp": int(self._sp[i]),
+                "zf": int(self._zf[i]), "sf": int(self._sf[i]), "of": int(self._of[i]),
+                "steps": int(self._steps[i]), "output": self._outputs[i], "error": self._errors[i]})
+        return results
+
+    def get_mem(self, lane):
+        return self._mem[lane].tolist()
+
+    def operand(self, lanes, r2, adr):
+        if adr is None:
+            return self._gr[lanes, r2]
+        return self._mem[lanes, adr].astype(np.int64)
+
+    def add_flag(self, lanes, v1, v2, arithmetic):
+        r = v1 + v2
+        self._zf[lanes] = r == 0
+        if arithmetic:
+            sr = r & 0x8000
+            sv1 = v1 & 0x8000
+            sv2 = v2 & 0x8000
+            self._sf[lanes] = sr >> 15
+            self._of[lanes] = ((~(sv1 ^ sv2)) & (sv1 ^ sr)) >> 15
+        else:
+            self._sf[lanes] = 0
+            self._of[lanes] = r > 0xffff
+        return r & 0xffff
+
+    def sub_flag(self, lanes, v1, v2, arithmetic):
+        r = v1 - v2
+        self._zf[lanes] = r == 0
+        if arithmetic:
+            sr = r & 0x8000
+            sv1 = v1 & 0x8000
+            sv2 = v2 & 0x8000
+            self._sf[lanes] = sr >> 15
+            self._of[lanes] = ((sv1 ^ sv2) & (sv1 ^ sr)) >> 15
+        else:
+            self._sf[lanes] = 0
+            self._of[lanes] = v1 < v2
+        return r & 0xffff
+
+    def bit_flag(self, lanes, v1, v2, op):
+        r = op(v1, v2)
+        self._zf[lanes] = r == 0
+        self._sf[lanes] = 0
+        self._of[lanes] = 0
+        return r & 0xffff
+
+    def op_NOP(self, lanes, r1, r2, adr):
+        pass
+
+    def op_LD(self, lanes, r1, r2, adr):
+        val = self.operand(lanes, r2, adr)
+        self._zf[lanes] = val == 0
+        self._sf[lanes] = (val & 0x8000) >> 15
+        self._of[lanes] = 0
+        self._gr[lanes, r1] = val
+
+    def op_ST(self, lanes, r1, r2, adr):
+        self._mem[lanes, adr] = self._gr[lanes, r1]
+
+    def op_LAD(self, lanes, r1, r2, adr):
+        self._gr[lanes, r1] = adr
+
+    def mk_op_alu(self, calc, arg):
+        def op_alu(lanes, r1, r2, adr):
+            v2 = self.operand(lanes, r2, adr)
+            self._gr[lanes, r1] = calc(lanes, self._gr[lanes, r1], v2, arg)
+        return op_alu
+
+    def mk_op_cmp(self, arithmetic):
+        def op_cmp(lanes, r1, r2, adr):
+            v1 = self._gr[lanes, r1]
+            v2 = self.operand(lanes, r2, adr)
+            if arithmetic:
+                lt = (v1 ^ 0x8000) < (v2 ^ 0x8000)
+            else:
+                lt = v1 < v2
+            self._of[lanes] = 0
+            self._zf[lanes] = v1 == v2
+            self._sf[lanes] = lt & (v1 != v2)
+        return op_cmp
+
+    def mk_op_shift(self, limit, of_bit, left, arithmetic):
+        def op_shift(lanes, r1, r2, adr):
+            v1 = self._gr[lanes, r1]
+            shift = np.minimum(adr, limit)
+            r = v1.copy()
+            of = self._of[lanes]
+            sign = v1 & 0x8000 if arithmetic else 0
+            for k in range(int(shift.max())):
+                m = shift > k
+                of = np.where(m, (r & of_bit) // of_bit, of)
+                if left:
+                    shifted = ((r << 1) & 0x7fff) | sign if arithmetic else (r << 1) & 0xffff
+                else:
+                    shifted = ((r >> 1) & 0x7fff) | sign if arithmetic else r >> 1
+                r = np.where(m, shifted, r)
+            self._of[lanes] = of
+            self._zf[lanes] = r == 0
+            self._sf[lanes] = (v1 & 0x8000) >> 15 if arithmetic else 0
+            self._gr[lanes, r1] = r
+        return op_shift
+
+    def mk_op_jump(self, cond):
+        def op_jump(lanes, r1, r2, adr):
+            self._pr[lanes] = np.where(cond(lanes), adr, self._pr[lanes])
+        return op_jump
+
+    def op_PUSH(self, lanes, r1, r2, adr):
+        sp = (self._sp[lanes] - 1) & 0xffff
+        self._sp[lanes] = sp
+        self._mem[lanes, sp] = adr
+
+    def op_POP(self, lanes, r1, r2, adr):
+        sp = self._sp[lanes]
+        self._gr[lanes, r1] = self._mem[lanes, sp]
+        self._sp[lanes] = (sp + 1) & 0xffff
+
+    def op_CALL(self, lanes, r1, r2, adr):
+        sp = (self._sp[lanes] - 1) & 0xffff
+        self._sp[lanes] = sp
+        self._mem[lanes, sp] = self._pr[lanes]
+        self._pr[lanes] = adr
+
+    def op_RET(self, lanes, r1, r2, adr):
+        sp = self._sp[lanes]
+        self._pr[lanes] = self._mem[lanes, sp]
+        self._sp[lanes] = (sp + 1) & 0xffff
+
+    def op_SVC(self, lanes, r1, r2, adr):
+        code = int(adr[0])
+        for lane in lanes:
+            if code == Comet2.SVC_OP_IN:
+                self.svc_in(lane)
+            elif code == Comet2.SVC_OP_OUT:
+                self.svc_out(lane)
+            else:
+                self.fail(lane, f"unknown SVC op 'SVC {code:04x}'")
+
+    def svc_in(self, lane):
+        # Comet2.op_SVC_INと同じ動作をレーンごとに行う
+        mem = self._mem[lane]
+        instr = self._inputs[lane]
+        pos = self._in_pos[lane]
+        start = int(self._gr[lane, 1])
+        size = 0
+        while size < 256:
+            while pos < len(instr) and not (self._input_all or Comet2.is_printable(instr[pos])):
+                pos += 1
+            if pos >= len(instr):
+                break
+            mem[(start + size) & Comet2.ADR_MAX] = ord(instr[pos]) & 0xff
+            pos += 1
+            size += 1
+        self._in_pos[lane] = pos
+        mem[int(self._gr[lane, 2])] = size
+
+    def svc_out(self, lane):
+        mem = self._mem[lane]
+        start = int(self._gr[lane, 1])
+        size = int(mem[int(self._gr[lane, 2])])
+        msg = [int(mem[adr & Comet2.ADR_MAX]) & 0xff for adr in range(start, start + size)]
+        self._outputs[lane].append(Comet2.to_str(msg))
+# End Comet2Lanes
+
+class Coverage:
+    """
+    番地ごとの実行の有無と条件分岐の成立/不成立を記録する
+    lcov形式で行単位のカバレッジとして出力する
+    """
+    def __init__(self, mem):
+        size = Comet2.ADR_MAX + 1
+        # 実行時に書き換えられる前の値と行番号を保持する
+        self._words = [elem.value for elem in mem[:size]]
+        self._lines = [elem.line for elem in mem[:size]]
+        self._hits = bytearray(size)
+        self._taken = bytearray(size)
+        self._not_taken = bytearray(size)
+
+    def reset(self):
+        size = Comet2.ADR_MAX + 1
+        self._hits[:] = bytes(size)
+        self._taken[:] = bytes(size)
+        self._not_taken[:] = bytes(size)
+
+    def get_bits(self):
+        """
+        実行した番地と分岐の成立/不成立を1つの整数のビットとして返す
+        """
+        return int.from_bytes(self._hits + self._taken + self._not_taken, "big")
+
+    def record(self, op, inst_adr, pr):
+        self._hits[inst_adr] = 1
+        if op in Comet2.OPS_COND_JUMP:
+            if pr == (inst_adr + 2) & Comet2.ADR_MAX:
+                self._not_taken[inst_adr] = 1
+            else:
+                self._taken[inst_adr] = 1
+
+    def merge(self, other):
+        """
+        同じプログラムの別の実行結果を合算する
+        """
+        size = Comet2.ADR_MAX + 1
+        for name in ("_hits", "_taken", "_not_taken"):
+            v = int.from_bytes(getattr(self, name), "big") | int.from_bytes(getattr(other, name), "big")
+            setattr(self, name, bytearray(v.to_bytes(size, "big")))
+
+    def get_records(self, code_lines):
+        """
+        行ごとの実行回数 {行番号:回数} と
+        分岐ごとの回数 {(行番号, 番地, 0:成立 1:不成立): 回数 (未実行の場合None)} を返す
+        """
+        lines = {}
+        branches = {}
+        adr = 0
+        size = len(self._lines)
+        while adr < size:
+            line = self._lines[adr]
+            if line not in code_lines:
+                adr += 1
+                continue
+            hit = self._hits[adr]
+            lines[line] = max(lines.get(line, 0), hit)
+            op = (self._words[adr] & 0xff00) >> 8
+            if op in Comet2.OPS_COND_JUMP:
+                branches[(line, adr, 0)] = self._taken[adr] if hit else None
+                branches[(line, adr, 1)] = self._not_taken[adr] if hit else None
+            adr += 2 if op in Comet2.OPS_2WORD else 1
+        return lines, branches
+
+    @staticmethod
+    def read_lcov(f):
+        """
+        lcov形式を読み込み {ソース名:(行ごとの回数, 分岐ごとの回数)} を返す
+        """
+        records = {}
+        lines = branches = None
+        for row in f:
+            row = row.strip()
+            if row.startswith("SF:"):
+                lines, branches = records.setdefault(row[3:], ({}, {}))
+            elif row.startswith("DA:"):
+                line, count = row[3:].split(",")[:2]
+                Coverage.add_count(lines, int(line), int(count))
+            elif row.startswith("BRDA:"):
+                line, adr, branch, count = row[5:].split(",")
+                count = None if count == "-" else int(count)
+                Coverage.add_count(branches, (int(line), int(adr), int(branch)), count)
+        return records
+
+    @staticmethod
+    def merge_records(records, srcname, lines, branches):
+        """
+        recordsのsrcnameの結果にlines, branchesを加算する
+        """
+        old_lines, old_branches = records.setdefault(srcname, ({}, {}))
+        for line, count in lines.items():
+            Coverage.add_count(old_lines, line, count)
+        for key, count in branches.items():
+            Coverage.add_count(old_branches, key, count)
+
+    @staticmethod
+    def add_count(counts, key, count):
+        # countがNoneの場合は未実行 (lcovの'-')
+        if count is None:
+            counts.setdefault(key, None)
+        else:
+            counts[key] = (counts.get(key) or 0) + count
+
+    @staticmethod
+    def write_lcov(f, records):
+        out = []
+        for srcname, (lines, branches) in records.items():
+            out.append("TN:")
+            out.append(f"SF:{srcname}")
+            for (line, adr, branch), count in sorted(branches.items()):
+                out.append(f"BRDA:{line},{adr},{branch},{'-' if count is None else count}")
+            out.append(f"BRF:{len(branches)}")
+            out.append(f"BRH:{len([c for c in branches.values() if c])}")
+            for line, count in sorted(lines.items()):
+                out.append(f"DA:{line},{count}")
+            out.append(f"LF:{len(lines)}")
+            out.append(f"LH:{len([c for c in lines.values() if c])}")
+            out.append("end_of_record")
+        f.write("\n".join(out) + "\n")
+# End Coverage
+
+class Fuzzer:
+    """
+    SVC INの入力を変異させながら実行し、新しい番地または分岐に到達した入力をコーパスに保存する
+    Runtime Error、ステップ数の上限超過、SPが実行前と異なる終了となった入力はcrashesに保存する
+    (-Cの場合はRETで終了したときのSPとENDで終了したときのSPのどちらも正常とする)
+    同じ理由、メッセージの異常終了は最初の入力のみ保存する
+    hooks: [(番地, 処理, 名前), ...] (--hle)
+    symbols: 異常終了のメッセージで番地の表示に使うSymbolIndex (Noneの場合memのラベルから作る)
+    """
+    def __init__(self, mem, start, end, fuzz_dir, virtual_call=False, input_all=False,
+            max_steps=1000000, seed=None, svc_ext=False, hooks=(), symbols=None):
+        self._mem = mem
+        self._pristine = [(elem.value, elem.line, elem.vlabel) for elem in mem]
+        self._written = set()
+        self._start = start
+        self._end = end
+        self._corpus_dir = pathlib.Path(fuzz_dir) / "corpus"
+        self._crashes_dir = pathlib.Path(fuzz_dir) / "crashes"
+        self._corpus_dir.mkdir(parents=True, exist_ok=True)
+        self._crashes_dir.mkdir(parents=True, exist_ok=True)
+        self._virtual_call = virtual_call
+        self._input_all = input_all
+        self._max_steps = max_steps
+        self._random = random.Random(seed)
+        self._coverage = Coverage(mem)
+        self._svc_ext = svc_ext
+        self._hooks = hooks
+        self._symbols = symbols if symbols is not None else SymbolIndex.from_mem(mem)
+        self._bits = 0
+        self._corpus = {}
+        # 保存済みの異常終了の(理由, メッセージ)
+        self._crash_keys = set()
+
+    def load_corpus(self):
+        for path in self._corpus_dir.iterdir():
+            if path.name not in self._corpus:
+                self._corpus[path.name] = path.read_bytes()
+        if len(self._corpus) == 0:
+            self.save(self._corpus_dir, b"")
+        for path in self._crashes_dir.glob("*.txt"):
+            with contextlib.suppress(OSError):
+                self._crash_keys.add((path.name.split("-")[0], path.read_text().rstrip("\n")))
+
+    def save(self, directory, data, reason=None, msg=None):
+        name = hashlib.sha1(data).hexdigest()[:16]
+        if reason is not None:
+            name = f"{reason}-{name}"
+            (directory / f"{name}.txt").write_text(msg + "\n")
+        (directory / name).write_bytes(data)
+        if directory == self._corpus_dir:
+            self._corpus[name] = data
+
+    def run_input(self, data):
+        """
+        dataを入力として実行し、(カバレッジ, 異常終了の理由, メッセージ)を返す
+        """
+        # 前回の実行で書き込まれた番地のみ戻す
+        for adr in self._written:
+            elem = self._mem[adr]
+            elem.value, elem.line, elem.vlabel = self._pristine[adr]
+        self._coverage.reset()
+        c = Comet2(self._mem)
+        c.enable_coverage(self._coverage)
+        c.set_symbols(self._symbols)
+        self._written = c.track_writes()
+        c.set_max_steps(self._max_steps)
+        if self._svc_ext:
+            c.enable_svc_ext()
+        for adr, func, name in self._hooks:
+            c.register_hook(adr, func, name)
+        fin = io.StringIO(data.decode("latin-1"))
+        reason = None
+        msg = ""
+        sp = c.get_state()[1]
+        # -Cの場合、RETで終了すると実行前のSP、ENDで終了すると仮想のCALL後のSPになる
+        valid_sps = (sp, (sp - 1) & 0xffff) if self._virtual_call else (sp,)
+        with contextlib.redirect_stderr(io.StringIO()) as ferr:
+            try:
+                c.run(self._start, self._end, None, None, fin, self._virtual_call, self._input_all)
+                if c.get_state()[1] not in valid_sps:
+                    reason = "stack"
+                    msg = f"SP={c.get_state()[1]:04x} at exit"
+            except SystemExit:
+                msg = ferr.getvalue().strip()
+                reason = "timeout" if "max steps exceeded" in msg else "error"
+        return self._coverage.get_bits(), reason, msg
+
+    def mutate(self, data):
+        rnd = self._random
+        data = bytearray(data)
+        for _ in range(rnd.randint(1, 4)):
+            kind = rnd.randrange(6)
+            pos = rnd.randint(0, len(data))
+            if kind == 0 and len(data) > 0: # bit flip
+                pos = min(pos, len(data) - 1)
+                data[pos] ^= 1 << rnd.randrange(8)
+            elif kind == 1 and len(data) > 0: # byte replace
+                pos = min(pos, len(data) - 1)
+                data[pos] = rnd.randrange(0x20, 0x7f) if rnd.random() < 0.8 else rnd.randrange(256)
+            elif kind == 2: # insert
+                data[pos:pos] = bytes([rnd.randrange(0x20, 0x7f) for _ in range(rnd.randint(1, 8))])
+            elif kind == 3 and len(data) > 0: # delete
+                del data[pos:pos+rnd.randint(1, 8)]
+            elif kind == 4: # splice
+                other = rnd.choice(list(self._corpus.values()))
+                data[pos:] = other[rnd.randint(0, len(other)):]
+            else: # repeat
+                part = data[pos:pos+rnd.randint(1, 16)]
+                data[pos:pos] = part * rnd.randint(1, 8)
+        return bytes(data[:1024])
+
+    def fuzz(self, runs):
+        """
+        runs回実行し、(実行回数, 追加した入力数, 新しい異常終了の数)を返す
+        """
+        self.load_corpus()
+        for data in list(self._corpus.values()):
+            self._bits |= self.run_input(data)[0]
+        added = 0
+        crashes = 0
+        for i in range(runs):
+            if i % 100 == 99:
+                # 他のプロセスが追加した入力を読み込む
+                self.load_corpus()
+            data = self.mutate(self._random.choice(list(self._corpus.values())))
+            bits, reason, msg = self.run_input(data)
+            if reason is not None:
+                if (reason, msg) not in self._crash_keys:
+                    self._crash_keys.add((reason, msg))
+                    self.save(self._crashes_dir, data, reason, msg)
+                    crashes += 1
+            elif bits & ~self._bits:
+                self._bits |= bits
+                self.save(self._corpus_dir, data)
+                added += 1
+        return (runs, added, crashes)
+# End Fuzzer
+
+def fuzz_worker(params):
+    image_name, fuzz_dir, virtual_call, input_all, max_steps, runs, seed, svc_ext, hle = params
+    image = SharedImage.attach(image_name)
+    try:
+        # HLEの処理はプロセス間で渡せないため各プロセスで読み込む
+        labels = image.get_labels()
+        hooks = resolve_hle_hooks(hle, labels)
+        fuzzer = Fuzzer(image.get_mem(), image.get_start(), image.get_end(), fuzz_dir,
+                virtual_call, input_all, max_steps, seed, svc_ext, hooks, SymbolIndex(labels))
+    finally:
+        image.close()
+    return fuzzer.fuzz(runs)
+
+def fuzz(mem, start, end, labels, fuzz_dir, jobs, runs, virtual_call=False, input_all=False,
+        max_steps=1000000, seed=0, svc_ext=False, hle=()):
+    """
+    jobs個のプロセスでそれぞれruns回ずつ実行する (各プロセスの乱数のシードはseed, seed+1, ...)
+    memはSharedImageで各プロセスに渡す (各プロセスは実行用に複製する)
+    コーパスはfuzz_dir/corpusを通して各プロセスで共有する
+    """
+    image = SharedImage.publish(mem, start, end, labels)
+    try:
+        params = [(image.get_name(), fuzz_dir, virtual_call, input_all, max_steps, runs, seed + i,
+                svc_ext, hle) for i in range(jobs)]
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.map(fuzz_worker, params)
+    finally:
+        image.close()
+    return tuple(sum(r) for r in zip(*results))
+
+class SharedImage:
+    """
+    アセンブル後のメモリイメージ、行番号、ラベルの一覧をshared_memoryに配置し、複数のプロセスで共有する
+    配置: ヘッダ(start, end, ラベルの一覧のサイズ) 値(2byte*65536) 行番号(4byte*65536) ラベルの一覧(JSON)
+    各プロセスはget_mem()で実行用のメモリを複製する (共有メモリを直接実行には使用しない)
+    番地の表示にはラベルの一覧から作成したSymbolIndexを使用する
+    """
+    HEADER_SIZE = 3 * 4
+    WORDS = 65536
+    VALS_OFFSET = HEADER_SIZE
+    LINES_OFFSET = VALS_OFFSET + WORDS * 2
+    LABELS_OFFSET = LINES_OFFSET + WORDS * 4
+
+    def __init__(self, shm, owner):
+        self._shm = shm
+        self._owner = owner
+        header = array.array("I")
+        header.frombytes(shm.buf[:SharedImage.HEADER_SIZE])
+        self._start, self._end, self._labels_size = header
+        self._labels = None
+
+    @staticmethod
+    def publish(mem, start, end, labels):
+        """
+        memを共有メモリに書き込む (作成したプロセスがclose()で削除する)
+        """
+        vals = array.array("H", [elem.value for elem in mem])
+        lines = array.array("I", [elem.line for elem in mem])
+        labels_data = json.dumps(labels).encode()
+        data = array.array("I", [start & 0xffff, end & 0xffff, len(labels_data)]).tobytes() + \
+                vals.tobytes() + lines.tobytes() + labels_data
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        shm.buf[:len(data)] = data
+        return SharedImage(shm, True)
+
+    @staticmethod
+    def attach(name):
+        return SharedImage(shared_memory.SharedMemory(name=name), False)
+
+    def get_name(self):
+        return self._shm.name
+
+    def get_start(self):
+        return self._start
+
+    def get_end(self):
+        return self._end
+
+    def get_labels(self):
+        if self._labels is None:
+            offset = SharedImage.LABELS_OFFSET
+            self._labels = json.loads(bytes(self._shm.buf[offset:offset+self._labels_size]))
+        return self._labels
+
+    def get_mem(self):
+        """
+        共有メモリの値と行番号からこのプロセスで実行するためのメモリを複製する (共有メモリは変更しない)
+        """
+        vals = array.array("H")
+        vals.frombytes(self._shm.buf[SharedImage.VALS_OFFSET:SharedImage.LINES_OFFSET])
+        lines = array.array("I")
+        lines.frombytes(self._shm.buf[SharedImage.LINES_OFFSET:SharedImage.LABELS_OFFSET])
+        return [Element(v, l) for v, l in zip(vals, lines)]
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+# End SharedImage
+
+class InputRecorder:
+    """
+    SVC INで読み込んだ文字を実行ステップ数とともにバイナリ形式で記録する (--record-input)
+    形式: MAGIC, [ステップ数(8byte) 長さ(4byte) 読み込んだ文字列(UTF-8)] * SVC INの回数
+    読み込んだ文字列には受け付けなかった文字も含める
+    """
+    MAGIC = b"C2IN\x01"
+    RECORD = struct.Struct("<QI")
+
+    def __init__(self, f):
+        self._f = f
+        self._f.write(self.MAGIC)
+
+    def record(self, step, data):
+        b = data.encode("utf-8", "surrogatepass")
+        self._f.write(self.RECORD.pack(step, len(b)) + b)
+        # 異常終了や強制終了の場合でもそれまでの入力を残す
+        self._f.flush()
+# End InputRecorder
+
+class InputReplay:
+    """
+    InputRecorderで記録した入力をSVC INごとに返す (--replay-input)
+    """
+    def __init__(self, f):
+        if f.read(len(InputRecorder.MAGIC)) != InputRecorder.MAGIC:
+            raise ValueError("bad input record format")
+        self._f = f
+
+    def get_file(self):
+        return self._f
+
+    def next(self, step):
+        """
+        stepで実行したSVC INの入力をファイルとして返す
+        記録がない場合、記録したステップ数と異なる場合はValueErrorを送出する
+        """
+        header = self._f.read(InputRecorder.RECORD.size)
+        if len(header) != InputRecorder.RECORD.size:
+            raise ValueError(f"no more recorded input (step {step})")
+        recorded_step, size = InputRecorder.RECORD.unpack(header)
+        if recorded_step != step:
+            raise ValueError(f"input replay mismatch (step {step}, recorded step {recorded_step})")
+        data = self._f.read(size)
+        if len(data) != size:
+            raise ValueError(f"truncated input record (step {step})")
+        return io.StringIO(data.decode("utf-8", "surrogatepass"))
+# End InputReplay
+
+class AsyncInput:
+    """
+    asyncio.StreamReaderからの入力をSVC IN用に保持する
+    SVC INは最大256文字を読み込むため、受け付ける文字が256文字揃うか終端に達するまで待つ
+    """
+    def __init__(self, reader, input_all=False, encoding="utf-8"):
+        self._reader = reader
+        self._input_all = input_all
+        self._decoder = codecs.getincrementaldecoder(encoding)("replace")
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def count_acceptable(self):
+        if self._input_all:
+            return len(self._buf) - self._pos
+        return sum(1 for ch in self._buf[self._pos:] if Comet2.is_printable(ch))
+
+    def is_ready(self):
+        return self._eof or self.count_acceptable() >= 256
+
+    async def fill(self):
+        while not self.is_ready():
+            data = await self._reader.read(4096)
+            if data == b"":
+                self._buf += self._decoder.decode(b"", True)
+                self._eof = True
+            else:
+                self._buf = self._buf[self._pos:] + self._decoder.decode(data)
+                self._pos = 0
+
+    def read(self, size=1):
+        s = self._buf[self._pos:self._pos+size]
+        self._pos += len(s)
+        return s
+# End AsyncInput
+
+class AsyncOutput:
+    """
+    SVC OUTの出力をasyncio.StreamWriterに書き込む
+    """
+    def __init__(self, writer, encoding="utf-8"):
+        self._writer = writer
+        self._encoding = encoding
+
+    def write(self, s):
+        self._writer.write(s.encode(self._encoding, "replace"))
+
+    async def drain(self):
+        await self._writer.drain()
+# End AsyncOutput
+
+async def run_async(c, start, end, reader=None, writer=None, quantum=1000,
+        virtual_call=False, input_all=False):
+    """
+    cをquantumステップごとに他のタスクへ処理を譲りながら実行する
+    SVC INは入力が揃うまで、他のタスクを実行しながら待つ
+    戻り値: Runtime Errorの場合None それ以外は性能カウンタ
+    """
+    fin = None if reader is None else AsyncInput(reader, input_all)
+    fout = None if writer is None else AsyncOutput(writer)
+    try:
+        c.setup(start, end, fout, None, fin, virtual_call, input_all)
+        input_ready = None if fin is None else fin.is_ready
+        while True:
+            status = c.run_steps(quantum, input_ready)
+            if fout is not None:
+                await fout.drain()
+            if status == "end":
+                break
+            if status == "input":
+                await fin.fill()
+            else:
+                await asyncio.sleep(0)
+    except SystemExit:
+        # Runtime Errorでイベントループごと終了しないようにする
+        return None
+    return c.finish()
+
+async def serve_unix(path, mem, start, end, quantum=1000, virtual_call=False, input_all=False,
+        simple_output=False, svc_ext=False, hooks=(), max_steps=None):
+    """
+    UNIXドメインソケットpathで待ち受け、接続ごとにmemの複製で実行する
+    hooks: [(番地, 処理, 名前), ...] (--hle)
+    max_steps: 接続ごとの最大ステップ数 (超えた場合は接続を閉じる)
+    """
+    async def handle(reader, writer):
+        c = Comet2([Element(e.value, e.line, e.vlabel, e.label) for e in mem], False, simple_output)
+        if svc_ext:
+            c.enable_svc_ext()
+        for adr, func, name in hooks:
+            c.register_hook(adr, func, name)
+        if max_steps is not None:
+            c.set_max_steps(max_steps)
+        try:
+            await run_async(c, start, end, reader, writer, quantum, virtual_call, input_all)
+        finally:
+            writer.close()
+    server = await asyncio.start_unix_server(handle, path)
+    async with server:
+        await server.serve_forever()
+
+class ResultCache:
+    """
+    実行結果をディレクトリに保存し、同じプログラム、初期値、入力での実行結果を再利用する
+    合計サイズがmax_sizeを超えた場合、最も長く使用していない結果から削除する
+    """
+    def __init__(self, directory, max_size=64*1024*1024):
+        self._dir = pathlib.Path(directory)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._max_size = max_size
+
+    @staticmethod
+    def make_key(mem, regs, settings, instr):
+        """
+        regs: (grlist, sp, zf, sf, of)  settings: 実行結果に影響する設定の辞書  instr: 入力 (入力なしの場合None)
+        """
+        h = hashlib.sha256()
+        h.update(array.array("H", [elem.value for elem in mem]).tobytes())
+        h.update(json.dumps([regs, settings], sort_keys=True).encode())
+        if instr is not None:
+            h.update(b"\0" + instr.encode("utf-8", "surrogateescape"))
+        return h.hexdigest()
+
+    def get(self, key):
+        path = self._dir / f"{key}.json"
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        return result
+
+    def put(self, key, result):
+        path = self._dir / f"{key}.json"
+        tmp = self._dir / f"{key}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self._dir.glob("*.json"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_size:
+                break
+            with contextlib.suppress(OSError):
+                path.unlink()
+            total -= size
+# End ResultCache
+
+def run_cached(cache, key, c, start, end, fout, fin, virtual_call=False, input_all=False):
+    """
+    キャッシュに結果があれば実行せずに出力し、無ければ実行して結果を保存する
+    (デバッグ出力が無効の場合のみ使用できる)
+    """
+    result = cache.get(key)
+    if result is None:
+        buf = io.StringIO()
+        ferr = io.StringIO()
+        error = None
+        try:
+            with contextlib.redirect_stderr(ferr):
+                # 出力が無効の場合も結果を共有できるよう常に出力を保存する
+                c.run(start, end, buf, None, fin, virtual_call, input_all)
+        except SystemExit:
+            error = ferr.getvalue()
+        gr, sp, zf, sf, of = c.get_state()
+        result = {"output": buf.getvalue(), "error": error,
+                "gr": gr, "sp": sp, "zf": zf, "sf": sf, "of": of, "counters": c.get_counters()}
+        cache.put(key, result)
+    if fout is not None:
+        fout.write(result["output"])
+    if result["error"] is not None:
+        sys.stderr.write(result["error"])
+        sys.exit(1)
+    return result
+
+class CostModel:
+    """
+    命令ごとのサイクル数の見積もり表
+    ops:     {命令名: サイクル数} 命令名はLD, LD_REG等 指定のない命令はdefaultを使用する
+    indexed: 指標レジスタで修飾した場合の追加サイクル数
+    memory:  メモリを読み書きする命令の追加サイクル数
+    """
+    # メモリを読み書きする命令 (LAD, シフト, 分岐を除く2word命令、スタック操作)
+    OPS_MEM_ACCESS = frozenset((0x10, 0x11, 0x20, 0x21, 0x22, 0x23, 0x30, 0x31, 0x32,
+        0x40, 0x41, 0x70, 0x71, 0x80, 0x81))
+
+    def __init__(self, ops=None, default=1, indexed=0, memory=0):
+        self._ops = {} if ops is None else ops
+        self._default = default
+        self._indexed = indexed
+        self._memory = memory
+
+    @staticmethod
+    def load(f):
+        """
+        JSON形式 {"ops": {...}, "default": n, "indexed": n, "memory": n} を読み込む
+        """
+        d = json.load(f)
+        return CostModel(d.get("ops"), d.get("default", 1), d.get("indexed", 0), d.get("memory", 0))
+
+    def build_table(self, op_table):
+        """
+        命令の1word目の値からサイクル数を引く表を生成する
+        """
+        base = [self._default] * 256
+        for op, handler in op_table.items():
+            base[op] = self._ops.get(handler.__name__[3:], self._default)
+            if op in self.OPS_MEM_ACCESS:
+                base[op] += self._memory
+        table = []
+        for op in range(256):
+            # 下位4bitが指標レジスタ
+            row = [base[op]] * 16
+            if op in Comet2.OPS_2WORD and op != 0xf0:
+                row = [base[op]] + [base[op] + self._indexed] * 15
+            table.extend(row * 16)
+        return table
+# End CostModel
+
+class CostProfile:
+    """
+    見積もったサイクル数を全体、ラベルごと、サブルーチンごとに集計する
+    ラベルごとの値はその番地以前で最も近いラベルに加算する
+    サブルーチンごとの値はCALL先の番地単位で、self(呼び出し先を含まない)とtotal(含む)を集計する
+    ラベルのないCALL先は最も近いラベルからのオフセット ("SUB+2") で表す
+    """
+    def __init__(self, table, mem, start=0, symbols=None):
+        self._table = table
+        self._symbols = symbols if symbols is not None else SymbolIndex.from_mem(mem)
+        self.total = 0
+        # 番地ごとの最も近いラベル名のキャッシュ
+        self._labels = {}
+        self.by_label = {}
+        self.by_routine_self = {}
+        self.by_routine_total = {}
+        # 実行中のサブルーチン [(サブルーチン名, 開始時のtotal), ...]
+        self._calls = [(self.routine_name(start & Comet2.ADR_MAX), 0)]
+        # 次のCALLがフック(--hle)で処理された (RETを実行しない)
+        self._skip_call = False
+
+    def routine_name(self, adr):
+        sym = self._symbols.format(adr)
+        return f"{adr:04x}" if sym is None else sym
+
+    def skip_call(self):
+        """
+        次に記録するCALLはフックで処理されたため、サブルーチンの集計を開始しない
+        """
+        self._skip_call = True
+
+    def record(self, word, inst_adr, pr):
+        c = self._table[word]
+        self.total += c
+        try:
+            label = self._labels[inst_adr]
+        except KeyError:
+            sym = self._symbols.lookup(inst_adr)
+            label = self._labels[inst_adr] = None if sym is None else sym[0]
+        self.by_label[label] = self.by_label.get(label, 0) + c
+        routine = self._calls[-1][0]
+        self.by_routine_self[routine] = self.by_routine_self.get(routine, 0) + c
+        op = word >> 8
+        if op == 0x80: # CALL
+            if self._skip_call:
+                self._skip_call = False
+                return
+            self._calls.append((self.routine_name(pr), self.total))
+        elif op == 0x81 and len(self._calls) > 1: # RET
+            routine, total = self._calls.pop()
+            # 再帰呼び出しの場合は最も外側の呼び出しのみ加算する
+            if all(r != routine for r, _ in self._calls):
+                self.by_routine_total[routine] = self.by_routine_total.get(routine, 0) + self.total - total
+
+    def get_report(self):
+        """
+        実行中のサブルーチンも含めた集計結果を返す
+        """
+        routine_total = dict(self.by_routine_total)
+        active = set()
+        for routine, total in self._calls:
+            if routine not in active:
+                routine_total[routine] = routine_total.get(routine, 0) + self.total - total
+                active.add(routine)
+        return {"total": self.total, "labels": dict(self.by_label),
+                "routines": {r: (c, routine_total.get(r, 0)) for r, c in self.by_routine_self.items()}}
+# End CostProfile
+
+class MemWindow:
+    """
+    ホストのファイルをmmapでメモリの一部に対応付ける
+    実行前にファイルの内容をメモリに反映し、書き込み可能な場合は実行後にメモリの内容をファイルに書き戻す
+    packing: "byte" 1byteを1wordとする "be16", "le16" 2byte(big/little endian)を1wordとする
+    """
+    def __init__(self, path, adr, writable=False, packing="byte"):
+        self._path = path
+        self._adr = adr
+        self._writable = writable
+        self._packing = packing
+        self._file = None
+        self._mmap = None
+        self._size = 0
+
+    @staticmethod
+    def parse_spec(spec):
+        """
+        "file,adr[,ro|rw][,byte|be16|le16]"からMemWindowを生成する
+        """
+        path, adr, *opts = spec.split(",")
+        writable = False
+        packing = "byte"
+        for opt in opts:
+            if opt in ("ro", "rw"):
+                writable = opt == "rw"
+            elif opt in ("byte", "be16", "le16"):
+                packing = opt
+            else:
+                raise ValueError(f"unknown option ({opt})")
+        return MemWindow(path, base_int(adr), writable, packing)
+
+    def attach(self, comet2):
+        unit = 1 if self._packing == "byte" else 2
+        self._file = open(self._path, "r+b" if self._writable else "rb")
+        length = os.fstat(self._file.fileno()).st_size
+        self._size = min(length // unit, Comet2.ADR_MAX + 1 - self._adr)
+        if self._size == 0:
+            return
+        access = mmap.ACCESS_WRITE if self._writable else mmap.ACCESS_READ
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=access)
+        comet2.load_mem(self._adr, unpack_words(self._mmap[:self._size*unit], self._packing))
+
+    def detach(self, comet2, write_back=True):
+        if self._mmap is not None:
+            if self._writable and write_back:
+                unit = 1 if self._packing == "byte" else 2
+                vals = [elem.value for elem in comet2.get_allmem()[self._adr:self._adr+self._size]]
+                self._mmap[:self._size*unit] = pack_words(vals, self._packing)
+                self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+# End MemWindow
+
+# メモリイメージの形式
+# byte: 1byteを1word be16, le16: 2byte(big/little endian)を1word hex: Intel HEX形式(番地はword単位)
+IMAGE_FORMATS = ("byte", "be16", "le16", "hex")
+
+def unpack_words(data, packing):
+    if packing == "byte":
+        return list(data)
+    words = array.array("H")
+    words.frombytes(data[:len(data)//2*2])
+    if (packing == "be16") == (sys.byteorder == "little"):
+        words.byteswap()
+    return words.tolist()
+
+def pack_words(vals, packing):
+    if packing == "byte":
+        return bytes([v & 0xff for v in vals])
+    words = array.array("H", vals)
+    if (packing == "be16") == (sys.byteorder == "little"):
+        words.byteswap()
+    return words.tobytes()
+
+def read_image(data, fmt):
+    """
+    メモリイメージを読み込み、[(番地, [値, ...]), ...]を返す
+    """
+    if fmt != "hex":
+        return [(0, unpack_words(data, fmt))]
+    segments = []
+    for n, row in enumerate(data.decode("ascii").splitlines(), 1):
+        row = row.strip()
+        if len(row) == 0:
+            continue
+        try:
+            record = bytes.fromhex(row[1:])
+        except ValueError:
+            record = b""
+        if row[0] != ":" or len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xff != 0:
+            raise ValueError(f"bad record L{n}")
+        if record[3] == 0x01:
+            break
+        if record[3] != 0x00:
+            raise ValueError(f"unsupported record type L{n}")
+        segments.append((int.from_bytes(record[1:3], "big"), unpack_words(record[4:-1], "be16")))
+    return segments
+
+def write_image(vals, fmt):
+    """
+    メモリの値をfmt形式のbytesに変換する
+    hex形式の場合、値が全て0の行は省略する
+    """
+    if fmt != "hex":
+        return pack_words(vals, fmt)
+    width = 8
+    rows = []
+    for adr in range(0, len(vals), width):
+        part = vals[adr:adr+width]
+        if not any(part):
+            continue
+        data = pack_words(part, "be16")
+        record = bytes([len(data), (adr >> 8) & 0xff, adr & 0xff, 0x00]) + data
+        record += bytes([-sum(record) & 0xff])
+        rows.append(":" + record.hex().upper())
+    rows.append(":00000001FF")
+    return ("\n".join(rows) + "\n").encode("ascii")
+
+def parse_image_spec(spec, with_offset):
+    """
+    "file[,offset][,fmt]"を(file, offset, fmt)に変換する
+    """
+    path, *opts = spec.split(",")
+    offset = 0
+    fmt = "byte"
+    for opt in opts:
+        if opt in IMAGE_FORMATS:
+            fmt = opt
+        elif with_offset:
+            offset = base_int(opt)
+        else:
+            raise ValueError(f"unknown format ({opt})")
+    return (path, offset, fmt)
+
+def print_cost(report):
+    print(f"# cycles {report['total']}")
+    for label, cycles in sorted(report["labels"].items(), key=lambda x: -x[1]):
+        print(f"# label   {str(label):10} {cycles}")
+    for routine, (cycles_self, cycles_total) in sorted(report["routines"].items(), key=lambda x: -x[1][1]):
+        print(f"# routine {routine:10} self={cycles_self} total={cycles_total}")
+    print("")
+
+def print_mem(mem, rows=None, base_vals=None, symbols=None):
+    """
+    rows:      出力する行(8word単位)の先頭番地のリスト Noneの場合は全体
+    base_vals: 指定された場合、値が異なる行のみ出力する
+    symbols:   指定された場合、行の先頭番地をラベルからのオフセットでも表示する
+    """
+    width = 8
+    vals = [m.value for m in mem]
+    data = pack_words(vals, "be16")
+    if rows is None:
+        rows = range(0, len(vals), width)
+    lines = []
+    for i in rows:
+        if base_vals is not None and vals[i:i+width] == base_vals[i:i+width]:
+            continue
+        line = f"# [{i:04x}]: {data[i*2:(i+width)*2].hex(' ', 2)}"
+        sym = symbols.format(i) if symbols is not None else None
+        lines.append(line if sym is None else f"{line}  ; {sym}")
+    lines.append("")
+    sys.stdout.write("\n".join(lines) + "\n")
+
+def parse_mem_ranges(spec, labels):
+    """
+    "adr[:adr],..."を出力する行の先頭番地のリストに変換する
+    adrは数値、ラベルまたはラベル+数値
+    """
+    width = 8
+    rows = set()
+    for item in spec.split(","):
+        start, _, end = item.partition(":")
+        start = parse_adr(start, labels)
+        end = start if end == "" else parse_adr(end, labels)
+        rows.update(range(start - start % width, end + 1, width))
+    return sorted(rows)
+
+def parse_adr(expr, labels):
+    name, _, offset = expr.strip().partition("+")
+    if labels.get(name) is not None:
+        adr = labels[name]
+    else:
+        adr = base_int(name)
+    if offset != "":
+        adr += base_int(offset)
+    if adr < 0 or Comet2.ADR_MAX < adr:
+        raise ValueError(f"address out of range ({expr})")
+    return adr
+
+def write_coverage(path, srcname, coverage, code_lines, append=False):
+    records = {}
+    if append and os.path.exists(path):
+        with open(path) as f:
+            records = Coverage.read_lcov(f)
+    lines, branches = coverage.get_records(code_lines)
+    Coverage.merge_records(records, srcname, lines, branches)
+    with open(path, "w") as f:
+        Coverage.write_lcov(f, records)
+
+def watch(args, interval=0.2):
+    """
+    asmfileが更新されるたびにアセンブルと実行をやり直す (Ctrl-Cで終了)
+    変更されていない行はIncrementalParserで前回の解析結果を再利用する
+    """
+    p = IncrementalParser(args.start_offset)
+    mtime = None
+    while True:
+        try:
+            new_mtime = os.stat(args.asmfile).st_mtime_ns
+        except OSError:
+            new_mtime = mtime
+        if new_mtime == mtime:
+            time.sleep(interval)
+            continue
+        mtime = new_mtime
+        with open(args.asmfile) as f:
+            lines = f.readlines()
+        assemble_start = time.perf_counter()
+        try:
+            p.parse(lines)
+        except SystemExit:
+            continue
+        elapsed = (time.perf_counter() - assemble_start) * 1000
+        print(f"# {args.asmfile}: {p.get_encoded_lines()}/{len(lines)} lines parsed " +
+                f"({elapsed:.1f}ms)", flush=True)
+        c = Comet2(p.get_mem(), args.print_regs, args.simple_output)
+        grlist = [args.gr0, args.gr1, args.gr2, args.gr3,
+                args.gr4, args.gr5, args.gr6, args.gr7]
+        c.init_regs(grlist, 0, args.sp, args.zf, args.sf, args.of)
+        if args.svc_ext:
+            c.enable_svc_ext()
+        if args.max_steps is not None:
+            c.set_max_steps(args.max_steps)
+        start = p.get_start() if args.start is None else args.start
+        end = p.get_end() if args.end is None else args.end
+        with contextlib.ExitStack() as stack:
+            fout = None if args.output == "" else sys.stdout
+            if args.output:
+                fout = stack.enter_context(open(args.output, "w"))
+            fdbg = None if args.output_debug == "" else sys.stdout
+            if args.output_debug:
+                fdbg = stack.enter_context(open(args.output_debug, "w"))
+            fin = None
+            if args.input_src:
+                fin = stack.enter_context(open(args.input_src))
+            try:
+                c.run(start, end, fout, fdbg, fin, args.virtual_call, args.input_all)
+            except SystemExit:
+                pass
+        sys.stdout.flush()
+
+def run_lanes(args, mem, start, end):
+    inputs = []
+    for path in args.lanes:
+        with open(path) as f:
+            inputs.append(f.read())
+    grlist = [args.gr0, args.gr1, args.gr2, args.gr3, args.gr4, args.gr5, args.gr6, args.gr7]
+    lanes = Comet2Lanes(mem, inputs, grlist, args.sp, args.input_all)
+    results = lanes.run(start, end, args.virtual_call, args.max_steps)
+    for path, result in zip(args.lanes, results):
+        print(f"# lane {path} (steps={result['steps']})")
+        for msg in result["output"]:
+            if args.simple_output:
+                sys.stdout.write(msg)
+            else:
+                sys.stdout.write(f"  OUT: {msg}\n")
+        if result["error"] is not None:
+            print(f"Runtime Error: {result['error']} ({path})", file=sys.stderr)
+
+def write_image_file(path, mem, fmt):
+    with open(path, "wb") as f:
+        f.write(write_image([elem.value for elem in mem], fmt))
+
+def assemble(path, start_offset=0):
+    p = Parser(start_offset)
+    with open(path) as f:
+        p.parse(f)
+    return p
+
+def build_object(src):
+    p = ObjectParser()
+    p.parse(io.StringIO(src))
+    return p.get_object()
+
+def build_object_worker(src):
+    """
+    プロセスプールでbuild_object()を実行する
+    エラーの場合、プロセスを終了せずに(None, エラーメッセージ)を返す
+    """
+    ferr = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(ferr):
+            return (build_object(src), None)
+    except SystemExit:
+        return (None, ferr.getvalue())
+
+def assemble_objects(paths, cache_dir=None, jobs=1):
+    """
+    pathsの各モジュールをオブジェクトにアセンブルする ('-': stdin)
+    cache_dirを指定した場合、ソースの内容が同じであれば保存したオブジェクトを使用する
+    jobsが2以上の場合、保存されていないモジュールをjobs個のプロセスで並列にアセンブルする
+    """
+    srcs = []
+    for path in paths:
+        if path == "-":
+            srcs.append(sys.stdin.read())
+        else:
+            with open(path) as f:
+                srcs.append(f.read())
+    cache_paths = [None] * len(paths)
+    objects = [None] * len(paths)
+    if cache_dir is not None:
+        for i, src in enumerate(srcs):
+            key = hashlib.sha256((ObjectParser.OBJECT_FORMAT + "\0" + src).encode()).hexdigest()
+            cache_paths[i] = pathlib.Path(cache_dir) / f"{key}.json"
+            with contextlib.suppress(OSError, ValueError):
+                with open(cache_paths[i]) as f:
+                    objects[i] = json.load(f)
+    misses = [i for i, obj in enumerate(objects) if obj is None]
+    if jobs > 1 and len(misses) > 1:
+        with multiprocessing.Pool(min(jobs, len(misses))) as pool:
+            results = pool.map(build_object_worker, [srcs[i] for i in misses])
+        for i, (obj, err) in zip(misses, results):
+            if obj is None:
+                sys.stderr.write(err)
+                sys.exit(1)
+            objects[i] = obj
+    else:
+        for i in misses:
+            objects[i] = build_object(srcs[i])
+    for i in misses:
+        if cache_paths[i] is not None:
+            cache_paths[i].parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache_paths[i].with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(objects[i], f)
+            os.replace(tmp, cache_paths[i])
+    return objects
+
+def assemble_object(path, cache_dir=None):
+    return assemble_objects([path], cache_dir)[0]
+
+def compare_cost(asmfiles, inputs, model, start_offset=0, virtual_call=False, input_all=False):
+    """
+    各プログラムを同じ入力で実行し、見積もったサイクル数を返す
+    {asmfile: [入力ごとのサイクル数, ...]}
+    アセンブルまたは実行でエラーになった場合、サイクル数をNoneとする (エラーメッセージは標準エラー出力に出力する)
+    """
+    result = {}
+    for asmfile in asmfiles:
+        try:
+            p = assemble(asmfile, start_offset)
+        except SystemExit:
+            result[asmfile] = [None] * len(inputs)
+            continue
+        mem = p.get_mem()
+        symbols = SymbolIndex(p.get_labels())
+        result[asmfile] = []
+        for instr in inputs:
+            c = Comet2([Element(e.value, e.line, e.vlabel, e.label) for e in mem])
+            c.set_symbols(symbols)
+            cost = c.enable_cost(model, p.get_start())
+            try:
+                c.run(p.get_start(), p.get_end(), None, None, io.StringIO(instr), virtual_call, input_all)
+            except SystemExit:
+                result[asmfile].append(None)
+                continue
+            result[asmfile].append(cost.total)
+    return result
+
+def load_hle_hooks(path):
+    """
+    pathのPythonファイルを読み込み、HLE_HOOKSを返す
+    """
+    spec = importlib.util.spec_from_file_location(pathlib.Path(path).stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.HLE_HOOKS
+
+def resolve_hle_hooks(paths, labels):
+    """
+    pathsのHLE_HOOKSを[(番地, 処理, 名前), ...]に変換する
+    ラベルが定義されていない場合ValueErrorを送出する
+    """
+    hooks = []
+    for path in paths:
+        for key, func in load_hle_hooks(path).items():
+            if not isinstance(key, str):
+                hooks.append((key, func, None))
+                continue
+            adr = labels.get(key)
+            if adr is None:
+                raise ValueError(f"undefined label in {path} ({key})")
+            hooks.append((adr, func, key))
+    return hooks
 
 def base_int(nstr):
     return int(nstr, 0)
@@ -999,17 +4004,92 @@ def main():
             help="ラベルのアドレス一覧を出力する")
     gasm.add_argument("-b", "--print-bin", action="store_true", help="アセンブル後のバイナリを出力する")
     gasm.add_argument("-a", "--parse-only", action="store_true", help="実行せずに終了する")
+    gasm.add_argument("--stream", action="store_true",
+            help="解析済みの行を保持せずにアセンブルする " +
+            "(デバッグ出力に値の由来のラベルを表示しない --coverageは使用できない)")
+    gasm.add_argument("--link", nargs="+",
+            help="asmfileとfileをそれぞれアセンブルしてリンクする " +
+            "(STARTのラベルでCALLできる 定数は共通化する)", metavar="file")
+    gasm.add_argument("--obj-cache",
+            help="--linkでアセンブルしたオブジェクトをdirに保存し、ソースが同じ場合は再利用する", metavar="dir")
+    gasm.add_argument("-j", "--jobs", type=base_int, default=1,
+            help="--linkでn個のプロセスで並列にアセンブルする", metavar="n")
+    gasm.add_argument("-O", "--optimize", action="store_true",
+            help="アセンブル後に覗き穴最適化をする (連続したIN, OUTの間のPOP, PUSHの削除、" +
+            "STの直後のLDの削除、JUMPへの分岐の短縮)")
+    gasm.add_argument("--cfg",
+            help="アセンブル後(-Oの場合最適化後)の命令の開始番地、基本ブロック、CALLの飛び先、" +
+            "データ領域をfileに出力する (fmt: json, dot)", metavar="file[,fmt]")
     gasm.add_argument("--load-data",
             help="アセンブル後に0番地からfileの内容を1byteずつ書き込む", metavar="file")
     gasm.add_argument("--load-data-offset", type=base_int, default=0,
             help="--load-dataオプションの開始番地", metavar="n")
+    gasm.add_argument("--mmap", action="append", default=[],
+            help="fileをmmapでadrからの領域に対応付ける " +
+            "(rw: 実行後にfileへ書き戻す, be16/le16: 2byteを1wordとする)",
+            metavar="file,adr[,ro|rw][,byte|be16|le16]")
+    gasm.add_argument("--load-image", action="append", default=[],
+            help="アセンブル後にoffset番地からfileの内容を書き込む (fmt: byte, be16, le16, hex)",
+            metavar="file[,offset][,fmt]")
     grun = parser.add_argument_group("runtime optional arguments")
-    grun.add_argument("-R", "--print-regs", action="store_true", help="実行前後にレジスタの内容を表示する")
+    grun.add_argument("-R", "--print-regs", action="store_true", help="実行前後にレジスタの内容を、実行後に性能カウンタを表示する")
     grun.add_argument("-M", "--print-mem", action="store_true", help="実行後にメモリの内容を表示する")
+    grun.add_argument("--mem-range", metavar="adr[:adr],...",
+            help="実行後にメモリの指定した範囲を表示する (adrは数値、ラベル、ラベル+数値)")
+    grun.add_argument("--mem-diff", action="store_true",
+            help="実行後にメモリの読み込み時から変化した行のみ表示する")
+    grun.add_argument("--save-image", help="実行後(-aの場合アセンブル後)のメモリの内容をfileに出力する",
+            metavar="file[,fmt]")
     grun.add_argument("--input-src", help="実行時の入力元 (default: stdin)", metavar="file")
     grun.add_argument("--simple-output", action="store_true", help="実行時の出力をそのまま出力する")
+    grun.add_argument("--record-input",
+            help="SVC INで読み込んだ文字を実行ステップ数とともにfileに記録する", metavar="file")
+    grun.add_argument("--replay-input",
+            help="--record-inputで記録したfileをSVC INの入力とする (実行ステップ数が異なる場合はエラー)",
+            metavar="file")
+    grun.add_argument("--checkpoint-every", type=base_int,
+            help="nステップごとに実行中の状態を--checkpoint-fileに保存する", metavar="n")
+    grun.add_argument("--checkpoint-file", help="チェックポイントの保存先", metavar="file")
+    grun.add_argument("--resume",
+            help="--checkpoint-fileで保存した状態から実行を再開する (asmfileと入力、--outputは保存時と同じものを指定する asmfileが異なる場合はエラー)",
+            metavar="file")
     grun.add_argument("--output", help="実行時の出力先 (default: stdout)", metavar="file")
     grun.add_argument("--output-debug", help="実行時のデバッグ出力先 (default: stdout)", metavar="file")
+    grun.add_argument("--coverage", help="実行した行と分岐をlcov形式でfileに出力する", metavar="file")
+    grun.add_argument("--coverage-append", action="store_true",
+            help="--coverageの出力先が既に存在する場合、その結果に加算する")
+    grun.add_argument("--fusion", action="store_true",
+            help="よく現れる命令列をまとめて実行する (デバッグ出力等が無効の場合のみ)")
+    grun.add_argument("--cost-table",
+            help="fileのサイクル数の表(JSON)で実行時間を見積もる", metavar="file")
+    grun.add_argument("--cost-compare", nargs="+",
+            help="asmfileとfileを同じ入力で実行し、見積もったサイクル数を比較する", metavar="file")
+    grun.add_argument("--cost-inputs", nargs="+", default=[],
+            help="--cost-compareで使用する入力ファイル (default: 入力なし)", metavar="file")
+    grun.add_argument("--lanes", nargs="+",
+            help="fileごとにレーンを用意し、同時に実行して結果を出力する (numpyが必要)", metavar="file")
+    grun.add_argument("--max-steps", type=base_int,
+            help="実行するステップ数の上限 (超えた場合Runtime Error)", metavar="n")
+    grun.add_argument("--fuzz", help="SVC INの入力を変異させて実行し、結果をdirに保存する", metavar="dir")
+    grun.add_argument("--fuzz-jobs", type=base_int, default=os.cpu_count(),
+            help="--fuzzで使用するプロセス数 (default: CPU数)", metavar="n")
+    grun.add_argument("--fuzz-runs", type=base_int, default=10000,
+            help="--fuzzで各プロセスが実行する回数", metavar="n")
+    grun.add_argument("--fuzz-seed", type=base_int,
+            help="--fuzzの乱数のシード (default: 実行ごとにランダム)", metavar="n")
+    grun.add_argument("--cache", help="実行結果をdirに保存し、同じプログラムと入力での実行では再利用する " +
+            "(--output-debug=\"\"の場合のみ 入力は終端まで読み込んでから実行する)", metavar="dir")
+    grun.add_argument("--cache-size", type=base_int, default=64*1024*1024,
+            help="--cacheの最大サイズ(byte)", metavar="n")
+    grun.add_argument("--serve", help="UNIXドメインソケットpathで待ち受け、接続ごとに実行する " +
+            "(入出力は接続を使用する)", metavar="path")
+    grun.add_argument("--quantum", type=base_int, default=1000,
+            help="--serveで他の接続に処理を譲るまでに実行するステップ数", metavar="n")
+    grun.add_argument("--watch", action="store_true",
+            help="asmfileが更新されるたびにアセンブルと実行をやり直す " +
+            "(入力は--input-srcのみ 実行時の基本的なオプションのみ有効)")
+    grun.add_argument("--postmortem", type=base_int,
+            help="異常終了時に直前のnステップの実行履歴を表示する", metavar="n")
     grun.add_argument("--start", type=base_int, help="プログラム開始アドレス", metavar="n")
     grun.add_argument("--end", type=base_int, help="プログラム終了アドレス", metavar="n")
     grun.add_argument("--gr0", type=base_int, default=0, help="GR0の初期値", metavar="n")
@@ -1028,20 +4108,95 @@ def main():
     gext.add_argument("-C", "--virtual-call", action="store_true",
             help="実行前にENDのアドレスをスタックに積む")
     gext.add_argument("--input-all", action="store_true", help="INでの入力は全ての文字を受け付ける")
+    gext.add_argument("--svc-ext", action="store_true",
+            help="拡張SVC (0x10:COPY 0x11:FILL 0x12:CMP 0x13:OUTW) を使用する")
+    gext.add_argument("--hle", action="append", default=[],
+            help="fileのHLE_HOOKS {ラベルまたは番地: 処理} でCALL先をPythonの処理に置き換える",
+            metavar="file")
+    gext.add_argument("--hle-verify", action="store_true",
+            help="--hleの処理と本来のサブルーチンを両方実行して結果を比較する")
 
     # レジスタ、メモリの値はデフォルトでは0
     # --virtual-call: RETで終了するような、STARTのラベル呼び出しを前提としたコードを正常終了させる
 
     args = parser.parse_args()
+    try:
+        windows = [MemWindow.parse_spec(spec) for spec in args.mmap]
+    except ValueError as e:
+        parser.error(f"argument --mmap: {e}")
+    try:
+        load_images = [parse_image_spec(spec, True) for spec in args.load_image]
+        save_image = None
+        if args.save_image is not None:
+            save_image = parse_image_spec(args.save_image, False)
+    except ValueError as e:
+        parser.error(f"argument --load-image/--save-image: {e}")
+    cfg_spec = None
+    if args.cfg is not None:
+        path, *opts = args.cfg.split(",")
+        if len(opts) > 1 or any(opt not in ("json", "dot") for opt in opts):
+            parser.error(f"argument --cfg: unknown format ({','.join(opts)})")
+        cfg_spec = (path, opts[0] if len(opts) != 0 else "json")
 
-    p = Parser(args.start_offset)
-    with contextlib.ExitStack() as stack:
+    if args.optimize and (args.stream or args.load_data is not None or
+            len(load_images) != 0 or len(windows) != 0):
+        parser.error("argument -O/--optimize: not allowed with --stream, --load-data, --load-image, --mmap")
+    if args.stream and args.coverage is not None:
+        parser.error("argument --coverage: not allowed with --stream")
+    # --serveはSVC INで入力を待つため命令列の融合を使用できない
+    if args.serve is not None and (args.fusion or args.hle_verify):
+        parser.error("argument --serve: not allowed with --fusion, --hle-verify")
+
+    if (args.checkpoint_every is None) != (args.checkpoint_file is None):
+        parser.error("argument --checkpoint-every: --checkpoint-every and --checkpoint-file are both required")
+    if args.resume is not None and (args.record_input is not None or len(windows) != 0):
+        parser.error("argument --resume: not allowed with --record-input, --mmap")
+
+    if args.watch:
         if args.asmfile == "-":
-            f = sys.stdin
-        else:
-            f = stack.enter_context(open(args.asmfile))
-        used_stdin = f == sys.stdin
-        p.parse(f)
+            parser.error("argument --watch: not allowed with asmfile '-'")
+        with contextlib.suppress(KeyboardInterrupt):
+            watch(args)
+        return
+
+    cost_model = None
+    if args.cost_table is not None:
+        with open(args.cost_table) as f:
+            cost_model = CostModel.load(f)
+    if args.cost_compare is not None:
+        # 入力ごとにアセンブルし直すため標準入力は使用できない
+        if "-" in [args.asmfile] + args.cost_compare:
+            parser.error("argument --cost-compare: not allowed with asmfile '-'")
+        inputs = []
+        for path in args.cost_inputs:
+            with open(path) as f:
+                inputs.append(f.read())
+        if len(inputs) == 0:
+            inputs.append("")
+        asmfiles = [args.asmfile] + args.cost_compare
+        result = compare_cost(asmfiles, inputs, cost_model or CostModel(),
+                args.start_offset, args.virtual_call, args.input_all)
+        names = args.cost_inputs if len(args.cost_inputs) != 0 else ["-"]
+        for asmfile, costs in result.items():
+            detail = " ".join([f"{name}={'error' if cost is None else cost}" for name, cost in zip(names, costs)])
+            total = "error" if None in costs else sum(costs)
+            print(f"# {asmfile:20} total={total} {detail}")
+        return
+
+    if args.link is not None:
+        objects = assemble_objects([args.asmfile] + args.link, args.obj_cache, args.jobs)
+        p = Linker(args.start_offset)
+        p.link(objects)
+        used_stdin = args.asmfile == "-"
+    else:
+        p = StreamParser(args.start_offset) if args.stream else Parser(args.start_offset)
+        with contextlib.ExitStack() as stack:
+            if args.asmfile == "-":
+                f = sys.stdin
+            else:
+                f = stack.enter_context(open(args.asmfile))
+            used_stdin = f == sys.stdin
+            p.parse(f)
     if args.start is None:
         start = p.get_start()
     else:
@@ -1054,8 +4209,21 @@ def main():
     if args.load_data is not None:
         with open(args.load_data, "rb") as f:
             p.load_data(f, args.load_data_offset)
+    for path, offset, fmt in load_images:
+        with open(path, "rb") as f:
+            p.load_data(f, offset, fmt)
 
     mem = p.get_mem()
+    if args.optimize and Optimizer(mem, start).optimize() is None:
+        print("System Warning: optimization skipped (code is reachable by computed address)",
+                file=sys.stderr)
+    mem_rows = None
+    if args.mem_range is not None:
+        try:
+            mem_rows = parse_mem_ranges(args.mem_range, p.get_labels())
+        except ValueError as e:
+            parser.error(f"argument --mem-range: {e}")
+    print_mem_enabled = args.print_mem or args.mem_range is not None or args.mem_diff
 
     if args.print_labels:
         labeldict = p.get_labels()
@@ -1065,20 +4233,83 @@ def main():
             print(f"# {label:10} [{adr:04x}]")
         print("")
 
+    symbols = SymbolIndex(p.get_labels())
     if args.print_bin:
-        print_mem(mem)
+        print_mem(mem, symbols=symbols)
+
+    if cfg_spec is not None:
+        index = ControlFlowIndex(mem, start, p.get_labels(), p.get_code_lines())
+        with open(cfg_spec[0], "w") as f:
+            index.write(f, cfg_spec[1])
 
     if args.parse_only:
+        if save_image is not None:
+            write_image_file(save_image[0], mem, save_image[2])
+        return
+
+    if args.lanes is not None:
+        run_lanes(args, mem, start, end)
+        return
+
+    try:
+        hooks = resolve_hle_hooks(args.hle, p.get_labels())
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.serve is not None:
+        with contextlib.suppress(KeyboardInterrupt):
+            asyncio.run(serve_unix(args.serve, Comet2(mem).get_allmem(), start, end, args.quantum,
+                    args.virtual_call, args.input_all, args.simple_output,
+                    args.svc_ext, hooks, args.max_steps))
+        return
+
+    if args.fuzz is not None:
+        max_steps = 1000000 if args.max_steps is None else args.max_steps
+        seed = random.randrange(1 << 32) if args.fuzz_seed is None else args.fuzz_seed
+        # --mmapのファイルの内容を読み込んだイメージを共有する (書き戻しはしない)
+        image = Comet2(mem)
+        try:
+            for window in windows:
+                window.attach(image)
+        finally:
+            for window in windows:
+                window.detach(image, False)
+        runs, added, crashes = fuzz(image.get_allmem(), start, end, p.get_labels(), args.fuzz,
+                args.fuzz_jobs, args.fuzz_runs, args.virtual_call, args.input_all, max_steps, seed,
+                args.svc_ext, args.hle)
+        print(f"# fuzz runs={runs} corpus+={added} crashes={crashes} seed={seed}")
         return
 
     c = Comet2(mem, args.print_regs, args.simple_output)
+    c.set_symbols(symbols)
+    base_vals = None
     grlist = [args.gr0, args.gr1, args.gr2, args.gr3,
             args.gr4, args.gr5, args.gr6, args.gr7]
     c.init_regs(grlist, 0, args.sp, args.zf, args.sf, args.of)
+    for adr, func, name in hooks:
+        c.register_hook(adr, func, name)
+    if args.hle_verify:
+        c.enable_hook_verify()
+    if args.svc_ext:
+        c.enable_svc_ext()
+    if args.fusion:
+        c.enable_fusion()
+    if args.max_steps is not None:
+        c.set_max_steps(args.max_steps)
+    if args.postmortem is not None:
+        c.enable_postmortem(args.postmortem)
+    if args.coverage is not None:
+        c.enable_coverage()
+    if cost_model is not None:
+        c.enable_cost(cost_model, start)
     with contextlib.ExitStack() as stack:
         fout = sys.stdout
         if args.output == "":
             fout = None
+        elif args.output and args.resume is not None and os.path.exists(args.output):
+            # 保存時以降の出力は再開後に出力し直す
+            fout = stack.enter_context(open(args.output, "r+"))
         elif args.output:
             fout = stack.enter_context(open(args.output, "w"))
         fdbg = sys.stdout
@@ -1093,12 +4324,84 @@ def main():
             fin = None
         elif args.input_src:
             fin = stack.enter_context(open(args.input_src))
-        elif used_stdin:
+        elif used_stdin and args.replay_input is None:
             print("System Warning: both asmfile and input-src are stdin", file=sys.stderr)
-        c.run(start, end, fout, fdbg, fin, args.virtual_call, args.input_all)
+        if args.record_input is not None:
+            c.enable_input_record(InputRecorder(stack.enter_context(open(args.record_input, "wb"))))
+        replay = None
+        if args.replay_input is not None:
+            try:
+                replay = InputReplay(stack.enter_context(open(args.replay_input, "rb")))
+            except ValueError as e:
+                parser.error(f"argument --replay-input: {e}")
+            c.enable_input_replay(replay)
+        virtual_call = args.virtual_call
+        if args.resume is not None:
+            if args.mem_diff:
+                # 再開時も実行開始前のプログラムとの差分を出力する
+                base_vals = [elem.value for elem in c.get_allmem()]
+            try:
+                positions = c.load_checkpoint(args.resume)
+            except (OSError, ValueError) as e:
+                parser.error(f"argument --resume: {e}")
+            start = c.get_pr()
+            end = c.get_end()
+            virtual_call = False
+            # 標準出力は保存時と同じファイルとは限らないため位置を戻さない
+            files = (("output", fout if args.output else None, positions["out"]),
+                    ("input", fin, positions["in"]),
+                    ("replay input", None if replay is None else replay.get_file(), positions["replay"]))
+            for name, f, pos in files:
+                if f is None or pos is None:
+                    continue
+                if not f.seekable():
+                    print(f"System Warning: cannot seek {name} to the checkpoint", file=sys.stderr)
+                    continue
+                f.seek(pos)
+                if f is fout:
+                    f.truncate()
+        if args.checkpoint_every is not None:
+            c.enable_checkpoint(args.checkpoint_every, args.checkpoint_file)
+        use_cache = (args.cache is not None and fdbg is None and len(windows) == 0 and
+                len(args.hle) == 0 and args.coverage is None and cost_model is None and
+                args.postmortem is None and not print_mem_enabled and save_image is None and
+                args.record_input is None and args.replay_input is None and
+                args.checkpoint_every is None and args.resume is None)
+        if use_cache:
+            instr = None if fin is None else fin.read()
+            regs = (grlist, args.sp, args.zf, args.sf, args.of)
+            settings = {"start": start, "end": end, "virtual_call": args.virtual_call,
+                    "input_all": args.input_all, "simple_output": args.simple_output,
+                    "svc_ext": args.svc_ext, "max_steps": args.max_steps}
+            key = ResultCache.make_key(c.get_allmem(), regs, settings, instr)
+            run_cached(ResultCache(args.cache, args.cache_size), key, c, start, end, fout,
+                    None if instr is None else io.StringIO(instr), args.virtual_call, args.input_all)
+            return
+        completed = False
+        try:
+            # 途中で失敗した場合も対応付け済みのものはfinallyで解除する
+            for window in windows:
+                window.attach(c)
+            if args.mem_diff and base_vals is None:
+                base_vals = [elem.value for elem in c.get_allmem()]
+            c.run(start, end, fout, fdbg, fin, virtual_call, args.input_all)
+            completed = True
+        finally:
+            for window in windows:
+                window.detach(c, completed)
+            if args.coverage is not None:
+                srcname = "<stdin>" if args.asmfile == "-" else args.asmfile
+                write_coverage(args.coverage, srcname, c.get_coverage(),
+                        p.get_code_lines(), args.coverage_append)
+
+    if cost_model is not None:
+        print_cost(c.get_cost().get_report())
+
+    if save_image is not None:
+        write_image_file(save_image[0], c.get_allmem(), save_image[2])
 
-    if args.print_mem:
-        print_mem(c.get_allmem())
+    if print_mem_enabled:
+        print_mem(c.get_allmem(), mem_rows, base_vals, symbols)
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 # coding:utf-8
+import asyncio
+import contextlib
 import io
+import os
 import pathlib
 import sys
+import tempfile
 import unittest
 from unittest import mock
 
@@ -14,6 +18,25 @@ casl2sim.Element.__repr__ = \
         lambda s: f"<{s.__module__}.{type(s).__name__} " + \
         f"value={s.value:04x}, line={s.line}, label='{s.label}'>"
 
+class TestSymbolIndex(unittest.TestCase):
+    def test_format(self):
+        symbols = casl2sim.SymbolIndex({"GR0": None, "MAIN": 2, "LOOP": 5, "ALIAS": 5, "END": 9})
+        self.assertEqual([None, None, "MAIN", "MAIN+2", "ALIAS", "ALIAS+3", "END", "END+16"],
+                [symbols.format(adr) for adr in (0, 1, 2, 4, 5, 8, 9, 25)])
+        self.assertEqual(("ALIAS", 3), symbols.lookup(8))
+
+    @mock.patch("sys.stderr.write")
+    def test_postmortem(self, mock_stderr_write):
+        c = casl2sim.Comet2([casl2sim.Element(v, 0) for v in (0x1210, 0x0003, 0x0000, 0xff00)])
+        c.set_symbols(casl2sim.SymbolIndex({"MAIN": 0, "L": 2}))
+        c.enable_postmortem(1)
+        with self.assertRaises(SystemExit):
+            c.run(0, 0xffff)
+        actual = "".join(["".join(call.args) for call in mock_stderr_write.call_args_list])
+        self.assertEqual("Runtime Error: unknown operation (['L+1'=0003]: ff00)\n" +
+                "Postmortem: last 1 steps\nPM:        2 ['L+1'=0003] ff00 0000\n", actual)
+# End TestSymbolIndex
+
 class TestParser(unittest.TestCase):
     def test_parse_DC(self):
         patterns = [
@@ -116,6 +139,41 @@ class TestParser(unittest.TestCase):
                         self.assertEqual(expected_adr, actual.value, msg=f"list[{i}]")
                 self.assertEqual(expected_start, p._start)
 
+    def test_parse_line(self):
+        patterns = [
+                ("LAB  LD GR1,GR2 ; comment\n", [0x1412], {"LAB": 0}, "label, comment"),
+                ("     ST GR1,LAB,GR3\n", [0x1113, 0], {}, "3 args"),
+                ("     JUMP LAB,GR1\n", [0x6401, 0], {}, "without opr1"),
+                ("     POP GR7\n", [0x7170], {}, "1 reg"),
+                ("     RET\n", [0x8100], {}, "no args"),
+                ("     SVC 2\n", [0xf000, 2], {}, "svc"),
+                ("     DS 2\n", [0, 0], {}, "DS"),
+                ("; comment only\n", [], {}, "comment")]
+        for line, expected_vals, expected_labels, msg in patterns:
+            with self.subTest(msg):
+                p = casl2sim.Parser()
+                actual = p.parse_line(line)
+                self.assertEqual(expected_vals, [e.value for e in actual])
+                for label, adr in expected_labels.items():
+                    self.assertEqual(adr, p.get_labels()[label])
+
+    def test_load_data(self):
+        vals = [0x0102, 0x0000, 0xbeef]
+        patterns = [
+                ("byte", b"\x01\x02", 1, [0, 1, 2]),
+                ("be16", b"\x01\x02\xbe\xef", 2, [0, 0, 0x0102, 0xbeef]),
+                ("le16", b"\x01\x02\xbe\xef", 0, [0x0201, 0xefbe]),
+                ("hex", casl2sim.write_image(vals, "hex"), 1, [0] + vals)]
+        for fmt, data, offset, expected_vals in patterns:
+            with self.subTest(fmt):
+                p = casl2sim.Parser()
+                p._mem = [casl2sim.Element(0, 0)]
+                p.load_data(io.BytesIO(data), offset, fmt)
+                self.assertEqual(expected_vals, [e.value for e in p.get_mem()])
+                if fmt != "byte":
+                    actual = casl2sim.write_image(expected_vals[offset:], fmt)
+                    self.assertEqual(data, actual)
+
     @mock.patch("casl2sim.Parser.err_exit", side_effect=SystemExit(1))
     def test_resolve_labels_error(self, mock_err_exit):
         """
@@ -163,6 +221,213 @@ class TestParser(unittest.TestCase):
                 self.assertEqual(expected, actual)
 # End TestParser
 
+class TestStreamParser(unittest.TestCase):
+    ASM = ["MAIN START", "  LD GR1,DATA", "  ADDA GR1,=1", "  ST GR1,DATA",
+            "  JUMP MAIN", "DATA DC 3,'ab',MAIN,DATA", "  LD GR2,=1", "  END"]
+
+    def test_parse(self):
+        for offset in (0, 3):
+            with self.subTest(offset):
+                expected = casl2sim.Parser(offset)
+                expected.parse([line + "\n" for line in self.ASM])
+                actual = casl2sim.StreamParser(offset)
+                actual.parse([line + "\n" for line in self.ASM])
+                self.assertEqual([(e.value, e.line, e.label) for e in expected.get_mem()],
+                        [(e.value, e.line, e.label) for e in actual.get_mem()])
+                self.assertEqual((expected.get_start(), expected.get_end()),
+                        (actual.get_start(), actual.get_end()))
+                # 命令を含む行は記録しない
+                self.assertIsNone(actual.get_code_lines())
+
+    def test_parse_iter(self):
+        produced = []
+        def lines():
+            for line in self.ASM:
+                produced.append(line)
+                yield line + "\n"
+        p = casl2sim.StreamParser()
+        it = p.parse_iter(lines())
+        adr, vals, line = next(it)
+        self.assertEqual((0, [0x1010, 0], 2), (adr, list(vals), line))
+        self.assertEqual(2, len(produced))
+        writes = [(adr, list(vals), line) for adr, vals, line in it]
+        # ラベルDATA(8)の定義時に前方参照を確定し、ENDの後に定数(=1)を割り当てる
+        self.assertIn((1, [8], None), writes)
+        self.assertIn((5, [8], None), writes)
+        self.assertEqual([(15, [1], 0), (3, [15], None), (14, [15], None)], writes[-3:])
+        self.assertEqual(0, len(p._fixups))
+# End TestStreamParser
+
+class TestIncrementalParser(unittest.TestCase):
+    def test_parse(self):
+        asm = ["MAIN START", "  LD GR1,DATA", "  ADDA GR1,=1", "  ST GR1,DATA",
+                "  JUMP MAIN", "DATA DC 3", "  END"]
+        p = casl2sim.IncrementalParser()
+        p.parse([line + "\n" for line in asm])
+        self.assertEqual(7, p.get_encoded_lines())
+        asm[2:3] = ["  ADDA GR1,=2", "  SUBA GR1,GR2"]
+        p.parse([line + "\n" for line in asm])
+        self.assertEqual(2, p.get_encoded_lines())
+        expected = casl2sim.Parser()
+        expected.parse([line + "\n" for line in asm])
+        self.assertEqual([(e.value, e.line, e.vlabel, e.label) for e in expected.get_mem()],
+                [(e.value, e.line, e.vlabel, e.label) for e in p.get_mem()])
+        self.assertEqual(expected.get_labels(), p.get_labels())
+        self.assertEqual(expected.get_code_lines(), p.get_code_lines())
+# End TestIncrementalParser
+
+class TestLinker(unittest.TestCase):
+    MODULES = [
+            ["MAIN START", "  LAD GR1,3", "  CALL DOUBLE", "  ST GR1,RES", "  LD GR2,=1", "  RET",
+                "RES DS 1", "  END"],
+            ["DOUBLE START BEGIN", "TMP DS 1", "BEGIN ADDA GR1,GR1", "  ADDA GR1,=1", "  SUBA GR1,=1",
+                "  RET", "  END"]]
+
+    def get_objects(self, modules):
+        objects = []
+        for asm in modules:
+            p = casl2sim.ObjectParser()
+            p.parse([line + "\n" for line in asm])
+            objects.append(p.get_object())
+        return objects
+
+    def test_link(self):
+        objects = self.get_objects(self.MODULES)
+        self.assertEqual([["DOUBLE", [3]]], objects[0]["externs"])
+        self.assertEqual([["RES", [5]]], objects[0]["relocs"])
+        self.assertEqual([[1, [7]]], objects[0]["literals"])
+        self.assertEqual(("DOUBLE", 1), (objects[1]["name"], objects[1]["entry"]))
+        p = casl2sim.Linker(2)
+        p.link(objects)
+        self.assertEqual((2, 12), (p.get_start(), p.get_end()))
+        self.assertEqual({"MAIN": 2, "RES": 11, "DOUBLE": 13, "DOUBLE.TMP": 12, "DOUBLE.BEGIN": 13},
+                {label: adr for label, adr in p.get_labels().items() if adr is not None})
+        mem = p.get_mem()
+        # CALL DOUBLEはDOUBLEの実行開始番地、各モジュールの=1は共通の定数(19番地)を参照する
+        self.assertEqual(13, mem[5].value)
+        self.assertEqual([19, 19, 19], [mem[9].value, mem[15].value, mem[17].value])
+        self.assertEqual(1, mem[19].value)
+        c = casl2sim.Comet2(mem)
+        c.run(p.get_start(), p.get_end(), None, None, None, True)
+        self.assertEqual(6, mem[11].value)
+
+    def test_link_end(self):
+        # 先頭のモジュールのENDで終了し、後ろのモジュールを実行しない
+        main = ["MAIN START", "  LAD GR1,3", "  CALL DOUBLE", "  ST GR1,RES", "  OUT MSG,LEN",
+                "RES DS 1", "MSG DC 'hi'", "LEN DC 2", "  END"]
+        p = casl2sim.Linker()
+        p.link(self.get_objects([main, self.MODULES[1]]))
+        c = casl2sim.Comet2(p.get_mem())
+        c.set_max_steps(1000)
+        fout = io.StringIO()
+        c.run(p.get_start(), p.get_end(), fout)
+        self.assertEqual("  OUT: hi\n", fout.getvalue())
+        self.assertEqual(6, p.get_mem()[p.get_labels()["RES"]].value)
+
+    @mock.patch("casl2sim.Parser.err_exit", side_effect=SystemExit(1))
+    def test_link_defined_label(self, mock_err_exit):
+        main = ["MAIN START", "  CALL DOUBLE", "DOUBLE RET", "  END"]
+        with self.assertRaises(SystemExit):
+            casl2sim.Linker().link(self.get_objects([main, self.MODULES[1]]))
+        mock_err_exit.assert_called_once_with("defined label (L3: DOUBLE)")
+
+    @mock.patch("casl2sim.Parser.err_exit", side_effect=SystemExit(1))
+    def test_link_error(self, mock_err_exit):
+        objects = self.get_objects([self.MODULES[0]])
+        with self.assertRaises(SystemExit):
+            casl2sim.Linker().link(objects)
+        mock_err_exit.assert_called_once_with("undefined label (MAIN L3: DOUBLE)")
+
+    def test_assemble_object(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = pathlib.Path(tmpdir) / "double.casl2"
+            path.write_text("".join([line + "\n" for line in self.MODULES[1]]))
+            cache_dir = pathlib.Path(tmpdir) / "cache"
+            expected = casl2sim.assemble_object(str(path), str(cache_dir))
+            self.assertEqual(1, len(list(cache_dir.iterdir())))
+            with mock.patch("casl2sim.ObjectParser.parse") as parse:
+                self.assertEqual(expected, casl2sim.assemble_object(str(path), str(cache_dir)))
+                parse.assert_not_called()
+
+    def test_assemble_objects_jobs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for i, asm in enumerate(self.MODULES + [[" START", " FOO", " END"]]):
+                path = pathlib.Path(tmpdir) / f"m{i}.casl2"
+                path.write_text("".join([line + "\n" for line in asm]))
+                paths.append(str(path))
+            expected = self.get_objects(self.MODULES)
+            self.assertEqual(expected, casl2sim.assemble_objects(paths[:2], None, 2))
+            ferr = io.StringIO()
+            with contextlib.redirect_stderr(ferr), self.assertRaises(SystemExit):
+                casl2sim.assemble_objects(paths, None, 2)
+            self.assertEqual("Assemble Error: unknown operation (L2: FOO)\n", ferr.getvalue())
+# End TestLinker
+
+class TestControlFlowIndex(unittest.TestCase):
+    def test_index(self):
+        asm = ["MAIN START", "  LD GR1,X", "  CALL SUB", "  JZE END", "  ADDA GR1,=1", "END RET",
+                "SUB LAD GR1,1", "  RET", "X DC 3", "  END"]
+        p = casl2sim.Parser()
+        p.parse([line + "\n" for line in asm])
+        index = casl2sim.ControlFlowIndex(p.get_mem(), p.get_start(), p.get_labels(),
+                p.get_code_lines())
+        self.assertEqual([0, 2, 4, 6, 8, 9, 11], index.get_insts())
+        self.assertEqual((True, False, 2), (index.is_inst(4), index.is_inst(5), index.get_inst_size(4)))
+        self.assertEqual((4, 6), index.get_block(5))
+        self.assertIsNone(index.get_block(12))
+        self.assertEqual({9}, index.get_call_targets())
+        d = index.to_json()
+        self.assertEqual([(0, 4, [4]), (4, 6, [8, 6]), (6, 8, [8]), (8, 9, []), (9, 12, [])],
+                [(b["start"], b["end"], b["succs"]) for b in d["blocks"]])
+        self.assertEqual([(12, 14)], d["data"])
+        f = io.StringIO()
+        index.write(f, "dot")
+        self.assertIn("b0000 -> b0009 [style=dashed];", f.getvalue())
+        self.assertIn('b0009 [label="SUB\\n0009-000b"];', f.getvalue())
+# End TestControlFlowIndex
+
+class TestOptimizer(unittest.TestCase):
+    ASM = ["MAIN START", "  LD GR3,=3", "LOOP OUT MSG,LEN", "  OUT MSG,LEN", "  ST GR3,CNT",
+            "  LD GR3,CNT", "  SUBA GR3,=1", "  JUMP NEXT", "NEXT JUMP NEXT2", "NEXT2 JNZ LOOP",
+            "  RET", "MSG DC 'hi'", "LEN DC 2", "CNT DS 1", "  END"]
+
+    def run_asm(self, asm, optimize):
+        p = casl2sim.Parser()
+        p.parse([line + "\n" for line in asm])
+        mem = p.get_mem()
+        stats = casl2sim.Optimizer(mem, p.get_start()).optimize() if optimize else None
+        c = casl2sim.Comet2(mem)
+        fout = io.StringIO()
+        c.run(p.get_start(), p.get_end(), fout, None, None, True)
+        return stats, fout.getvalue(), c.get_counters()["instructions"]
+
+    def test_optimize(self):
+        _, expected_out, expected_steps = self.run_asm(self.ASM, False)
+        stats, out, steps = self.run_asm(self.ASM, True)
+        self.assertEqual({"io_macro": 1, "load_after_store": 1, "jump_thread": 1}, stats)
+        self.assertEqual(expected_out, out)
+        # ループ1回あたり POP, PUSHの4命令を1命令に、JUMPの連鎖を1命令にする
+        self.assertEqual(expected_steps - 3 * 4, steps)
+
+    def test_optimize_computed_address(self):
+        asm = self.ASM[:1] + ["  LAD GR4,LOOP"] + self.ASM[1:]
+        p = casl2sim.Parser()
+        p.parse([line + "\n" for line in asm])
+        vals = [elem.value for elem in p.get_mem()]
+        self.assertIsNone(casl2sim.Optimizer(p.get_mem(), p.get_start()).optimize())
+        self.assertEqual(vals, [elem.value for elem in p.get_mem()])
+
+    def test_optimize_flags_used(self):
+        # LDで設定したフラグをJZEで参照するため、LDは削除しない
+        asm = ["MAIN START", "  ST GR1,X", "  LD GR1,X", "  JZE END", "  LAD GR2,1", "END RET",
+                "X DS 1", "  END"]
+        p = casl2sim.Parser()
+        p.parse([line + "\n" for line in asm])
+        stats = casl2sim.Optimizer(p.get_mem(), p.get_start()).optimize()
+        self.assertEqual(0, stats["load_after_store"])
+# End TestOptimizer
+
 class TestComet2(unittest.TestCase):
     def test_op_LD_no_opr3(self):
         mem = [
@@ -906,6 +1171,66 @@ class TestComet2(unittest.TestCase):
         c.op_SVC(elem)
         self.assertEqual(expected, c._mem[:len(expected)])
 
+    def test_input_record_replay(self):
+        asm = ["MAIN START", "LOOP IN BUF,LEN", "  LD GR1,LEN", "  JZE FIN", "  OUT BUF,LEN",
+                "  JUMP LOOP", "FIN RET", "BUF DS 256", "LEN DS 1", "  END"]
+        p = casl2sim.Parser()
+        p.parse([line + "\n" for line in asm])
+        outputs = []
+        record = io.BytesIO()
+        for fusion in (False, True):
+            c = casl2sim.Comet2([casl2sim.Element(e.value, e.line) for e in p.get_mem()])
+            if fusion:
+                c.enable_fusion()
+                c.enable_input_replay(casl2sim.InputReplay(io.BytesIO(record.getvalue())))
+            else:
+                c.enable_input_record(casl2sim.InputRecorder(record))
+            fout = io.StringIO()
+            c.run(p.get_start(), p.get_end(), fout, None, None if fusion else io.StringIO("ab\x01c"), True)
+            outputs.append(fout.getvalue())
+        self.assertEqual(["  OUT: abc\n"] * 2, outputs)
+        self.assertEqual(b"C2IN\x01" + bytes([5] + [0] * 7 + [4, 0, 0, 0]) + b"ab\x01c" +
+                bytes([22] + [0] * 11), record.getvalue())
+        c = casl2sim.Comet2([casl2sim.Element(e.value, e.line) for e in p.get_mem()])
+        c.enable_input_replay(casl2sim.InputReplay(io.BytesIO(record.getvalue())))
+        with mock.patch.object(c, "err_exit", side_effect=SystemExit(1)) as mock_err_exit, \
+                self.assertRaises(SystemExit):
+            c.run(p.get_start() + 2, p.get_end(), None, None, None, True)
+        mock_err_exit.assert_called_once_with("input replay mismatch (step 4, recorded step 5)")
+
+    def test_checkpoint(self):
+        asm = ["MAIN START", "  LAD GR1,0", "LOOP LAD GR1,1,GR1", "  ST GR1,BUF", "  OUT BUF,LEN",
+                "  CPA GR1,=60", "  JNZ LOOP", "  RET", "BUF DS 1", "LEN DC 1", "  END"]
+        p = casl2sim.Parser()
+        p.parse([line + "\n" for line in asm])
+        def run(checkpoint=None, resume=None, max_steps=None):
+            c = casl2sim.Comet2([casl2sim.Element(e.value, e.line) for e in p.get_mem()], True)
+            fout = io.StringIO()
+            start, end, virtual_call = p.get_start(), p.get_end(), True
+            if resume is not None:
+                self.assertEqual({"in": None, "out": 81, "replay": None}, c.load_checkpoint(resume))
+                start, end, virtual_call = c.get_pr(), c.get_end(), False
+            if checkpoint is not None:
+                c.enable_checkpoint(100, checkpoint)
+            if max_steps is not None:
+                c.set_max_steps(max_steps)
+            with contextlib.suppress(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                c.run(start, end, fout, None, None, virtual_call)
+            return fout.getvalue(), c.get_counters()
+        expected_out, expected_counters = run()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "checkpoint")
+            out, _ = run(checkpoint=path, max_steps=150)
+            self.assertEqual(expected_out[:len(out)], out)
+            out, counters = run(resume=path)
+            self.assertEqual(expected_out[81:], out)
+            self.assertEqual(expected_counters, counters)
+            self.assertEqual(["checkpoint"], os.listdir(tmpdir))
+            # 別のプログラムでは再開できない
+            c = casl2sim.Comet2([casl2sim.Element(e.value, e.line) for e in p.get_mem()[:-1]])
+            with self.assertRaisesRegex(ValueError, "different program"):
+                c.load_checkpoint(path)
+
     def test_op_SVC_OUT(self):
         mem_vals = [
                 0xf000, 0x0002, ord("X"), ord("X"), ord("t"), ord("e"),
@@ -922,6 +1247,200 @@ class TestComet2(unittest.TestCase):
         actual = c._fout.getvalue()
         self.assertEqual(expected, actual)
 
+    def test_get_counters(self):
+        # CALL 4; JUMP 8; PUSH 3; POP GR1; RET
+        mem_vals = [0x8000, 0x0004, 0x6400, 0x0008, 0x7000, 0x0003, 0x7110, 0x8100, 0x0000]
+        c = casl2sim.Comet2([casl2sim.Element(v, 0) for v in mem_vals])
+        actual = c.run(0, 8)
+        expected = {
+                "instructions": 5,
+                "ops": {"JUMP": 1, "PUSH": 1, "POP": 1, "CALL": 1, "RET": 1},
+                "mem_reads": 2,
+                "mem_writes": 2,
+                "stack_pushes": 2,
+                "stack_pops": 2,
+                "branches_taken": 0,
+                "branches_not_taken": 0,
+                "call_depth_max": 1,
+                "svc_in_bytes": 0,
+                "svc_out_bytes": 0}
+        self.assertEqual(expected, actual)
+
+    def test_cost(self):
+        # MAIN: CALL SUB; JUMP 8; SUB: LD GR1,0,GR1; RET
+        mem_vals = [0x8000, 0x0004, 0x6400, 0x0008, 0x1011, 0x0000, 0x8100, 0x0000, 0x0000]
+        mem = [casl2sim.Element(v, 0) for v in mem_vals]
+        mem[0].label = "MAIN"
+        mem[4].label = "SUB"
+        c = casl2sim.Comet2(mem)
+        model = casl2sim.CostModel.load(io.StringIO(
+            '{"ops": {"CALL": 3, "LD": 2}, "indexed": 1, "memory": 1}'))
+        cost = c.enable_cost(model)
+        c.run(0, 8)
+        # CALL(3+1) JUMP(1) LD(2+1+1) RET(1+1)
+        expected = {"total": 11, "labels": {"MAIN": 5, "SUB": 6},
+                "routines": {"MAIN": (5, 11), "SUB": (6, 6)}}
+        self.assertEqual(expected, cost.get_report())
+
+    def test_cost_hook(self):
+        # MAIN: CALL SUB; JUMP 8; SUB: LD GR1,0,GR1; RET (SUBはフックで処理する)
+        mem_vals = [0x8000, 0x0004, 0x6400, 0x0008, 0x1011, 0x0000, 0x8100, 0x0000, 0x0000]
+        mem = [casl2sim.Element(v, 0) for v in mem_vals]
+        mem[0].label = "MAIN"
+        mem[4].label = "SUB"
+        c = casl2sim.Comet2(mem)
+        c.register_hook(4, lambda c: c.set_gr(1, 1), "SUB")
+        model = casl2sim.CostModel.load(io.StringIO(
+            '{"ops": {"CALL": 3, "LD": 2}, "indexed": 1, "memory": 1}'))
+        cost = c.enable_cost(model)
+        c.run(0, 8)
+        # CALL(3+1) JUMP(1) 戻り先のサブルーチンは集計しない
+        expected = {"total": 5, "labels": {"MAIN": 5}, "routines": {"MAIN": (5, 5)}}
+        self.assertEqual(expected, cost.get_report())
+
+    def test_compare_cost(self):
+        srcs = {"ok": ["MAIN START", "  IN BUF,LEN", "  RET", "BUF DS 8", "LEN DS 1", "  END"],
+                "bad": ["MAIN START", "  DC #ffff", "  END"],
+                "undef": ["MAIN START", "  JUMP NONE", "  END"]}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for name, asm in srcs.items():
+                path = os.path.join(tmpdir, f"{name}.casl2")
+                pathlib.Path(path).write_text("".join([line + "\n" for line in asm]))
+                paths.append(path)
+            with contextlib.redirect_stderr(io.StringIO()):
+                result = casl2sim.compare_cost(paths, ["a", "bc"], casl2sim.CostModel(), virtual_call=True)
+        # エラーになったプログラムも比較を続ける
+        self.assertEqual([[8, 8], [None, None], [None, None]], [result[path] for path in paths])
+
+    def test_register_hook_verify_mem(self):
+        # CALL 4; JUMP 8; SUB: ST GR1,9; RET (SUB: MEM[9] <- GR1)
+        mem_vals = [0x8000, 0x0004, 0x6400, 0x0008, 0x1110, 0x0009, 0x8100, 0x0000, 0x0000, 0x0000]
+        mem = [casl2sim.Element(v, i + 1) for i, v in enumerate(mem_vals)]
+        c = casl2sim.Comet2(mem)
+        c.register_hook(4, lambda c: c.set_mem(9, c.get_gr(1)), "SUB")
+        c.enable_hook_verify()
+        c.init_regs([0, 7, 0, 0, 0, 0, 0, 0], 0, 0, 0, 0, 0)
+        c.run(0, 8)
+        self.assertEqual(7, mem[9].value)
+        # フックが書き込んだ番地は実行前の値、行番号に戻した後、本来のサブルーチンが書き込む
+        self.assertEqual([], c._journals)
+        self.assertEqual([1, 2, 3, 4, 5, 6, 7, 8, 9, 0], [e.line for e in mem[:10]])
+        c = casl2sim.Comet2([casl2sim.Element(v, 0) for v in mem_vals])
+        c.register_hook(4, lambda c: c.set_mem(9, 1), "SUB")
+        c.enable_hook_verify()
+        with mock.patch.object(c, "err_exit", side_effect=SystemExit(1)) as mock_err_exit, \
+                self.assertRaises(SystemExit):
+            c.run(0, 8)
+        mock_err_exit.assert_called_once_with("HLE verify error ('SUB': MEM[0009]=0000, HLE=0001)")
+
+    def test_fusion(self):
+        # LAD GR1,1,GR1; CPA GR1,7; JNZ 0
+        mem_vals = [0x1211, 0x0001, 0x4010, 0x0007, 0x6200, 0x0000, 0x0000, 0x0005]
+        results = []
+        for fusion in (False, True):
+            c = casl2sim.Comet2([casl2sim.Element(v, 0) for v in mem_vals])
+            if fusion:
+                c.enable_fusion()
+            counters = c.run(0, 6)
+            results.append((counters, c._gr, c._pr, c._zf, c._sf, c._of))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(15, results[1][0]["instructions"])
+        self.assertEqual(5, c._gr[1])
+        self.assertTrue(0 in c._fusion)
+        c.set_mem(3, 0x0006)
+        self.assertFalse(0 in c._fusion)
+        self.assertEqual(bytes(6), bytes(c._fusion_cover[0:6]))
+        # まとめる命令列がなくなった番地への書き込みでは無効化しない
+        with mock.patch.object(c, "invalidate_fusion") as invalidate_fusion:
+            c.set_mem(3, 0x0007)
+            c.set_mem_block(2, [0x4010, 0x0007])
+            invalidate_fusion.assert_not_called()
+
+    def test_register_hook(self):
+        # CALL 4; JUMP 6; SUB: LAD GR1,5; RET (SUB: GR1 <- 5)
+        mem_vals = [0x8000, 0x0004, 0x6400, 0x0007, 0x1210, 0x0005, 0x8100, 0x0000]
+        def hook(c):
+            c.set_gr(1, 5)
+        for verify in (False, True):
+            with self.subTest(verify=verify):
+                c = casl2sim.Comet2([casl2sim.Element(v, 0) for v in mem_vals])
+                c.register_hook(4, hook, "SUB")
+                if verify:
+                    c.enable_hook_verify()
+                counters = c.run(0, 7)
+                self.assertEqual([0, 5, 0, 0, 0, 0, 0, 0], c._gr)
+                self.assertEqual(0, c._sp)
+                self.assertEqual(0x0002, c._mem[0xffff].value)
+                self.assertEqual(4 if verify else 2, counters["instructions"])
+
+    @mock.patch("casl2sim.Comet2.err_exit", side_effect=SystemExit(1))
+    def test_register_hook_verify_error(self, mock_err_exit):
+        mem_vals = [0x8000, 0x0004, 0x6400, 0x0007, 0x1210, 0x0005, 0x8100, 0x0000]
+        c = casl2sim.Comet2([casl2sim.Element(v, 0) for v in mem_vals])
+        c.register_hook(4, lambda c: c.set_gr(1, 6), "SUB")
+        c.enable_hook_verify()
+        with self.assertRaises(SystemExit):
+            c.run(0, 7)
+        self.assertTrue(mock_err_exit.call_args.args[0].startswith("HLE verify error ('SUB'"))
+
+    @mock.patch("sys.stderr.write")
+    def test_output_postmortem(self, mock_stderr_write):
+        mem_vals = [0x1210, 0x0003, 0x2110, 0x0006, 0x6200, 0x0002, 0x0001, 0xff00]
+        c = casl2sim.Comet2([casl2sim.Element(v, 0) for v in mem_vals])
+        c.enable_postmortem(2)
+        with self.assertRaises(SystemExit):
+            c.run(0, 0xffff)
+        actual = "".join(["".join(call.args) for call in mock_stderr_write.call_args_list])
+        expected = "Runtime Error: unknown operation ([0007]: ff00)\n" + \
+                "Postmortem: last 2 steps\n" + \
+                "PM:        7 [0006] 0001 ff00\n" + \
+                "PM:        8 [0007] ff00 0000\n"
+        self.assertEqual(expected, actual)
+
+    def test_coverage(self):
+        # L1: LAD GR1,1  L2: SUBA GR1,=1  L3: JNZ 2  L4: JZE 0  L5: DC 1
+        mem = [casl2sim.Element(v, l) for v, l in [
+                (0x1210, 1), (0x0001, 1), (0x2110, 2), (0x0008, 2), (0x6200, 3), (0x0002, 3),
+                (0x6300, 4), (0x0000, 4), (0x0001, 5)]]
+        c = casl2sim.Comet2(mem)
+        cov = c.enable_coverage()
+        c.run(0, 6)
+        lines, branches = cov.get_records({1, 2, 3, 4})
+        self.assertEqual({1:1, 2:1, 3:1, 4:0}, lines)
+        self.assertEqual({(3, 4, 0):0, (3, 4, 1):1, (4, 6, 0):None, (4, 6, 1):None}, branches)
+        records = {}
+        casl2sim.Coverage.merge_records(records, "a.casl2", lines, branches)
+        f = io.StringIO()
+        casl2sim.Coverage.write_lcov(f, records)
+        f.seek(0)
+        merged = casl2sim.Coverage.read_lcov(f)
+        casl2sim.Coverage.merge_records(merged, "a.casl2", lines, branches)
+        expected = {"a.casl2": ({1:2, 2:2, 3:2, 4:0},
+            {(3, 4, 0):0, (3, 4, 1):2, (4, 6, 0):None, (4, 6, 1):None})}
+        self.assertEqual(expected, merged)
+
+    def test_op_SVC_ext(self):
+        # SVC COPY; SVC FILL; SVC CMP; SVC OUTW
+        mem_vals = [0xf000, 0x0010, 0xf000, 0x0011, 0xf000, 0x0012, 0xf000, 0x0013,
+                0x0001, 0x0002, 0x0003, 0x0004, 0x0000, 0x0000, 0x0000, 0x0000, 0x0003]
+        c = casl2sim.Comet2([casl2sim.Element(v, 0) for v in mem_vals])
+        c.enable_svc_ext()
+        c._fout = io.StringIO()
+        c._gr[1:4] = [8, 12, 4]
+        c.op_SVC(c.fetch())
+        self.assertEqual([1, 2, 3, 4], [e.value for e in c._mem[12:16]])
+        c._gr[1:4] = [14, 0xbeef, 2]
+        c.op_SVC(c.fetch())
+        self.assertEqual([1, 2, 0xbeef, 0xbeef], [e.value for e in c._mem[12:16]])
+        c._gr[1:4] = [8, 12, 4]
+        c.op_SVC(c.fetch())
+        self.assertEqual(2, c._gr[0])
+        self.assertEqual((0, 1, 0), (c._zf, c._sf, c._of))
+        c._gr[1:3] = [13, 16]
+        c.op_SVC(c.fetch())
+        self.assertEqual("  OUT: 0002 beef beef\n", c._fout.getvalue())
+
     @mock.patch("sys.stderr.write")
     def test_err_exit_no_print_regs(self, mock_stderr_write):
         var1 = 12
@@ -942,6 +1461,251 @@ class TestComet2(unittest.TestCase):
                 self.assertEqual(expected, actual)
 # End TestComet2
 
+@unittest.skipIf(casl2sim.np is None, "numpy is not installed")
+class TestComet2Lanes(unittest.TestCase):
+    def test_run(self):
+        asm = [
+                "MAIN  START",
+                "      IN    BUF,LEN",
+                "      LAD   GR1,0",
+                "LOOP  CPA   GR1,LEN",
+                "      JZE   FIN",
+                "      LD    GR2,BUF,GR1",
+                "      CPL   GR2,=77",
+                "      JMI   NEXT",
+                "      SLL   GR2,1",
+                "      ADDA  GR2,GR1",
+                "      ST    GR2,BUF,GR1",
+                "NEXT  LAD   GR1,1,GR1",
+                "      JUMP  LOOP",
+                "FIN   OUT   BUF,LEN",
+                "      RET",
+                "LEN   DS    1",
+                "BUF   DS    256",
+                "      END"]
+        inputs = ["", "ABC", "xyz a\nQ", "M" * 300]
+        p = casl2sim.Parser()
+        p.parse([line + "\n" for line in asm])
+        vals = [e.value for e in p.get_mem()]
+        lanes = casl2sim.Comet2Lanes(p.get_mem(), inputs)
+        results = lanes.run(p.get_start(), p.get_end(), True)
+        for i, (instr, result) in enumerate(zip(inputs, results)):
+            with self.subTest(instr=instr):
+                c = casl2sim.Comet2([casl2sim.Element(v, 0) for v in vals])
+                c._fout = io.StringIO()
+                counters = c.run(p.get_start(), p.get_end(), c._fout, None, io.StringIO(instr), True)
+                expected = (c._gr, c._pr, c._sp, c._zf, c._sf, c._of, counters["instructions"],
+                        c._fout.getvalue(), [e.value for e in c._mem])
+                actual = (result["gr"], result["pr"], result["sp"], result["zf"], result["sf"],
+                        result["of"], result["steps"],
+                        "".join([f"  OUT: {msg}\n" for msg in result["output"]]), lanes.get_mem(i))
+                self.assertEqual(expected, actual)
+
+    def test_run_max_steps(self):
+        asm = ["MAIN START", "  IN BUF,LEN", "  LD GR1,LEN", "L JNZ L", "  RET",
+                "LEN DS 1", "BUF DS 256", "  END"]
+        p = casl2sim.Parser()
+        p.parse([line + "\n" for line in asm])
+        lanes = casl2sim.Comet2Lanes(p.get_mem(), ["", "A"])
+        results = lanes.run(p.get_start(), p.get_end(), True, 50)
+        self.assertEqual([None, "max steps exceeded (50)"], [r["error"] for r in results])
+        self.assertEqual(50, results[1]["steps"])
+# End TestComet2Lanes
+
+class TestMemWindow(unittest.TestCase):
+    def test_attach_detach(self):
+        patterns = [
+                ("byte", b"\x01\x02\x03", [1, 2, 3], b"\x11\x12\x13"),
+                ("be16", b"\x01\x02\x03\x04", [0x0102, 0x0304], b"\x11\x12\x13\x14"),
+                ("le16", b"\x01\x02\x03\x04", [0x0201, 0x0403], b"\x11\x12\x13\x14")]
+        for packing, data, expected_vals, expected_data in patterns:
+            with self.subTest(packing), tempfile.TemporaryDirectory() as tmpdir:
+                path = pathlib.Path(tmpdir) / "window.bin"
+                path.write_bytes(data)
+                c = casl2sim.Comet2([])
+                window = casl2sim.MemWindow(str(path), 0x8000, True, packing)
+                window.attach(c)
+                actual_vals = [e.value for e in c._mem[0x8000:0x8000+len(expected_vals)]]
+                self.assertEqual(expected_vals, actual_vals)
+                for e in c._mem[0x8000:0x8000+len(expected_vals)]:
+                    e.value += 0x1010
+                window.detach(c)
+                self.assertEqual(expected_data, path.read_bytes())
+
+    def test_attach_clear_debug(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = pathlib.Path(tmpdir) / "window.bin"
+            path.write_bytes(b"\x01")
+            c = casl2sim.Comet2([casl2sim.Element(0, 3, "DATA", "LAB")])
+            window = casl2sim.MemWindow(str(path), 0, False)
+            window.attach(c)
+            window.detach(c)
+            e = c._mem[0]
+            self.assertEqual((1, 0, None, "LAB"), (e.value, e.line, e.vlabel, e.label))
+# End TestMemWindow
+
+class TestFuzzer(unittest.TestCase):
+    def test_fuzz(self):
+        # LAD GR1,16; LAD GR2,15; SVC 1; LD GR1,16; CPL GR1,14; JNZ 13; DC #ff00; RET; DC 65
+        mem_vals = [0x1210, 0x0010, 0x1220, 0x000f, 0xf000, 0x0001, 0x1010, 0x0010,
+                0x4110, 0x000e, 0x6200, 0x000d, 0xff00, 0x8100, 0x0041]
+        mem = casl2sim.Comet2([casl2sim.Element(v, 0) for v in mem_vals]).get_allmem()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fuzzer = casl2sim.Fuzzer(mem, 0, 0x0100, tmpdir, virtual_call=True, max_steps=100, seed=0)
+            self.assertEqual("error", fuzzer.run_input(b"A")[1])
+            bits, reason, _ = fuzzer.run_input(b"B")
+            self.assertIsNone(reason)
+            self.assertEqual(bits, fuzzer.run_input(b"B")[0])
+            self.assertNotEqual(bits, fuzzer.run_input(b"A")[0])
+            runs, _, crashes = fuzzer.fuzz(300)
+            self.assertEqual(300, runs)
+            # 同じ異常終了は1つのみ保存する
+            self.assertEqual(1, crashes)
+            self.assertEqual(1, len(list((pathlib.Path(tmpdir) / "crashes").glob("error-*.txt"))))
+            self.assertEqual((300, 0), fuzzer.fuzz(300)[::2])
+
+    def test_fuzz_virtual_call_end(self):
+        # LAD GR1,8; LAD GR2,7; SVC 1 (ENDで終了)
+        mem_vals = [0x1210, 0x0008, 0x1220, 0x0007, 0xf000, 0x0001]
+        mem = casl2sim.Comet2([casl2sim.Element(v, 0) for v in mem_vals]).get_allmem()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fuzzer = casl2sim.Fuzzer(mem, 0, 6, tmpdir, virtual_call=True, max_steps=100, seed=0)
+            self.assertIsNone(fuzzer.run_input(b"A")[1])
+            self.assertEqual((100, 0), fuzzer.fuzz(100)[::2])
+# End TestFuzzer
+
+class TestResultCache(unittest.TestCase):
+    def test_run_cached(self):
+        # LAD GR1,10; LAD GR2,9; SVC 1; SVC 2; RET; (LEN) (BUF)
+        mem_vals = [0x1210, 0x000a, 0x1220, 0x0009, 0xf000, 0x0001, 0xf000, 0x0002, 0x8100]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = casl2sim.ResultCache(tmpdir)
+            mem = [casl2sim.Element(v, 0) for v in mem_vals]
+            key = casl2sim.ResultCache.make_key(mem, ([0]*8, 0, 0, 0, 0), {}, "abc")
+            self.assertNotEqual(key, casl2sim.ResultCache.make_key(mem, ([0]*8, 0, 0, 0, 0), {}, "abd"))
+            c = casl2sim.Comet2(mem, False, True)
+            fout = io.StringIO()
+            result = casl2sim.run_cached(cache, key, c, 0, 0x100, fout, io.StringIO("abc"), True)
+            self.assertEqual("abc", fout.getvalue())
+            self.assertEqual(5, result["counters"]["instructions"])
+            c = casl2sim.Comet2([], False, True)
+            fout = io.StringIO()
+            with mock.patch.object(c, "run") as run:
+                self.assertEqual(result, casl2sim.run_cached(cache, key, c, 0, 0x100, fout, None, True))
+                run.assert_not_called()
+            self.assertEqual("abc", fout.getvalue())
+
+    def test_run_cached_no_output(self):
+        # LAD GR1,8; LAD GR2,7; SVC 2; RET; (LEN) (BUF)
+        mem_vals = [0x1210, 0x0008, 0x1220, 0x0007, 0xf000, 0x0002, 0x8100, 0x0001, 0x0041]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = casl2sim.ResultCache(tmpdir)
+            mem = [casl2sim.Element(v, 0) for v in mem_vals]
+            key = casl2sim.ResultCache.make_key(mem, ([0]*8, 0, 0, 0, 0), {}, None)
+            casl2sim.run_cached(cache, key, casl2sim.Comet2(mem, False, True), 0, 0x100, None, None, True)
+            # 出力を無効にした実行の結果からも出力する
+            fout = io.StringIO()
+            c = casl2sim.Comet2([], False, True)
+            with mock.patch.object(c, "run") as run:
+                casl2sim.run_cached(cache, key, c, 0, 0x100, fout, None, True)
+                run.assert_not_called()
+            self.assertEqual("A", fout.getvalue())
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = casl2sim.ResultCache(tmpdir, 130)
+            for key in ["a", "b", "c"]:
+                cache.put(key, {"output": key * 40})
+                os.utime(pathlib.Path(tmpdir) / f"{key}.json", (0, {"a": 3, "b": 1, "c": 2}[key]))
+            cache.put("d", {"output": "d" * 40})
+            self.assertIsNone(cache.get("b"))
+            self.assertIsNone(cache.get("c"))
+            self.assertEqual({"output": "a" * 40}, cache.get("a"))
+# End TestResultCache
+
+class TestSharedImage(unittest.TestCase):
+    def test_publish_attach(self):
+        mem = casl2sim.Comet2([casl2sim.Element(0x1210, 1, None, "MAIN"),
+                casl2sim.Element(0x0002, 1, "DATA"), casl2sim.Element(0x1234, 2, None, "DATA")]).get_allmem()
+        image = casl2sim.SharedImage.publish(mem, 0, 0x0003, {"MAIN": 0, "DATA": 2})
+        try:
+            attached = casl2sim.SharedImage.attach(image.get_name())
+            actual = attached.get_mem()
+            self.assertEqual((0, 3), (attached.get_start(), attached.get_end()))
+            self.assertEqual({"MAIN": 0, "DATA": 2}, attached.get_labels())
+            self.assertEqual([(e.value, e.line) for e in mem], [(e.value, e.line) for e in actual])
+            self.assertEqual("DATA+1", casl2sim.SymbolIndex(attached.get_labels()).format(3))
+            actual[2].value = 0
+            self.assertEqual(0x1234, attached.get_mem()[2].value)
+            attached.close()
+        finally:
+            image.close()
+# End TestSharedImage
+
+class TestRunAsync(unittest.TestCase):
+    class Writer:
+        def __init__(self):
+            self.data = b""
+            self.drained = 0
+
+        def write(self, data):
+            self.data += data
+
+        async def drain(self):
+            self.drained += 1
+
+    def test_run_async(self):
+        # LAD GR1,10; LAD GR2,9; SVC 1; SVC 2; RET; (LEN) (BUF)
+        mem_vals = [0x1210, 0x000a, 0x1220, 0x0009, 0xf000, 0x0001, 0xf000, 0x0002, 0x8100]
+        writers = [self.Writer() for _ in range(2)]
+        async def main():
+            readers = [asyncio.StreamReader() for _ in range(2)]
+            machines = [casl2sim.Comet2([casl2sim.Element(v, 0) for v in mem_vals], False, True)
+                    for _ in range(2)]
+            tasks = [asyncio.create_task(casl2sim.run_async(c, 0, 0x100, r, w, 2, True))
+                    for c, r, w in zip(machines, readers, writers)]
+            readers[1].feed_data(b"xyz")
+            readers[1].feed_eof()
+            await asyncio.sleep(0.01)
+            self.assertEqual(2, machines[0].get_steps())
+            self.assertEqual(b"xyz", writers[1].data)
+            readers[0].feed_data(b"a" * 100)
+            await asyncio.sleep(0.01)
+            self.assertEqual(2, machines[0].get_steps())
+            readers[0].feed_data(b"\n" + b"b" * 200)
+            return await asyncio.gather(*tasks)
+        results = asyncio.run(main())
+        self.assertEqual([5, 5], [r["instructions"] for r in results])
+        self.assertEqual(b"a" * 100 + b"b" * 156, writers[0].data)
+
+    def test_serve_unix_max_steps(self):
+        # LAD GR1,1; JUMP 2
+        mem = [casl2sim.Element(v, 0) for v in [0x1210, 0x0001, 0x6400, 0x0002]]
+        async def main(path):
+            server = asyncio.create_task(casl2sim.serve_unix(path, mem, 0, 0x100, 10, True, max_steps=50))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            reader, writer = await asyncio.open_unix_connection(path)
+            # 最大ステップ数を超えた接続は閉じる
+            data = await asyncio.wait_for(reader.read(), 10)
+            writer.close()
+            server.cancel()
+            return data
+        with tempfile.TemporaryDirectory() as tmpdir, contextlib.redirect_stderr(io.StringIO()) as ferr:
+            self.assertEqual(b"", asyncio.run(main(os.path.join(tmpdir, "sock"))))
+        self.assertIn("max steps exceeded (50)", ferr.getvalue())
+
+    def test_run_steps(self):
+        # LAD GR1,1; ADDA GR1,GR1; JUMP 2
+        c = casl2sim.Comet2([casl2sim.Element(v, 0) for v in [0x1210, 0x0001, 0x2411, 0x6400, 0x0002]])
+        c.setup(0, 5)
+        self.assertIsNone(c.run_steps(3))
+        self.assertEqual(3, c.get_steps())
+        self.assertEqual(2, c.get_gr(1))
+        self.assertIsNone(c.run_steps(2))
+        self.assertEqual(4, c.get_gr(1))
+# End TestRunAsync
+
 class TestMain(unittest.TestCase):
     def setUp(self):
         self.orig_argv = sys.argv
@@ -949,6 +1713,17 @@ class TestMain(unittest.TestCase):
     def tearDown(self):
         sys.argv = self.orig_argv
 
+    @mock.patch("sys.stdout", new_callable=io.StringIO)
+    def test_print_mem(self, mock_stdout):
+        mem = [casl2sim.Element(i, 0) for i in range(24)]
+        base_vals = [e.value for e in mem]
+        mem[17].value = 0xbeef
+        rows = casl2sim.parse_mem_ranges("LAB:LAB+1,0x10", {"LAB": 7})
+        self.assertEqual([0, 8, 16], rows)
+        casl2sim.print_mem(mem, rows, base_vals)
+        expected = "# [0010]: 0010 beef 0012 0013 0014 0015 0016 0017\n\n"
+        self.assertEqual(expected, mock_stdout.getvalue())
+
     def test_run_asmfile(self):
         asmdir = pathlib.Path("asm")
         testfiles = [str(p) for p in